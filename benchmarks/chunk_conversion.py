@@ -0,0 +1,92 @@
+"""
+Microbenchmark of the per-chunk cost of `to_generic_streaming_chunk` versus
+the per-stream `StreamingChunkConverter`.
+
+The equivalence of the two over the same recorded chunks is checked by
+`tests/test_chunk_converter.py`.
+
+Usage (from the root of the repository):
+
+```bash
+uv run python -m benchmarks.chunk_conversion
+```
+
+Recorded chunks are read from JSON Lines files in the format that
+`TRACE_FORMAT=jsonl` produces (`.traces/*_RESPONSE_STREAM.jsonl`), so real
+traces can be used instead of the bundled sample:
+
+```bash
+uv run python -m benchmarks.chunk_conversion .traces/*_RESPONSE_STREAM.jsonl
+```
+"""
+
+import argparse
+import json
+import timeit
+from pathlib import Path
+
+from litellm import ModelResponseStream
+
+from common.chunk_converter import StreamingChunkConverter
+from common.utils import to_generic_streaming_chunk
+
+
+DEFAULT_RECORDING = Path(__file__).parent / "data" / "recorded_stream_chunks.jsonl"
+
+
+def load_recorded_streams(paths: list[Path]) -> list[list[ModelResponseStream]]:
+    """
+    Every file is one recorded stream (consecutive chunks with different ids
+    within a file are treated as separate streams too).
+    """
+    streams: list[list[ModelResponseStream]] = []
+    for path in paths:
+        last_id = None
+        with path.open(encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if "complapi_chunk" not in record:
+                    continue
+                chunk = ModelResponseStream(**record["complapi_chunk"])
+                if chunk.id != last_id:
+                    streams.append([])
+                    last_id = chunk.id
+                streams[-1].append(chunk)
+    return streams
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", nargs="*", type=Path, default=[DEFAULT_RECORDING])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=200, help="How many times to convert every stream per repeat")
+    args = parser.parse_args()
+
+    streams = load_recorded_streams(args.recordings)
+    total_chunks = sum(len(stream) for stream in streams)
+    print(f"Loaded {total_chunks} chunks in {len(streams)} stream(s)\n")
+
+    def _baseline() -> None:
+        for stream in streams:
+            for chunk in stream:
+                to_generic_streaming_chunk(chunk)
+
+    def _specialized() -> None:
+        for stream in streams:
+            # A new converter per stream, just like in the handlers
+            convert_chunk = StreamingChunkConverter()
+            for chunk in stream:
+                convert_chunk(chunk)
+
+    results = {}
+    for name, fn in (("to_generic_streaming_chunk", _baseline), ("StreamingChunkConverter", _specialized)):
+        best = min(timeit.repeat(fn, repeat=args.repeat, number=args.number))
+        results[name] = best / (args.number * total_chunks) * 1e9
+        print(f"{name:>28}: {results[name]:8.0f} ns/chunk")
+
+    speedup = results["to_generic_streaming_chunk"] / results["StreamingChunkConverter"]
+    print(f"\n{'speedup':>28}: {speedup:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,615 @@
+"""
+End-to-end benchmark of the proxy against a local mock upstream (see
+`benchmarks/mock_upstream.py`), without any network access or API keys.
+
+Every scenario is a combination of:
+
+- a mode:
+  - `proxy` - requests go through `litellm --config config.yaml` (started the
+    same way `uv-run.sh` does) over HTTP; LiteLLM Server always calls the
+    async entry points of the handlers
+  - `async` - `litellm.acompletion()` calls the handler in-process
+    (`acompletion` / `astreaming`)
+  - `sync` - `litellm.completion()` calls the handler in-process from a thread
+    pool (`completion` / `streaming`)
+- a kind of request: `completion` or `streaming`
+- tracing: `off` or `on` (`WRITE_TRACES_TO_FILES`, written to a temporary
+  folder)
+- the number of worker processes of the LiteLLM Server (`proxy` mode only,
+  `NUM_WORKERS`) - the report ends with the throughput of every worker count
+  relative to the first one (make sure the concurrency is high enough to keep
+  all the workers busy, and that the mock upstream is not the bottleneck)
+
+Every (mode, tracing) pair runs in a fresh process, with the `openai/...`
+target of the handler pointed at the mock via `OPENAI_BASE_URL`. For every
+scenario the benchmark reports requests/sec, latency and time to first chunk
+percentiles, the per-chunk overhead (the time between the mock sending a
+token and the client receiving it) and the memory of the process that runs
+the handler. The results are saved as JSON, and can be compared with a
+previous run:
+
+```bash
+uv run python -m benchmarks.e2e_benchmark --concurrency 32 --requests 500
+uv run python -m benchmarks.e2e_benchmark --modes async,sync --compare benchmarks/results/e2e_<timestamp>.json
+uv run python -m benchmarks.e2e_benchmark --modes proxy --tracing off --workers 1,2,4 --concurrency 128
+```
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import httpx
+
+PROJECT_DIR = Path(__file__).parent.parent
+RESULTS_DIR = Path(__file__).parent / "results"
+
+_STAMP_RE = re.compile(r"\[t=(\d+)\]")
+_IN_PROCESS_MODEL = "yoda_speak/yoda"
+# `model_name` in `config.yaml`
+_PROXY_MODEL = "yoda"
+
+
+# Measurements
+
+
+def new_sample() -> dict[str, Any]:
+    return {"started_ns": time.time_ns(), "first_chunk_ns": None, "ended_ns": None, "overheads_ns": [], "error": None}
+
+
+def record_content(sample: dict[str, Any], content: Optional[str], *, chunk: bool = True) -> None:
+    if not content:
+        return
+    received_ns = time.time_ns()
+    if sample["first_chunk_ns"] is None:
+        sample["first_chunk_ns"] = received_ns
+    if not chunk:
+        # The tokens of a non-streamed response were all sent at the end
+        return
+    for sent_ns in _STAMP_RE.findall(content):
+        sample["overheads_ns"].append(received_ns - int(sent_ns))
+
+
+def percentiles(values: list[float]) -> Optional[dict[str, float]]:
+    if not values:
+        return None
+    values = sorted(values)
+
+    def _pct(pct: float) -> float:
+        return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": _pct(50),
+        "p90": _pct(90),
+        "p99": _pct(99),
+        "max": values[-1],
+    }
+
+
+def summarize(samples: list[dict[str, Any]], wall_seconds: float) -> dict[str, Any]:
+    succeeded = [s for s in samples if s["error"] is None]
+    errors = [s["error"] for s in samples if s["error"] is not None]
+    return {
+        "requests": len(samples),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "wall_seconds": wall_seconds,
+        "requests_per_second": len(succeeded) / wall_seconds if wall_seconds else 0.0,
+        "latency_ms": percentiles([(s["ended_ns"] - s["started_ns"]) / 1e6 for s in succeeded]),
+        "ttft_ms": percentiles(
+            [(s["first_chunk_ns"] - s["started_ns"]) / 1e6 for s in succeeded if s["first_chunk_ns"] is not None]
+        ),
+        "chunk_overhead_ms": percentiles([overhead / 1e6 for s in succeeded for overhead in s["overheads_ns"]]),
+    }
+
+
+def memory_usage(pid: Optional[int] = None) -> dict[str, Optional[float]]:
+    """
+    Current and peak RSS of a process (in MB). Linux only, except for the
+    peak RSS of the current process.
+    """
+    status = {}
+    try:
+        with open(f"/proc/{pid or 'self'}/status", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                status[key] = value.strip()
+    except OSError:
+        pass
+
+    def _mb(key: str) -> Optional[float]:
+        return int(status[key].split()[0]) / 1024 if key in status else None
+
+    peak_rss_mb = _mb("VmHWM")
+    if peak_rss_mb is None and pid is None:
+        # Kilobytes on Linux, bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_rss_mb = max_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {"rss_mb": _mb("VmRSS"), "peak_rss_mb": peak_rss_mb}
+
+
+def process_tree_memory_usage(pid: int) -> dict[str, Optional[float]]:
+    """
+    `memory_usage()` of a process and all its descendants (e.g. the worker
+    processes of the LiteLLM Server) put together. Linux only.
+    """
+    pids, total = [pid], {"rss_mb": None, "peak_rss_mb": None}
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/task/{current}/children", encoding="utf-8") as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+        for key, value in memory_usage(current).items():
+            if value is not None:
+                total[key] = (total[key] or 0.0) + value
+    return total
+
+
+# Load generation
+
+
+async def arun_concurrently(send_one: Callable, concurrency: int, requests: int) -> list[dict[str, Any]]:
+    samples = []
+    indexes = iter(range(requests))
+
+    async def _worker() -> None:
+        for idx in indexes:
+            samples.append(await send_one(idx))
+
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    return samples
+
+
+def run_concurrently(send_one: Callable, concurrency: int, requests: int) -> list[dict[str, Any]]:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(send_one, range(requests)))
+
+
+def benchmark_messages(idx: int) -> list[dict[str, str]]:
+    # Different for every request, so that no cache or coalescing kicks in
+    return [{"role": "user", "content": f"Benchmark request #{idx}. How is the weather on Dagobah?"}]
+
+
+def proxy_sender(client: httpx.AsyncClient, base_url: str, kind: str) -> Callable:
+    url = f"{base_url}/v1/chat/completions"
+
+    async def _send(idx: int) -> dict[str, Any]:
+        sample = new_sample()
+        payload = {"model": _PROXY_MODEL, "messages": benchmark_messages(idx), "stream": kind == "streaming"}
+        try:
+            if kind == "streaming":
+                async with client.stream("POST", url, json=payload) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: ") or line == "data: [DONE]":
+                            continue
+                        for choice in json.loads(line[6:]).get("choices") or []:
+                            record_content(sample, (choice.get("delta") or {}).get("content"))
+            else:
+                response = await client.post(url, json=payload)
+                response.raise_for_status()
+                record_content(sample, response.json()["choices"][0]["message"]["content"], chunk=False)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            sample["error"] = repr(e)
+        sample["ended_ns"] = time.time_ns()
+        return sample
+
+    return _send
+
+
+def in_process_sender(mode: str, kind: str) -> Callable:
+    import litellm  # pylint: disable=import-outside-toplevel
+
+    stream = kind == "streaming"
+
+    async def _asend(idx: int) -> dict[str, Any]:
+        sample = new_sample()
+        try:
+            response = await litellm.acompletion(
+                model=_IN_PROCESS_MODEL, messages=benchmark_messages(idx), stream=stream
+            )
+            if stream:
+                async for chunk in response:
+                    record_content(sample, chunk.choices[0].delta.content if chunk.choices else None)
+            else:
+                record_content(sample, response.choices[0].message.content, chunk=False)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            sample["error"] = repr(e)
+        sample["ended_ns"] = time.time_ns()
+        return sample
+
+    def _send(idx: int) -> dict[str, Any]:
+        sample = new_sample()
+        try:
+            response = litellm.completion(model=_IN_PROCESS_MODEL, messages=benchmark_messages(idx), stream=stream)
+            if stream:
+                for chunk in response:
+                    record_content(sample, chunk.choices[0].delta.content if chunk.choices else None)
+            else:
+                record_content(sample, response.choices[0].message.content, chunk=False)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            sample["error"] = repr(e)
+        sample["ended_ns"] = time.time_ns()
+        return sample
+
+    return _asend if mode == "async" else _send
+
+
+def run_kind(send_one: Callable, args: argparse.Namespace) -> dict[str, Any]:
+    run_concurrently(send_one, args.concurrency, args.warmup)
+    started_at = time.perf_counter()
+    samples = run_concurrently(send_one, args.concurrency, args.requests)
+    return summarize(samples, time.perf_counter() - started_at)
+
+
+async def arun_kind(send_one: Callable, args: argparse.Namespace) -> dict[str, Any]:
+    await arun_concurrently(send_one, args.concurrency, args.warmup)
+    started_at = time.perf_counter()
+    samples = await arun_concurrently(send_one, args.concurrency, args.requests)
+    return summarize(samples, time.perf_counter() - started_at)
+
+
+def run_worker(args: argparse.Namespace) -> None:
+    """
+    Runs in a subprocess (so that every scenario starts from a clean slate and
+    the memory measurements are not mixed up) and prints the results of all
+    the kinds as a JSON line.
+    """
+    # pylint: disable=import-outside-toplevel
+    import litellm
+    from litellm.utils import custom_llm_setup
+
+    from yoda_example.yoda_speak import yoda_speak_llm
+
+    litellm.custom_provider_map = [{"provider": "yoda_speak", "custom_handler": yoda_speak_llm}]
+    custom_llm_setup()
+
+    results = {"memory_before": memory_usage(), "kinds": {}}
+    if args.worker == "sync":
+        for kind in args.kinds:
+            results["kinds"][kind] = run_kind(in_process_sender("sync", kind), args)
+            results["kinds"][kind]["memory"] = memory_usage()
+    else:
+
+        async def _arun_kinds() -> None:
+            for kind in args.kinds:
+                results["kinds"][kind] = await arun_kind(in_process_sender("async", kind), args)
+                results["kinds"][kind]["memory"] = memory_usage()
+
+        # A single event loop, like in LiteLLM Server (the pooled upstream
+        # clients are bound to the loop they were created in)
+        asyncio.run(_arun_kinds())
+    print(json.dumps(results))
+
+
+# Processes
+
+
+def scenario_env(args: argparse.Namespace, tracing: bool, traces_dir: str) -> dict[str, str]:
+    return {
+        **os.environ,
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.mock_port}/v1",
+        "OPENAI_API_KEY": "sk-benchmark",
+        "LITELLM_LOCAL_MODEL_COST_MAP": "True",
+        "LITELLM_CONFIG": str(args.config),
+        "WRITE_TRACES_TO_FILES": "true" if tracing else "false",
+        "TRACES_DIR": traces_dir,
+        # The requests are all different anyway, but a cache lookup is not
+        # part of what is being measured
+        "RESPONSE_CACHE": "",
+        "REQUEST_COALESCING": "false",
+        "PYTHONUNBUFFERED": "1",
+    }
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[0]} exited with code {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} didn't respond within {timeout} seconds")
+
+
+def stop_process(process: subprocess.Popen) -> None:
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def start_mock(args: argparse.Namespace) -> subprocess.Popen:
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.mock_upstream",
+        "--port",
+        str(args.mock_port),
+        "--ttft",
+        args.mock_ttft,
+        "--tokens-per-second",
+        str(args.mock_tokens_per_second),
+        "--output-tokens",
+        str(args.mock_output_tokens),
+        "--stamp-tokens",
+        "--seed",
+        "0",
+    ]
+    if args.mock_inter_token:
+        command += ["--inter-token", args.mock_inter_token]
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        command, cwd=PROJECT_DIR, stdout=subprocess.DEVNULL
+    )
+    wait_until_ready(f"http://127.0.0.1:{args.mock_port}/health", process, timeout=30)
+    return process
+
+
+def run_proxy_scenarios(args: argparse.Namespace, env: dict[str, str], workers: int) -> dict[str, Any]:
+    # The same command as in `uv-run.sh` (minus `uv run`, which is expected to
+    # wrap the benchmark itself)
+    command = [
+        shutil.which("litellm") or "litellm",
+        "--config",
+        str(args.config),
+        "--port",
+        str(args.proxy_port),
+        "--host",
+        "127.0.0.1",
+    ]
+    env = {**env, "NUM_WORKERS": str(workers)}
+    with tempfile.TemporaryFile() as log:
+        process = subprocess.Popen(  # pylint: disable=consider-using-with
+            command, cwd=PROJECT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        try:
+            base_url = f"http://127.0.0.1:{args.proxy_port}"
+            try:
+                wait_until_ready(f"{base_url}/health/liveliness", process, timeout=args.startup_timeout)
+            except (RuntimeError, TimeoutError):
+                log.seek(0)
+                print(log.read().decode("utf-8", errors="replace")[-4000:], file=sys.stderr)
+                raise
+
+            results = {"memory_before": process_tree_memory_usage(process.pid), "kinds": {}}
+            for kind in args.kinds:
+
+                async def _run(kind: str = kind) -> dict[str, Any]:
+                    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+                    async with httpx.AsyncClient(timeout=args.request_timeout, limits=limits) as client:
+                        return await arun_kind(proxy_sender(client, base_url, kind), args)
+
+                results["kinds"][kind] = asyncio.run(_run())
+                results["kinds"][kind]["memory"] = process_tree_memory_usage(process.pid)
+            return results
+        finally:
+            stop_process(process)
+
+
+def run_worker_scenarios(args: argparse.Namespace, mode: str, env: dict[str, str]) -> dict[str, Any]:
+    command = [
+        sys.executable,
+        "-m",
+        "benchmarks.e2e_benchmark",
+        "--worker",
+        mode,
+        "--kinds",
+        ",".join(args.kinds),
+        "--concurrency",
+        str(args.concurrency),
+        "--requests",
+        str(args.requests),
+        "--warmup",
+        str(args.warmup),
+    ]
+    completed = subprocess.run(command, cwd=PROJECT_DIR, env=env, capture_output=True, text=True, check=False)
+    if completed.returncode != 0:
+        print(completed.stderr[-4000:], file=sys.stderr)
+        raise RuntimeError(f"The {mode} worker exited with code {completed.returncode}")
+    # The last line - the handler may print things too
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+# Reporting
+
+
+def scenario_key(scenario: dict[str, Any]) -> tuple[str, str, str, int]:
+    # The results of the older runs have no worker counts
+    return scenario["mode"], scenario["kind"], scenario["tracing"], scenario.get("workers", 1)
+
+
+def _fmt(value: Optional[float], digits: int = 1) -> str:
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+def _pct(stats: Optional[dict[str, float]], key: str) -> Optional[float]:
+    return None if stats is None else stats[key]
+
+
+def print_report(scenarios: list[dict[str, Any]], baseline: Optional[list[dict[str, Any]]] = None) -> None:
+    baseline_by_key = {scenario_key(s): s for s in baseline or []}
+    header = (
+        f"{'mode':<6} {'kind':<10} {'trace':<5} {'wrk':>3} {'req/s':>8} {'lat p50':>8} {'lat p99':>8} {'ttft p50':>9}"
+        f" {'ttft p99':>9} {'chunk p50':>10} {'chunk p99':>10} {'rss MB':>7} {'errors':>6}"
+    )
+    if baseline is not None:
+        header += f" {'Δ req/s':>9} {'Δ ttft p50':>11}"
+    print(header)
+    for scenario in scenarios:
+        line = (
+            f"{scenario['mode']:<6} {scenario['kind']:<10} {scenario['tracing']:<5} {scenario.get('workers', 1):>3}"
+            f" {scenario['requests_per_second']:>8.1f}"
+            f" {_fmt(_pct(scenario['latency_ms'], 'p50')):>8} {_fmt(_pct(scenario['latency_ms'], 'p99')):>8}"
+            f" {_fmt(_pct(scenario['ttft_ms'], 'p50')):>9} {_fmt(_pct(scenario['ttft_ms'], 'p99')):>9}"
+            f" {_fmt(_pct(scenario['chunk_overhead_ms'], 'p50'), 2):>10}"
+            f" {_fmt(_pct(scenario['chunk_overhead_ms'], 'p99'), 2):>10}"
+            f" {_fmt(scenario['memory']['rss_mb'], 0):>7} {scenario['errors']:>6}"
+        )
+        previous = baseline_by_key.get(scenario_key(scenario))
+        if previous is not None:
+            rps_delta = scenario["requests_per_second"] / previous["requests_per_second"] - 1
+            ttft, previous_ttft = _pct(scenario["ttft_ms"], "p50"), _pct(previous["ttft_ms"], "p50")
+            ttft_delta = None if ttft is None or previous_ttft is None else ttft - previous_ttft
+            line += f" {rps_delta:>+8.1%} {_fmt(ttft_delta):>9}ms"
+        print(line)
+
+
+def print_scaling(scenarios: list[dict[str, Any]]) -> None:
+    """
+    Throughput versus the number of workers of the proxy (relative to the
+    first worker count).
+    """
+    by_kind: dict[tuple[str, str], list[dict[str, Any]]] = {}
+    for scenario in scenarios:
+        if scenario["mode"] == "proxy":
+            by_kind.setdefault((scenario["kind"], scenario["tracing"]), []).append(scenario)
+    if not any(len(series) > 1 for series in by_kind.values()):
+        return
+
+    print(f"\n{'kind':<10} {'trace':<5} {'wrk':>3} {'req/s':>8} {'speedup':>8} {'per worker':>11}")
+    for (kind, tracing), series in by_kind.items():
+        base = series[0]
+        for scenario in series:
+            speedup = (
+                scenario["requests_per_second"] / base["requests_per_second"] if base["requests_per_second"] else 0
+            )
+            print(
+                f"{kind:<10} {tracing:<5} {scenario['workers']:>3} {scenario['requests_per_second']:>8.1f}"
+                f" {speedup:>7.2f}x {scenario['requests_per_second'] / scenario['workers']:>11.1f}"
+            )
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", default="proxy,async,sync", help="Comma-separated: proxy, async, sync")
+    parser.add_argument("--kinds", default="completion,streaming", help="Comma-separated: completion, streaming")
+    parser.add_argument("--tracing", default="off,on", help="Comma-separated: off, on")
+    parser.add_argument("--workers", default="1", help="Comma-separated worker counts of the proxy (`proxy` mode)")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="Unmeasured requests before every scenario")
+    parser.add_argument("--request-timeout", type=float, default=120.0)
+    parser.add_argument("--startup-timeout", type=float, default=120.0)
+    parser.add_argument("--config", type=Path, default=PROJECT_DIR / "config.yaml")
+    parser.add_argument("--proxy-port", type=int, default=4100)
+    parser.add_argument("--mock-port", type=int, default=18999)
+    parser.add_argument("--mock-ttft", default="fixed:50", help="See `benchmarks/mock_upstream.py`")
+    parser.add_argument("--mock-tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--mock-inter-token")
+    parser.add_argument("--mock-output-tokens", type=int, default=50)
+    parser.add_argument("--output", type=Path, help="Where to save the results (JSON)")
+    parser.add_argument("--compare", type=Path, help="Results of a previous run to compare with")
+    parser.add_argument("--worker", choices=("async", "sync"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.modes = [mode for mode in args.modes.split(",") if mode]
+    args.kinds = [kind for kind in args.kinds.split(",") if kind]
+    args.tracing = [tracing for tracing in args.tracing.split(",") if tracing]
+    args.workers = [int(workers) for workers in args.workers.split(",") if workers]
+    return args
+
+
+def run_scenarios(args: argparse.Namespace, mode: str, tracing: str, workers: int) -> list[dict[str, Any]]:
+    traces_dir = tempfile.mkdtemp(prefix="benchmark-traces-")
+    shared_state_dir = tempfile.mkdtemp(prefix="benchmark-shared-state-")
+    try:
+        env = scenario_env(args, tracing == "on", traces_dir)
+        # A fresh shared state for every run of the proxy
+        env["SHARED_STATE_PATH"] = str(Path(shared_state_dir) / "shared_state.sqlite3")
+        print(f"Running {mode} scenarios with tracing {tracing} ({workers} workers)...", flush=True)
+        if mode == "proxy":
+            results = run_proxy_scenarios(args, env, workers)
+        else:
+            results = run_worker_scenarios(args, mode, env)
+    finally:
+        shutil.rmtree(traces_dir, ignore_errors=True)
+        shutil.rmtree(shared_state_dir, ignore_errors=True)
+
+    return [
+        {
+            "mode": mode,
+            "kind": kind,
+            "tracing": tracing,
+            "workers": workers,
+            "concurrency": args.concurrency,
+            **summary,
+            "memory_before": results["memory_before"],
+        }
+        for kind, summary in results["kinds"].items()
+    ]
+
+
+def main() -> None:
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+        return
+
+    baseline = None
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8"))["scenarios"]
+
+    scenarios = []
+    mock = start_mock(args)
+    try:
+        for mode in args.modes:
+            for tracing in args.tracing:
+                # The in-process modes have no worker processes
+                for workers in args.workers if mode == "proxy" else [1]:
+                    scenarios.extend(run_scenarios(args, mode, tracing, workers))
+    finally:
+        stop_process(mock)
+
+    print()
+    print_report(scenarios, baseline)
+    print_scaling(scenarios)
+
+    output = args.output or RESULTS_DIR / f"e2e_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "environment": {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpu_count": os.cpu_count(),
+                },
+                "settings": {
+                    key: str(value) if isinstance(value, Path) else value
+                    for key, value in vars(args).items()
+                    if key not in ("worker", "output", "compare")
+                },
+                "scenarios": scenarios,
+            },
+            indent=2,
+        ),
+        encoding="utf-8",
+    )
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
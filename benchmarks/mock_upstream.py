@@ -0,0 +1,203 @@
+"""
+A local OpenAI-compatible upstream for the end-to-end benchmarks (see
+`benchmarks/e2e_benchmark.py`), with configurable latency:
+
+- `--ttft` - the time before the first token (or, for non-streaming
+  requests, before the generation starts)
+- `--tokens-per-second` / `--inter-token` - the time between tokens
+- `--output-tokens` - how many tokens every response has
+
+Latencies are distributions (in milliseconds):
+
+- `fixed:<ms>`
+- `uniform:<min_ms>:<max_ms>`
+- `normal:<mean_ms>:<stddev_ms>`
+- `lognormal:<median_ms>:<sigma>`
+- `exponential:<mean_ms>`
+
+With `--stamp-tokens`, every token carries the time it was sent
+(`[t=<unix time in ns>]`), so that a client on the same machine can measure
+how long every chunk spent in the proxy.
+
+Usage (from the root of the repository):
+
+```bash
+uv run python -m benchmarks.mock_upstream --port 18999 --ttft lognormal:300:0.5 --tokens-per-second 50
+OPENAI_BASE_URL=http://127.0.0.1:18999/v1 OPENAI_API_KEY=sk-mock ./uv-run.sh
+```
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Optional
+
+from aiohttp import web
+
+
+class LatencyDistribution:
+    def __init__(self, spec: str, rng: Optional[random.Random] = None) -> None:
+        kind, *params = spec.split(":")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(param) / 1000 for param in params]
+        if kind == "lognormal" and len(params) == 2:
+            # The sigma is not a time
+            self.params[1] = float(params[1])
+
+        expected_params = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2, "exponential": 1}
+        if kind not in expected_params:
+            raise ValueError(f"Unknown latency distribution: {spec!r}")
+        if len(self.params) != expected_params[kind]:
+            raise ValueError(f"{kind} takes {expected_params[kind]} parameter(s): {spec!r}")
+        self._rng = rng or random.Random()
+
+    def sample(self) -> float:
+        """
+        A latency in seconds (never negative).
+        """
+        if self.kind == "fixed":
+            value = self.params[0]
+        elif self.kind == "uniform":
+            value = self._rng.uniform(*self.params)
+        elif self.kind == "normal":
+            value = self._rng.gauss(*self.params)
+        elif self.kind == "lognormal":
+            median, sigma = self.params
+            value = median * self._rng.lognormvariate(0.0, sigma) if median > 0 else 0.0
+        else:
+            value = self._rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        return max(value, 0.0)
+
+
+class MockUpstream:
+    def __init__(
+        self,
+        *,
+        ttft: LatencyDistribution,
+        inter_token: LatencyDistribution,
+        output_tokens: int,
+        stamp_tokens: bool = False,
+    ) -> None:
+        self.ttft = ttft
+        self.inter_token = inter_token
+        self.output_tokens = output_tokens
+        self.stamp_tokens = stamp_tokens
+        self.requests = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/chat/completions", self.chat_completions)
+        # Used by the connection warm-up of the upstream client pool
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_get("/health", self.health)
+        return app
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        model = body.get("model") or "mock"
+        usage = {
+            "prompt_tokens": sum(len(str(m.get("content") or "").split()) for m in body.get("messages") or []),
+            "completion_tokens": self.output_tokens,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+
+        await asyncio.sleep(self.ttft.sample())
+
+        if not body.get("stream"):
+            tokens = []
+            for idx in range(self.output_tokens):
+                if idx:
+                    await asyncio.sleep(self.inter_token.sample())
+                tokens.append(self._token(idx))
+            return web.json_response(
+                {
+                    **_response_envelope(model, "chat.completion"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": "".join(tokens)},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        envelope = _response_envelope(model, "chat.completion.chunk")
+        try:
+            for idx in range(self.output_tokens):
+                if idx:
+                    await asyncio.sleep(self.inter_token.sample())
+                delta = {"content": self._token(idx)}
+                if idx == 0:
+                    delta["role"] = "assistant"
+                await _write_event(
+                    response, {**envelope, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                )
+
+            await _write_event(response, {**envelope, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            if (body.get("stream_options") or {}).get("include_usage"):
+                await _write_event(response, {**envelope, "choices": [], "usage": usage})
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client stopped reading (e.g. a cancelled request)
+            pass
+        return response
+
+    async def models(self, request: web.Request) -> web.Response:
+        # pylint: disable=unused-argument
+        return web.json_response({"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+
+    async def health(self, request: web.Request) -> web.Response:
+        # pylint: disable=unused-argument
+        return web.json_response({"status": "ok", "requests": self.requests})
+
+    def _token(self, idx: int) -> str:
+        if self.stamp_tokens:
+            return f" tok{idx}[t={time.time_ns()}]"
+        return f" tok{idx}"
+
+
+def _response_envelope(model: str, obj: str) -> dict[str, Any]:
+    return {"id": f"chatcmpl-mock-{time.time_ns()}", "object": obj, "created": int(time.time()), "model": model}
+
+
+async def _write_event(response: web.StreamResponse, data: dict[str, Any]) -> None:
+    await response.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18999)
+    parser.add_argument("--ttft", default="fixed:50", help="Distribution of the time to first token (ms)")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument(
+        "--inter-token", help="Distribution of the time between tokens (ms) - overrides --tokens-per-second"
+    )
+    parser.add_argument("--output-tokens", type=int, default=50)
+    parser.add_argument("--stamp-tokens", action="store_true", help="Embed the send time into every token")
+    parser.add_argument("--seed", type=int, help="Seed of the latency distributions")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    mock = MockUpstream(
+        ttft=LatencyDistribution(args.ttft, rng),
+        inter_token=LatencyDistribution(args.inter_token or f"fixed:{1000 / args.tokens_per_second}", rng),
+        output_tokens=args.output_tokens,
+        stamp_tokens=args.stamp_tokens,
+    )
+    print(f"Mock upstream listening on http://{args.host}:{args.port}/v1", flush=True)
+    web.run_app(mock.app(), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import time
+
+# When the first module of the package started to be imported (the handler
+# imports of the cold-start profile, see `common/startup.py`)
+IMPORTS_STARTED_AT = time.perf_counter()
@@ -0,0 +1,370 @@
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+from typing import Any, Callable, Optional, Sequence
+
+import httpx
+import litellm
+
+from common.config import settings_section
+
+
+_WAITING = "waiting"
+_GRANTED = "granted"
+# Pushed out of a full queue by a request of a higher priority
+_EVICTED = "evicted"
+# Gave up waiting (the deadline passed or the request was cancelled)
+_ABANDONED = "abandoned"
+
+
+class AdmissionRejectedError(litellm.RateLimitError):
+    """
+    A request that was not admitted to its upstream target (the wait queue
+    was full, the queue deadline passed or, see `common/rate_limits.py`, the
+    rate limits of the target would hold it for too long). LiteLLM Server
+    turns it into a 429 response with a `Retry-After` header.
+    """
+
+    def __init__(self, message: str, *, model: str, retry_after: float, reason: str) -> None:
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+        headers = {"retry-after": str(self.retry_after)}
+        super().__init__(
+            message=message,
+            llm_provider="proxy",
+            model=model,
+            response=httpx.Response(429, headers=headers, request=httpx.Request("POST", "http://proxy/admission")),
+        )
+        # The headers LiteLLM Server adds to the error response
+        self.headers = headers
+
+
+class _Waiter:
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ("rank", "wake", "state")
+
+    def __init__(self, rank: int, wake: Callable[[], None]) -> None:
+        self.rank = rank
+        self.wake = wake
+        self.state = _WAITING
+
+
+class _TargetQueue:
+    # pylint: disable=too-few-public-methods,too-many-instance-attributes
+
+    def __init__(self, *, max_concurrency: int, max_queue: int, queue_timeout: float) -> None:
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+
+        self.in_flight = 0
+        self.queued = 0
+        # (priority rank, arrival order, waiter) - abandoned and evicted
+        # waiters stay in the heap until they are popped
+        self.heap: list[tuple[int, int, _Waiter]] = []
+        # How long requests hold their slots (None until the first release)
+        self.hold_time_ewma: Optional[float] = None
+
+        self.admitted = 0
+        self.queued_total = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        # reason ("queue_full", "queue_timeout") -> count
+        self.rejected: dict[str, int] = {}
+
+
+class AdmissionTicket:
+    """
+    A slot of an upstream target, held from admission until `release()`.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ("target", "priority", "wait_time", "_controller", "_queue", "_admitted_at", "_released")
+
+    def __init__(
+        self, controller: "AdmissionController", queue: _TargetQueue, target: str, priority: str, wait_time: float
+    ) -> None:
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self.target = target
+        self.priority = priority
+        self.wait_time = wait_time
+        self._controller = controller
+        self._queue = queue
+        self._admitted_at = time.perf_counter()
+        self._released = False
+
+    def release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._controller._release(  # pylint: disable=protected-access
+            self._queue, time.perf_counter() - self._admitted_at
+        )
+
+
+class AdmissionController:
+    """
+    Per-target admission control: at most `max_concurrency` requests are in
+    flight to every upstream target, the rest wait in a queue of at most
+    `max_queue` requests, ordered by priority class (and by arrival within a
+    class). A request is rejected with `AdmissionRejectedError` (a 429 with
+    `Retry-After`) right away if the queue is full of requests of the same
+    or a higher priority, and once it has waited `queue_timeout` seconds. A
+    request of a higher priority pushes the most recent request of the
+    lowest priority out of a full queue.
+
+    The priority class of a request is taken from its metadata
+    (`"metadata": {"priority": "batch"}` in the request body of the LiteLLM
+    Server); requests without one (or with an unknown one) get
+    `default_priority`. `priorities` go from the highest to the lowest.
+
+    Configured in the `admission` section of the handler settings in
+    `config.yaml` (`targets` overrides the limits of individual targets):
+
+    ```yaml
+    admission:
+      max_concurrency: 64
+      max_queue: 256
+      queue_timeout: 10
+      priorities: [interactive, default, batch]
+      default_priority: default
+      targets:
+        openai/gpt-4o:
+          max_concurrency: 32
+    ```
+
+    Serves both sync and async callers (the slots are shared).
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        *,
+        max_concurrency: int = 64,
+        max_queue: int = 256,
+        queue_timeout: float = 10.0,
+        priorities: Sequence[str] = ("interactive", "default", "batch"),
+        default_priority: str = "default",
+        priority_metadata_key: str = "priority",
+        targets: Optional[dict[str, dict[str, Any]]] = None,
+    ) -> None:
+        # pylint: disable=too-many-arguments
+        if not priorities:
+            raise ValueError("AdmissionController needs at least one priority class")
+        if default_priority not in priorities:
+            raise ValueError(f"The default priority {default_priority!r} is not one of {list(priorities)}")
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.priorities = tuple(priorities)
+        self.default_priority = default_priority
+        self.priority_metadata_key = priority_metadata_key
+        self.target_settings = dict(targets or {})
+
+        self._ranks = {priority: rank for rank, priority in enumerate(self.priorities)}
+        self._queues: dict[str, _TargetQueue] = {}
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: Optional[dict[str, Any]]) -> Optional["AdmissionController"]:
+        """
+        None (no admission control) if the `admission` section is missing or
+        has `enabled: false`.
+        """
+        settings = settings_section(settings)
+        if settings is None:
+            return None
+        return cls(**settings)
+
+    def priority_of(self, litellm_params: Optional[dict]) -> str:
+        metadata = (litellm_params or {}).get("metadata") or {}
+        priority = metadata.get(self.priority_metadata_key)
+        return priority if priority in self._ranks else self.default_priority
+
+    def acquire(self, target: str, priority: str) -> AdmissionTicket:
+        """
+        Wait (blocking the thread) for a slot of `target`.
+        """
+        started_at = time.perf_counter()
+        woken = threading.Event()
+        queue, waiter = self._enqueue(target, priority, woken.set)
+        if waiter is not None:
+            if not woken.wait(queue.queue_timeout) and not self._abandon(queue, waiter):
+                raise self._rejection(queue, target, priority, "queue_timeout")
+            if waiter.state == _EVICTED:
+                raise self._rejection(queue, target, priority, "queue_full")
+        return self._admitted(queue, target, priority, started_at)
+
+    async def aacquire(self, target: str, priority: str) -> AdmissionTicket:
+        """
+        Wait for a slot of `target`.
+        """
+        started_at = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+        # Released slots may be handed over from other threads
+        queue, waiter = self._enqueue(target, priority, lambda: loop.call_soon_threadsafe(_resolve, woken))
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(woken, timeout=queue.queue_timeout)
+            except asyncio.TimeoutError as e:
+                if not self._abandon(queue, waiter):
+                    raise self._rejection(queue, target, priority, "queue_timeout") from e
+            except asyncio.CancelledError:
+                if self._abandon(queue, waiter):
+                    # The slot was handed over just as the request got cancelled
+                    self._release(queue, None)
+                raise
+            if waiter.state == _EVICTED:
+                raise self._rejection(queue, target, priority, "queue_full")
+        return self._admitted(queue, target, priority, started_at)
+
+    def queue_depths(self) -> dict[str, int]:
+        with self._lock:
+            return {target: queue.queued for target, queue in self._queues.items()}
+
+    def in_flight(self) -> dict[str, int]:
+        with self._lock:
+            return {target: queue.in_flight for target, queue in self._queues.items()}
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        with self._lock:
+            return {
+                target: {
+                    "max_concurrency": queue.max_concurrency,
+                    "in_flight": queue.in_flight,
+                    "queued": queue.queued,
+                    "admitted": queue.admitted,
+                    "rejected": dict(queue.rejected),
+                    "queued_total": queue.queued_total,
+                    "avg_wait_time": queue.wait_time_total / queue.admitted if queue.admitted else 0.0,
+                    "max_wait_time": queue.wait_time_max,
+                }
+                for target, queue in self._queues.items()
+            }
+
+    def _queue(self, target: str) -> _TargetQueue:
+        queue = self._queues.get(target)
+        if queue is None:
+            settings = self.target_settings.get(target) or {}
+            queue = self._queues[target] = _TargetQueue(
+                max_concurrency=settings.get("max_concurrency", self.max_concurrency),
+                max_queue=settings.get("max_queue", self.max_queue),
+                queue_timeout=settings.get("queue_timeout", self.queue_timeout),
+            )
+        return queue
+
+    def _enqueue(self, target: str, priority: str, wake: Callable[[], None]) -> tuple[_TargetQueue, Optional[_Waiter]]:
+        """
+        Take a free slot (no waiter is returned) or join the queue.
+        """
+        rank = self._ranks[priority]
+        with self._lock:
+            queue = self._queue(target)
+            if queue.in_flight < queue.max_concurrency and not queue.queued:
+                queue.in_flight += 1
+                return queue, None
+
+            if queue.queued >= queue.max_queue and not self._evict_lower(queue, rank):
+                raise self._rejection(queue, target, priority, "queue_full", locked=True)
+
+            waiter = _Waiter(rank, wake)
+            heapq.heappush(queue.heap, (rank, next(self._arrivals), waiter))
+            queue.queued += 1
+            queue.queued_total += 1
+            return queue, waiter
+
+    @staticmethod
+    def _evict_lower(queue: _TargetQueue, rank: int) -> bool:
+        """
+        Push the most recent of the lowest priority waiters (if their priority
+        is lower than `rank`) out of the queue. Has to be called under the lock.
+        """
+        candidates = [entry for entry in queue.heap if entry[2].state == _WAITING and entry[0] > rank]
+        if not candidates:
+            return False
+        _, _, victim = max(candidates, key=lambda entry: entry[:2])
+        victim.state = _EVICTED
+        queue.queued -= 1
+        victim.wake()
+        return True
+
+    def _abandon(self, queue: _TargetQueue, waiter: _Waiter) -> bool:
+        """
+        Leave the queue. True if the waiter got a slot in the meantime (which
+        it now holds).
+        """
+        with self._lock:
+            if waiter.state == _GRANTED:
+                return True
+            if waiter.state == _WAITING:
+                waiter.state = _ABANDONED
+                queue.queued -= 1
+            return False
+
+    def _admitted(self, queue: _TargetQueue, target: str, priority: str, started_at: float) -> AdmissionTicket:
+        wait_time = time.perf_counter() - started_at
+        with self._lock:
+            queue.admitted += 1
+            queue.wait_time_total += wait_time
+            queue.wait_time_max = max(queue.wait_time_max, wait_time)
+        return AdmissionTicket(self, queue, target, priority, wait_time)
+
+    def _release(self, queue: _TargetQueue, hold_time: Optional[float]) -> None:
+        with self._lock:
+            if hold_time is None:
+                pass
+            elif queue.hold_time_ewma is None:
+                queue.hold_time_ewma = hold_time
+            else:
+                queue.hold_time_ewma += 0.2 * (hold_time - queue.hold_time_ewma)
+
+            # Hand the slot over to the first waiter in line
+            while queue.heap:
+                _, _, waiter = heapq.heappop(queue.heap)
+                if waiter.state != _WAITING:
+                    continue
+                waiter.state = _GRANTED
+                queue.queued -= 1
+                waiter.wake()
+                return
+            queue.in_flight -= 1
+
+    def _rejection(
+        self, queue: _TargetQueue, target: str, priority: str, reason: str, *, locked: bool = False
+    ) -> AdmissionRejectedError:
+        # pylint: disable=too-many-arguments,too-many-positional-arguments
+        if locked:
+            retry_after = self._retry_after(queue)
+            queue.rejected[reason] = queue.rejected.get(reason, 0) + 1
+        else:
+            with self._lock:
+                retry_after = self._retry_after(queue)
+                queue.rejected[reason] = queue.rejected.get(reason, 0) + 1
+
+        if reason == "queue_full":
+            message = f"The admission queue of {target} is full (no room for a {priority} request)"
+        else:
+            message = f"Waited for {queue.queue_timeout} seconds to be admitted to {target}"
+        return AdmissionRejectedError(message, model=target, retry_after=retry_after, reason=reason)
+
+    @staticmethod
+    def _retry_after(queue: _TargetQueue) -> float:
+        """
+        The expected time until the queue is drained.
+        """
+        if queue.hold_time_ewma is None:
+            return queue.queue_timeout
+        return queue.hold_time_ewma * (queue.queued + 1) / queue.max_concurrency
+
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,232 @@
+import asyncio
+import threading
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, Generator, Iterable, Optional
+
+from litellm import ModelResponseStream
+
+from common.config import STREAM_COALESCE_MAX_CHARS, STREAM_COALESCE_MAX_DELAY_MS
+
+
+class ChunkCoalescer:
+    """
+    Merges consecutive text deltas of an upstream stream into fewer, bigger
+    chunks, so that chunk conversion, the per-chunk hooks, LiteLLM's stream
+    wrapper and the SSE framing run once per merged chunk rather than once
+    per token.
+
+    A merged chunk is released once it holds `max_chars` characters or once
+    its first delta has been held for `max_delay` seconds. Only plain text
+    deltas of the same choice are merged (the deltas of the choices of an
+    `n > 1` request are interleaved) - tool calls, reasoning, finish reasons
+    and usage are never merged into (or across), they release the held text
+    first and go through as they are. The first text delta of a stream is
+    not held at all, so the time to first token doesn't change.
+
+    The async streams are released on time even when the upstream stalls.
+    The sync ones can only be released when the next chunk arrives (or the
+    stream ends).
+    """
+
+    def __init__(
+        self,
+        *,
+        max_delay: float = STREAM_COALESCE_MAX_DELAY_MS / 1000,
+        max_chars: int = STREAM_COALESCE_MAX_CHARS,
+    ) -> None:
+        self.max_delay = max_delay
+        self.max_chars = max_chars
+
+        self._lock = threading.Lock()
+        self.chunks_in = 0
+        self.chunks_out = 0
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "chunks_in": self.chunks_in,
+                "chunks_out": self.chunks_out,
+                "ratio": self.chunks_in / self.chunks_out if self.chunks_out else 0.0,
+            }
+
+    def coalesce(self, stream: Iterable[Any]) -> Generator[Any, None, None]:
+        chunks_in = chunks_out = 0
+        held = None
+        held_since = 0.0
+        held_chars = 0
+        first_text_sent = False
+        try:
+            for chunk in stream:
+                chunks_in += 1
+                text = _text_delta(chunk)
+                if text is None:
+                    if held is not None:
+                        chunks_out += 1
+                        yield held
+                        held = None
+                    chunks_out += 1
+                    yield chunk
+                    continue
+
+                if not first_text_sent:
+                    first_text_sent = True
+                    chunks_out += 1
+                    yield chunk
+                    continue
+
+                if held is not None and _choice_index(chunk) != _choice_index(held):
+                    # A delta of another choice (n > 1) - never merged into this one
+                    chunks_out += 1
+                    yield held
+                    held = None
+
+                if held is None:
+                    held, held_since, held_chars = chunk, time.perf_counter(), len(text)
+                else:
+                    _append_text(held, text)
+                    held_chars += len(text)
+                if held_chars >= self.max_chars or time.perf_counter() - held_since >= self.max_delay:
+                    chunks_out += 1
+                    yield held
+                    held = None
+
+            if held is not None:
+                chunks_out += 1
+                yield held
+        finally:
+            self._record(chunks_in, chunks_out)
+
+    async def acoalesce(self, stream: AsyncIterator[Any]) -> AsyncGenerator[Any, None]:
+        # pylint: disable=too-many-branches,too-many-statements
+        chunks_in = chunks_out = 0
+        held = None
+        held_since = 0.0
+        held_chars = 0
+        first_text_sent = False
+        iterator = aiter(stream)
+        # The read of the next chunk that outlived the deadline of the held
+        # text (it is awaited again, never restarted)
+        pending: Optional[asyncio.Future] = None
+        try:
+            while True:
+                if held is None:
+                    # Nothing is held - no deadline to watch
+                    try:
+                        if pending is None:
+                            chunk = await anext(iterator)
+                        else:
+                            chunk = await pending
+                            pending = None
+                    except StopAsyncIteration:
+                        break
+                else:
+                    if pending is None:
+                        pending = asyncio.ensure_future(anext(iterator))
+                    timeout = held_since + self.max_delay - time.perf_counter()
+                    if timeout > 0:
+                        await asyncio.wait((pending,), timeout=timeout)
+                    if not pending.done():
+                        chunks_out += 1
+                        yield held
+                        held = None
+                        continue
+                    read, pending = pending, None
+                    try:
+                        chunk = read.result()
+                    except StopAsyncIteration:
+                        break
+
+                chunks_in += 1
+                text = _text_delta(chunk)
+                if text is None:
+                    if held is not None:
+                        chunks_out += 1
+                        yield held
+                        held = None
+                    chunks_out += 1
+                    yield chunk
+                    continue
+
+                if not first_text_sent:
+                    first_text_sent = True
+                    chunks_out += 1
+                    yield chunk
+                    continue
+
+                if held is not None and _choice_index(chunk) != _choice_index(held):
+                    chunks_out += 1
+                    yield held
+                    held = None
+
+                if held is None:
+                    held, held_since, held_chars = chunk, time.perf_counter(), len(text)
+                else:
+                    _append_text(held, text)
+                    held_chars += len(text)
+                if held_chars >= self.max_chars:
+                    chunks_out += 1
+                    yield held
+                    held = None
+
+            if held is not None:
+                chunks_out += 1
+                yield held
+        finally:
+            if pending is not None:
+                pending.cancel()
+                await asyncio.wait((pending,))
+                if not pending.cancelled():
+                    pending.exception()
+            self._record(chunks_in, chunks_out)
+
+    def _record(self, chunks_in: int, chunks_out: int) -> None:
+        with self._lock:
+            self.chunks_in += chunks_in
+            self.chunks_out += chunks_out
+
+
+def create_chunk_coalescer(
+    max_delay_ms: float = STREAM_COALESCE_MAX_DELAY_MS, max_chars: int = STREAM_COALESCE_MAX_CHARS
+) -> Optional[ChunkCoalescer]:
+    """
+    None (no coalescing) unless `STREAM_COALESCE_MAX_DELAY_MS` is set.
+    """
+    if max_delay_ms <= 0:
+        return None
+    return ChunkCoalescer(max_delay=max_delay_ms / 1000, max_chars=max_chars)
+
+
+def _text_delta(chunk: Any) -> Optional[str]:
+    """
+    The text of a chunk that is nothing but a text delta of a single choice
+    (None for any other chunk).
+    """
+    if type(chunk) is not ModelResponseStream:  # pylint: disable=unidiomatic-typecheck
+        return None
+    choices = chunk.choices
+    if len(choices) != 1 or getattr(chunk, "usage", None) is not None:
+        return None
+    choice = choices[0]
+    if choice.finish_reason:
+        return None
+    delta = choice.delta
+    content = delta.content
+    if not isinstance(content, str) or not content:
+        return None
+    if (
+        getattr(delta, "tool_calls", None)
+        or getattr(delta, "function_call", None) is not None
+        or getattr(delta, "reasoning_content", None)
+        or getattr(delta, "thinking_blocks", None)
+    ):
+        return None
+    return content
+
+
+def _choice_index(chunk: ModelResponseStream) -> int:
+    return chunk.choices[0].index
+
+
+def _append_text(chunk: ModelResponseStream, text: str) -> None:
+    delta = chunk.choices[0].delta
+    delta.content = delta.content + text
@@ -0,0 +1,196 @@
+# pylint: disable=unidiomatic-typecheck
+# Exact class checks are intentional in this module: a specialized converter is
+# only valid for the exact classes it was built for.
+from typing import Any, Callable, Optional
+
+from litellm import GenericStreamingChunk
+from pydantic import BaseModel
+
+from common.utils import ProxyError, generic_streaming_chunk, to_generic_streaming_chunk, tool_call_chunk, usage_block
+
+
+_ChunkConverterFn = Callable[[Any], GenericStreamingChunk]
+
+
+class StreamingChunkConverter:
+    """
+    Per-stream replacement for `common.utils.to_generic_streaming_chunk`.
+
+    `to_generic_streaming_chunk` probes every chunk for every shape it knows
+    about (OpenAI tool_calls, Anthropic tool_use, legacy function_call,
+    `text`). Within a single stream all the chunks come from the same
+    provider, though, so this converter detects the shape of the first chunk
+    and keeps using a converter specialized for that shape for the rest of the
+    stream. The shape is re-detected only if the class of the chunk changes.
+
+    Specialized converters are keyed by the classes of the chunk, its first
+    choice and the choice's delta, and are built once per process. Chunks that
+    don't fit the detected layout (e.g. dict-based deltas) fall back to
+    `to_generic_streaming_chunk`, so the output is always the same as the one
+    of `to_generic_streaming_chunk`.
+
+    Create one instance per stream:
+
+    ```python
+    convert_chunk = StreamingChunkConverter()
+    async for chunk in resp_stream:
+        generic_chunk = convert_chunk(chunk)
+    ```
+    """
+
+    def __init__(self) -> None:
+        self._chunk_class: Optional[type] = None
+        self._convert: _ChunkConverterFn = to_generic_streaming_chunk
+
+    def __call__(self, chunk: Any) -> GenericStreamingChunk:
+        if type(chunk) is not self._chunk_class:
+            convert = _detect_converter(chunk)
+            if convert is None:
+                # Nothing to learn the layout from (e.g. a usage-only chunk
+                # without choices) - detect again on the next chunk
+                return to_generic_streaming_chunk(chunk)
+            self._chunk_class = type(chunk)
+            self._convert = convert
+        return self._convert(chunk)
+
+
+_SPECIALIZED_CONVERTERS: dict[tuple[type, type, type], _ChunkConverterFn] = {}
+
+
+def _detect_converter(chunk: Any) -> Optional[_ChunkConverterFn]:
+    if not isinstance(chunk, BaseModel):
+        return to_generic_streaming_chunk
+
+    choices = getattr(chunk, "choices", None)
+    if not isinstance(choices, list) or not choices:
+        return None
+
+    choice = choices[0]
+    delta = getattr(choice, "delta", None)
+    if not isinstance(choice, BaseModel) or not isinstance(delta, BaseModel):
+        return to_generic_streaming_chunk
+
+    key = (type(chunk), type(choice), type(delta))
+    converter = _SPECIALIZED_CONVERTERS.get(key)
+    if converter is None:
+        converter = _build_pydantic_chunk_converter(*key)
+        _SPECIALIZED_CONVERTERS[key] = converter
+    return converter
+
+
+def _field_reader(model_class: type, name: str) -> Callable[[Any], Any]:
+    """
+    Build the cheapest reader of an optional attribute of a pydantic model that
+    is equivalent to `getattr(obj, name, None)`.
+    """
+    if name in model_class.model_fields or hasattr(model_class, name):
+        # Declared field (or a class-level attribute/property)
+        return lambda obj: getattr(obj, name, None)
+
+    if model_class.model_config.get("extra") == "allow":
+        # LiteLLM's stream types keep most of their attributes in
+        # `__pydantic_extra__`. Reading that dict directly avoids pydantic's
+        # `__getattr__` and, for absent attributes, an AttributeError.
+        def _read_extra(obj: Any) -> Any:
+            extra = obj.__pydantic_extra__
+            return extra.get(name) if extra else None
+
+        return _read_extra
+
+    return lambda obj: None
+
+
+def _build_pydantic_chunk_converter(chunk_class: type, choice_class: type, delta_class: type) -> _ChunkConverterFn:
+    # pylint: disable=too-many-locals,too-many-statements,too-many-branches
+    get_choices = _field_reader(chunk_class, "choices")
+    get_provider_specific_fields = _field_reader(chunk_class, "provider_specific_fields")
+    get_usage = _field_reader(chunk_class, "usage")
+    get_delta = _field_reader(choice_class, "delta")
+    get_choice_text = _field_reader(choice_class, "text")
+    get_finish_reason = _field_reader(choice_class, "finish_reason")
+    get_choice_index = _field_reader(choice_class, "index")
+    get_content = _field_reader(delta_class, "content")
+    get_tool_calls = _field_reader(delta_class, "tool_calls")
+    get_tool_use = _field_reader(delta_class, "tool_use")
+    get_function_call = _field_reader(delta_class, "function_call")
+
+    def _convert(chunk: Any) -> GenericStreamingChunk:
+        try:
+            choices = get_choices(chunk)
+            provider_specific_fields = get_provider_specific_fields(chunk)
+
+            text = ""
+            finish_reason = ""
+            is_finished = False
+            index = 0
+            tool_use = None
+
+            if isinstance(choices, list) and choices:
+                choice = choices[0]
+                if type(choice) is not choice_class:
+                    return to_generic_streaming_chunk(chunk)
+
+                delta = get_delta(choice)
+                if delta is not None:
+                    if type(delta) is not delta_class:
+                        return to_generic_streaming_chunk(chunk)
+
+                    content = get_content(delta)
+                    if isinstance(content, str):
+                        text = content
+
+                    tool_calls = get_tool_calls(delta)
+                    if isinstance(tool_calls, list) and tool_calls:
+                        tool_use = _convert_tool_call(tool_calls[0])
+                        if tool_use is None:
+                            # Not an object shape we know - let the generic
+                            # converter deal with it
+                            return to_generic_streaming_chunk(chunk)
+
+                    elif get_tool_use(delta) is not None or get_function_call(delta) is not None:
+                        # Anthropic-style tool_use and legacy function_call are
+                        # rare enough to not deserve a fast path
+                        return to_generic_streaming_chunk(chunk)
+
+                if not text:
+                    content_text = get_choice_text(choice)
+                    if isinstance(content_text, str):
+                        text = content_text
+
+                fr = get_finish_reason(choice)
+                if isinstance(fr, str):
+                    finish_reason = fr
+                    is_finished = bool(fr)
+
+                idx = get_choice_index(choice)
+                if isinstance(idx, int):
+                    index = idx
+
+        except Exception as e:
+            raise ProxyError(f"Failed to convert to GenericStreamingChunk: {e}") from e
+
+        return generic_streaming_chunk(
+            text, is_finished, finish_reason, usage_block(get_usage(chunk)), index, tool_use, provider_specific_fields
+        )
+
+    return _convert
+
+
+def _convert_tool_call(tc: Any) -> Optional[dict[str, Any]]:
+    if not isinstance(tc, BaseModel):
+        return None
+
+    fn = getattr(tc, "function", None)
+    if fn is not None and not isinstance(fn, BaseModel):
+        return None
+
+    tc_index = getattr(tc, "index", 0)
+    tc_id = getattr(tc, "id", None)
+    tc_type = getattr(tc, "type", "function")
+    fn_name = getattr(fn, "name", None)
+    fn_args = getattr(fn, "arguments", None)
+    if fn_args is not None and not isinstance(fn_args, str):
+        # Last resort stringification for partial structured args
+        fn_args = str(fn_args)
+
+    return tool_call_chunk(tc_index, tc_id, tc_type, fn_name, fn_args)
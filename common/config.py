@@ -1,7 +1,9 @@
 import os
 from pathlib import Path
+from typing import Any, Optional
 
 import litellm
+import yaml
 
 # We don't need to do `dotenv.load_dotenv()` - litellm does this for us upon
 # import.
@@ -9,11 +11,144 @@ import litellm
 #  DEV (although, when it is not set, it is DEV by default). What would be the
 #  best way to adapt to the approach taken by litellm ?
 
-from common.utils import env_var_to_bool
+from common.utils import env_var_to_bool, env_var_to_float, env_var_to_int
 
+PROJECT_DIR = Path(__file__).parent.parent
+# The same config file that is passed to `litellm --config` (see `uv-run.sh`)
+LITELLM_CONFIG_PATH = Path(os.getenv("LITELLM_CONFIG") or PROJECT_DIR / "config.yaml")
 
 WRITE_TRACES_TO_FILES = env_var_to_bool(os.getenv("WRITE_TRACES_TO_FILES"), "false")
-TRACES_DIR = Path(__file__).parent.parent / ".traces"
+TRACES_DIR = Path(os.getenv("TRACES_DIR") or PROJECT_DIR / ".traces")
+# Write every complete upstream exchange to `TRACES_DIR` in a format that the
+# replay provider (see `common/replay.py`) can serve
+WRITE_RECORDINGS = env_var_to_bool(os.getenv("WRITE_RECORDINGS"), "false")
+
+# Traces are written by a background thread (see `common/trace_writer.py`), so
+# the request path only pays for an enqueue
+TRACE_QUEUE_MAX_SIZE = env_var_to_int(os.getenv("TRACE_QUEUE_MAX_SIZE"), 10000)
+# What to do when the trace queue is full: "drop" (the trace is lost, the
+# request is not slowed down) or "block" (the request waits for the writer)
+TRACE_QUEUE_OVERFLOW_POLICY = (os.getenv("TRACE_QUEUE_OVERFLOW_POLICY") or "drop").lower()
+TRACE_WRITE_BATCH_SIZE = env_var_to_int(os.getenv("TRACE_WRITE_BATCH_SIZE"), 256)
+# Format of the streamed response traces: "markdown" (human-readable) or
+# "jsonl" (compact, one chunk per line)
+TRACE_FORMAT = (os.getenv("TRACE_FORMAT") or "markdown").lower()
+# How many chunks a stream trace session keeps in memory before handing them
+# over to the trace writer
+TRACE_STREAM_BUFFER_SIZE = env_var_to_int(os.getenv("TRACE_STREAM_BUFFER_SIZE"), 64)
+# The share of the requests that are traced (1.0 - all of them), overridden
+# for the target models that match TRACE_SAMPLE_RULES
+# (`<model pattern>=<rate>,...`, e.g. `openai/gpt-4o-mini=0.01,anthropic/*=0.5`).
+# Failed requests are traced regardless, if TRACE_ALWAYS_ON_ERROR is on.
+TRACE_SAMPLE_RATE = env_var_to_float(os.getenv("TRACE_SAMPLE_RATE"), 1.0)
+TRACE_SAMPLE_RULES = os.getenv("TRACE_SAMPLE_RULES") or ""
+TRACE_ALWAYS_ON_ERROR = env_var_to_bool(os.getenv("TRACE_ALWAYS_ON_ERROR"), "true")
+# Every trace file is cut off after this many (uncompressed) bytes (0 - no cap)
+TRACE_MAX_BYTES = env_var_to_int(os.getenv("TRACE_MAX_BYTES"), 0)
+# Compression of the trace files: "none", "gzip" or "zstd" (requires the
+# `zstandard` package)
+TRACE_COMPRESSION = (os.getenv("TRACE_COMPRESSION") or "none").lower()
+# Trace files older than TRACE_RETENTION_MAX_AGE_HOURS are deleted, and so are
+# the oldest ones while TRACES_DIR is bigger than TRACE_RETENTION_MAX_SIZE_MB
+# (0 - no limit), every TRACE_RETENTION_INTERVAL_SECONDS
+TRACE_RETENTION_MAX_AGE_HOURS = env_var_to_float(os.getenv("TRACE_RETENTION_MAX_AGE_HOURS"), 0.0)
+TRACE_RETENTION_MAX_SIZE_MB = env_var_to_float(os.getenv("TRACE_RETENTION_MAX_SIZE_MB"), 0.0)
+TRACE_RETENTION_INTERVAL_SECONDS = env_var_to_float(os.getenv("TRACE_RETENTION_INTERVAL_SECONDS"), 60.0)
+
+# Yield upstream `ModelResponseStream` chunks to LiteLLM as they are, instead of
+# converting them to `GenericStreamingChunk` dicts (which LiteLLM then converts
+# back). Only meant for handlers that don't modify the response.
+STREAM_PASSTHROUGH = env_var_to_bool(os.getenv("STREAM_PASSTHROUGH"), "false")
+# Merge consecutive text deltas of upstream streams into one chunk until it
+# holds STREAM_COALESCE_MAX_CHARS characters or its first delta has been held
+# for STREAM_COALESCE_MAX_DELAY_MS milliseconds (0 - no coalescing)
+STREAM_COALESCE_MAX_DELAY_MS = env_var_to_float(os.getenv("STREAM_COALESCE_MAX_DELAY_MS"), 0.0)
+STREAM_COALESCE_MAX_CHARS = env_var_to_int(os.getenv("STREAM_COALESCE_MAX_CHARS"), 64)
+# Ask the upstream to report the usage of streamed responses
+# (`stream_options.include_usage`) and pass it on to LiteLLM, which otherwise
+# counts the tokens of every streamed response locally
+STREAM_INCLUDE_USAGE = env_var_to_bool(os.getenv("STREAM_INCLUDE_USAGE"), "true")
+# Accumulate the prompt tokens the upstream providers served from their prompt
+# caches (see `PromptCacheStats` in `common/prompt_transforms.py`)
+PROMPT_CACHE_STATS = env_var_to_bool(os.getenv("PROMPT_CACHE_STATS"), "false")
+
+# Exact-match response cache: "memory" (LRU + TTL, per process), "sqlite"
+# (persisted in RESPONSE_CACHE_PATH) or empty (no caching)
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE") or ""
+RESPONSE_CACHE_MAX_ENTRIES = env_var_to_int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES"), 1000)
+RESPONSE_CACHE_TTL_SECONDS = env_var_to_float(os.getenv("RESPONSE_CACHE_TTL_SECONDS"), 3600.0)
+RESPONSE_CACHE_PATH = Path(os.getenv("RESPONSE_CACHE_PATH") or PROJECT_DIR / ".cache" / "response_cache.sqlite3")
+# How cached streams are replayed: 0 - as fast as the client consumes them,
+# 1.0 - with the original timing between chunks (0.5 - twice as fast, etc.)
+RESPONSE_CACHE_REPLAY_PACING = env_var_to_float(os.getenv("RESPONSE_CACHE_REPLAY_PACING"), 0.0)
+
+# Server-side conversation state (`previous_response_id`): "memory" (LRU + TTL,
+# per process), "sqlite" (persisted in CONVERSATION_STORE_PATH) or empty (the
+# clients send the whole conversation every time)
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE") or ""
+CONVERSATION_STORE_MAX_ENTRIES = env_var_to_int(os.getenv("CONVERSATION_STORE_MAX_ENTRIES"), 10000)
+CONVERSATION_STORE_TTL_SECONDS = env_var_to_float(os.getenv("CONVERSATION_STORE_TTL_SECONDS"), 86400.0)
+CONVERSATION_STORE_PATH = Path(
+    os.getenv("CONVERSATION_STORE_PATH") or PROJECT_DIR / ".cache" / "conversation_store.sqlite3"
+)
+
+# Concurrent identical requests share a single upstream call (async handlers
+# only). A coalesced stream subscriber that falls more than
+# REQUEST_COALESCING_MAX_LAG chunks behind the upstream is cut off.
+REQUEST_COALESCING = env_var_to_bool(os.getenv("REQUEST_COALESCING"), "false")
+REQUEST_COALESCING_MAX_LAG = env_var_to_int(os.getenv("REQUEST_COALESCING_MAX_LAG"), 1024)
+
+# Async streams are read from the upstream into a buffer of STREAM_BUFFER_SIZE
+# chunks (0 - no buffering). When the buffer is full, the reading either waits
+# for the client ("block") or, if the client hasn't read anything for
+# SLOW_CONSUMER_TIMEOUT seconds, the stream is aborted ("abort").
+STREAM_BUFFER_SIZE = env_var_to_int(os.getenv("STREAM_BUFFER_SIZE"), 0)
+SLOW_CONSUMER_POLICY = (os.getenv("SLOW_CONSUMER_POLICY") or "block").lower()
+SLOW_CONSUMER_TIMEOUT = env_var_to_float(os.getenv("SLOW_CONSUMER_TIMEOUT"), 30.0)
+
+# Time every stage of the `ProxyLLM` hook pipeline (see `common/proxy_llm.py`)
+PIPELINE_STAGE_TIMING = env_var_to_bool(os.getenv("PIPELINE_STAGE_TIMING"), "false")
+
+# Before the LiteLLM Server reports ready, the handlers open their upstream
+# connections (waiting for them for at most STARTUP_WARM_UP_TIMEOUT seconds),
+# load the tokenizers of their targets and go through LiteLLM's code paths
+# with mock responses, so that the first request doesn't pay for any of it
+STARTUP_WARM_UP = env_var_to_bool(os.getenv("STARTUP_WARM_UP"), "true")
+STARTUP_WARM_UP_TIMEOUT = env_var_to_float(os.getenv("STARTUP_WARM_UP_TIMEOUT"), 10.0)
+# Print the cold-start profile (import time, warm-up, time to the first
+# served request)
+STARTUP_PROFILE = env_var_to_bool(os.getenv("STARTUP_PROFILE"), "true")
+
+# Worker processes of the LiteLLM Server (LiteLLM's own `--num_workers` env
+# var). With more than one, the state the workers have to agree on (rate limit
+# buckets, metrics, the response cache) is kept in SHARED_STATE - "sqlite" (a
+# local database in WAL mode at SHARED_STATE_PATH) or empty (every worker on
+# its own)
+NUM_WORKERS = env_var_to_int(os.getenv("NUM_WORKERS"), 1)
+SHARED_STATE = (os.getenv("SHARED_STATE") or ("sqlite" if NUM_WORKERS > 1 else "")).lower()
+SHARED_STATE_PATH = Path(os.getenv("SHARED_STATE_PATH") or PROJECT_DIR / ".cache" / "shared_state.sqlite3")
+
+# Latency histograms of the proxy handlers, served in the Prometheus text
+# format at http://PROXY_METRICS_HOST:PROXY_METRICS_PORT/metrics (0 - no
+# metrics are collected)
+PROXY_METRICS_PORT = env_var_to_int(os.getenv("PROXY_METRICS_PORT"), 0)
+PROXY_METRICS_HOST = os.getenv("PROXY_METRICS_HOST") or "0.0.0.0"
+# How often every worker publishes its metrics to the shared state
+PROXY_METRICS_SYNC_INTERVAL = env_var_to_float(os.getenv("PROXY_METRICS_SYNC_INTERVAL"), 1.0)
+
+if SHARED_STATE not in ("", "sqlite"):
+    raise ValueError(f"Unknown SHARED_STATE: {SHARED_STATE!r} (expected 'sqlite' or empty)")
+if TRACE_COMPRESSION not in ("none", "gzip", "zstd"):
+    raise ValueError(f"Unknown TRACE_COMPRESSION: {TRACE_COMPRESSION!r} (expected 'none', 'gzip' or 'zstd')")
+if TRACE_COMPRESSION == "zstd":
+    try:
+        import zstandard  # pylint: disable=unused-import
+    except ImportError:
+        print(
+            "\033[1;31mzstandard is not installed (TRACE_COMPRESSION=zstd). Please install it with "
+            "`uv pip install zstandard`. Falling back to gzip.\033[0m"
+        )
+        TRACE_COMPRESSION = "gzip"
 
 if os.getenv("LANGFUSE_SECRET_KEY") or os.getenv("LANGFUSE_PUBLIC_KEY") or os.getenv("LANGFUSE_HOST"):
     try:
@@ -28,3 +163,37 @@ if os.getenv("LANGFUSE_SECRET_KEY") or os.getenv("LANGFUSE_PUBLIC_KEY") or os.ge
         print("\033[1;34mEnabling Langfuse logging...\033[0m")
         litellm.success_callback = ["langfuse"]
         litellm.failure_callback = ["langfuse"]
+
+
+def load_handler_settings(provider: str) -> dict[str, Any]:
+    """
+    Load the settings of a custom handler from the `proxy_handler_settings`
+    section of the LiteLLM config file (LiteLLM itself ignores this section):
+
+    ```yaml
+    proxy_handler_settings:
+      <provider>:
+        ...
+    ```
+    """
+    if not LITELLM_CONFIG_PATH.exists():
+        return {}
+
+    with LITELLM_CONFIG_PATH.open(encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+
+    return (config.get("proxy_handler_settings") or {}).get(provider) or {}
+
+
+def settings_section(settings: Optional[dict[str, Any]]) -> Optional[dict[str, Any]]:
+    """
+    A copy of a section of the handler settings (see `load_handler_settings`)
+    without its `enabled` key, or None if the section is missing or has
+    `enabled: false` (the feature is off).
+    """
+    if settings is None:
+        return None
+    settings = dict(settings)
+    if not settings.pop("enabled", True):
+        return None
+    return settings
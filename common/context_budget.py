@@ -0,0 +1,303 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+
+import litellm
+from pydantic import BaseModel
+
+from common.metrics import ProxyMetrics
+
+
+# `litellm.token_counter()` adds 3 tokens to every list of messages (the
+# priming of the reply), on top of the tokens of the messages themselves
+_REPLY_PRIMING_TOKENS = 3
+# Roles that are never trimmed away (the injected system prompt among them)
+_PINNED_ROLES = ("system", "developer")
+
+
+class TokenCountCache:
+    """
+    Token counts of individual messages, keyed by the hash of their content
+    (and the target model, whose tokenizer counted them). In a conversation,
+    every turn resends the whole history, so only the new messages of a turn
+    have to be tokenized. LRU with at most `max_entries` counts.
+    """
+
+    def __init__(self, *, max_entries: int = 50000) -> None:
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        # Time spent in the tokenizer (for the messages that weren't cached)
+        self.tokenize_seconds = 0.0
+        self._counts: OrderedDict[bytes, int] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, message: Any, *, target_model: str) -> int:
+        key = _message_key(message, target_model)
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return tokens
+
+        started_at = time.perf_counter()
+        tokens = _count_message_tokens(message, target_model)
+        elapsed = time.perf_counter() - started_at
+
+        with self._lock:
+            self.misses += 1
+            self.tokenize_seconds += elapsed
+            self._counts[key] = tokens
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def stats(self) -> dict[str, Any]:
+        average_seconds = self.tokenize_seconds / self.misses if self.misses else 0.0
+        return {
+            "entries": len(self._counts),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+            "tokenize_seconds": self.tokenize_seconds,
+            # The cached counts, at the average cost of the ones that weren't
+            "tokenize_seconds_saved": self.hits * average_seconds,
+        }
+
+
+class ContextBudget:
+    """
+    A prompt transform that keeps the prompt within a token budget: the
+    oldest turns of the conversation (a user message with everything that
+    follows it up to the next one - assistant replies, tool calls and their
+    results stay together) are left out until the rest fits. The system
+    messages (the injected system prompt among them) and the last turn are
+    always kept - if they alone don't fit, the prompt is passed on as is.
+
+    The budget is `max_tokens` or, if it isn't set, the input limit of the
+    target model minus `reserve_tokens` (room for the tool definitions and
+    the response). Targets with an unknown input limit aren't trimmed.
+
+    Strategies:
+      - "drop": the trimmed turns are left out
+      - "summarize": they are replaced with a system message (of at most
+        `summary_max_tokens`) that quotes the beginnings of their user
+        messages (the most recent ones that fit) - extracted, not written by
+        a model, so trimming doesn't cost an extra upstream call
+
+    Should come after `inject_system_prompt` (which it counts in). Trimming
+    changes the beginning of the conversation, so a trimmed prompt is only
+    served from the provider's prompt cache up to the system messages.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        *,
+        max_tokens: Optional[int] = None,
+        reserve_tokens: int = 4096,
+        strategy: str = "drop",
+        summary_max_tokens: int = 256,
+        summary_chars_per_turn: int = 200,
+        cache_max_entries: int = 50000,
+        metrics: Optional[ProxyMetrics] = None,
+    ) -> None:
+        if strategy not in ("drop", "summarize"):
+            raise ValueError(f"Unknown context budget strategy: {strategy!r} (expected 'drop' or 'summarize')")
+        self.max_tokens = max_tokens
+        self.reserve_tokens = reserve_tokens
+        self.strategy = strategy
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_chars_per_turn = summary_chars_per_turn
+        self.token_counts = TokenCountCache(max_entries=cache_max_entries)
+        self.metrics = metrics
+
+        self.requests = 0
+        self.trimmed_requests = 0
+        # Over budget even without any of the turns that can be trimmed
+        self.over_budget_requests = 0
+        self.trimmed_messages = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self._budgets: dict[str, Optional[int]] = {}
+        self._stats_lock = threading.Lock()
+
+    def __call__(self, messages: list, *, target_model: str) -> list:
+        budget = self.budget(target_model)
+        if budget is None or not messages:
+            return messages
+
+        counts = [self.token_counts.count(message, target_model=target_model) for message in messages]
+        tokens_before = sum(counts) + _REPLY_PRIMING_TOKENS
+
+        trimmed, tokens_after, dropped = messages, tokens_before, 0
+        if tokens_before > budget:
+            trimmed, tokens_after, dropped = self._trim(messages, counts, budget, target_model)
+
+        self._record(
+            target_model, tokens_before=tokens_before, tokens_after=tokens_after, dropped=dropped, budget=budget
+        )
+        return trimmed
+
+    def budget(self, target_model: str) -> Optional[int]:
+        if self.max_tokens is not None:
+            return self.max_tokens
+        if target_model not in self._budgets:
+            try:
+                max_input_tokens = litellm.get_model_info(target_model).get("max_input_tokens")
+            except Exception:  # pylint: disable=broad-exception-caught
+                max_input_tokens = None
+            self._budgets[target_model] = max_input_tokens - self.reserve_tokens if max_input_tokens else None
+        return self._budgets[target_model]
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "trimmed_requests": self.trimmed_requests,
+            "over_budget_requests": self.over_budget_requests,
+            "trimmed_messages": self.trimmed_messages,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "tokens_saved": self.tokens_before - self.tokens_after,
+            "token_counts": self.token_counts.stats(),
+        }
+
+    def _trim(self, messages: list, counts: list[int], budget: int, target_model: str) -> tuple[list, int, int]:
+        dropped = self._oldest_turns_to_drop(messages, counts, budget)
+        dropped_set = set(dropped)
+        trimmed = [message for idx, message in enumerate(messages) if idx not in dropped_set]
+        tokens_after = sum(counts) + _REPLY_PRIMING_TOKENS - sum(counts[idx] for idx in dropped)
+
+        if self.strategy == "summarize":
+            summary = self._summarize([messages[idx] for idx in dropped], target_model)
+            if summary is not None:
+                insert_at = _leading_pinned_count(trimmed)
+                trimmed = trimmed[:insert_at] + [summary] + trimmed[insert_at:]
+                tokens_after += self.token_counts.count(summary, target_model=target_model)
+        return trimmed, tokens_after, len(dropped)
+
+    def _oldest_turns_to_drop(self, messages: list, counts: list[int], budget: int) -> list[int]:
+        """
+        The indices of the messages of the oldest turns that don't fit into
+        the budget (without the pinned ones).
+        """
+        turns = _split_turns(messages)
+        pinned = {idx for idx, message in enumerate(messages) if _role(message) in _PINNED_ROLES}
+        # The part of the prompt that always stays (the last turn included)
+        tokens = _REPLY_PRIMING_TOKENS + sum(counts[idx] for idx in pinned)
+        tokens += sum(counts[idx] for idx in turns[-1] if idx not in pinned)
+        if self.strategy == "summarize":
+            tokens += self.summary_max_tokens
+
+        # The most recent turns that still fit
+        kept_from = len(turns) - 1
+        while kept_from > 0:
+            turn_tokens = sum(counts[idx] for idx in turns[kept_from - 1] if idx not in pinned)
+            if tokens + turn_tokens > budget:
+                break
+            tokens += turn_tokens
+            kept_from -= 1
+
+        return [idx for turn in turns[:kept_from] for idx in turn if idx not in pinned]
+
+    def _summarize(self, dropped: list, target_model: str) -> Optional[dict[str, Any]]:
+        header = (
+            f"The {len(dropped)} earliest messages of this conversation were left out to fit the context window."
+            " The user messages among them began with:"
+        )
+        tokens = _count_text_tokens(header, target_model)
+        lines = []
+        for message in reversed(dropped):
+            if _role(message) != "user":
+                continue
+            text = " ".join(_text_of(message).split())
+            if not text:
+                continue
+            if len(text) > self.summary_chars_per_turn:
+                text = text[: self.summary_chars_per_turn].rstrip() + "..."
+            line = f"- {text}"
+            line_tokens = _count_text_tokens(line, target_model)
+            if tokens + line_tokens > self.summary_max_tokens:
+                break
+            tokens += line_tokens
+            lines.append(line)
+        if not lines:
+            return None
+        return {"role": "system", "content": "\n".join([header] + lines[::-1])}
+
+    def _record(self, target_model: str, *, tokens_before: int, tokens_after: int, dropped: int, budget: int) -> None:
+        with self._stats_lock:
+            self.requests += 1
+            self.tokens_before += tokens_before
+            self.tokens_after += tokens_after
+            if dropped:
+                self.trimmed_requests += 1
+                self.trimmed_messages += dropped
+            if tokens_after > budget:
+                self.over_budget_requests += 1
+
+        if self.metrics is not None and dropped:
+            self.metrics.context_trimmed_messages.inc((target_model,), dropped)
+            self.metrics.context_trimmed_tokens.inc((target_model,), tokens_before - tokens_after)
+
+
+def _split_turns(messages: list) -> list[list[int]]:
+    """
+    The indices of the messages, grouped into turns - every user message
+    starts a new one (whatever comes before the first one is a turn of its
+    own).
+    """
+    turns: list[list[int]] = [[]]
+    for idx, message in enumerate(messages):
+        if _role(message) == "user" and turns[-1]:
+            turns.append([])
+        turns[-1].append(idx)
+    return turns
+
+
+def _leading_pinned_count(messages: list) -> int:
+    count = 0
+    for message in messages:
+        if _role(message) not in _PINNED_ROLES:
+            break
+        count += 1
+    return count
+
+
+def _message_key(message: Any, target_model: str) -> bytes:
+    if isinstance(message, BaseModel):
+        message = message.model_dump(mode="json", exclude_none=True)
+    serialized = json.dumps(message, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.blake2b(f"{target_model}\n{serialized}".encode(), digest_size=16).digest()
+
+
+def _count_message_tokens(message: Any, target_model: str) -> int:
+    if isinstance(message, BaseModel):
+        message = message.model_dump(exclude_none=True)
+    return litellm.token_counter(model=target_model, messages=[message]) - _REPLY_PRIMING_TOKENS
+
+
+def _count_text_tokens(text: str, target_model: str) -> int:
+    return litellm.token_counter(model=target_model, text=text)
+
+
+def _role(message: Any) -> Optional[str]:
+    if isinstance(message, dict):
+        return message.get("role")
+    return getattr(message, "role", None)
+
+
+def _text_of(message: Any) -> str:
+    content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(
+            block.get("text") or "" for block in content if isinstance(block, dict) and block.get("type") == "text"
+        )
+    return ""
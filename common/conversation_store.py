@@ -0,0 +1,215 @@
+import json
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import litellm
+from pydantic import BaseModel
+
+from common.config import (
+    CONVERSATION_STORE,
+    CONVERSATION_STORE_MAX_ENTRIES,
+    CONVERSATION_STORE_PATH,
+    CONVERSATION_STORE_TTL_SECONDS,
+)
+from common.lru_store import InMemoryLRUStore, LRUStore, SQLiteLRUStore, create_lru_store
+
+
+class ConversationNotFoundError(litellm.BadRequestError):
+    """
+    `previous_response_id` refers to a response that was never stored, or
+    that has expired or was evicted since (reaches the client as a 400).
+    """
+
+    def __init__(self, response_id: str, *, model: str) -> None:
+        super().__init__(
+            message=f"Previous response with id {response_id!r} not found (it may have expired)",
+            model=model,
+            llm_provider="conversation_store",
+        )
+
+
+class ConversationStore(LRUStore, ABC):
+    """
+    Base class of the stores of server-side conversation state - the
+    Responses API style `previous_response_id` for the ChatCompletions API.
+
+    Every response is stored as a turn: the id of the previous response, the
+    new messages of the request and the reply, normalized to plain JSON
+    dicts. A conversation is a chain of turns, so every turn is stored once,
+    however long the conversation gets. `history()` puts the messages of the
+    whole chain back together (None if any of its turns is gone).
+    """
+
+    def __init__(self, *, max_entries: int, ttl_seconds: float, **kwargs: Any) -> None:
+        # `kwargs` - for the other base class of the store
+        super().__init__(max_entries=max_entries, ttl_seconds=ttl_seconds, **kwargs)
+        self.stored = 0
+        # The messages the clients didn't have to send
+        self.restored_messages = 0
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def new_response_id() -> str:
+        return f"resp_{uuid.uuid4().hex}"
+
+    @abstractmethod
+    def history(self, response_id: str) -> Optional[list[dict]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def store(self, response_id: str, previous_response_id: Optional[str], messages: list[dict]) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dict[str, int]:
+        return {**super().stats(), "stored": self.stored, "restored_messages": self.restored_messages}
+
+    def _record_lookup(self, history: Optional[list[dict]]) -> None:
+        with self._stats_lock:
+            if history is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.restored_messages += len(history)
+
+
+class InMemoryConversationStore(ConversationStore, InMemoryLRUStore):
+    """
+    LRU store with a TTL, local to the process. Restoring a conversation
+    refreshes all of its turns, so the active conversations are the last ones
+    to be evicted.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_entries: int = CONVERSATION_STORE_MAX_ENTRIES,
+        ttl_seconds: float = CONVERSATION_STORE_TTL_SECONDS,
+    ) -> None:
+        super().__init__(max_entries=max_entries, ttl_seconds=ttl_seconds)
+
+    def history(self, response_id: str) -> Optional[list[dict]]:
+        turns = []
+        with self._lock:
+            current: Optional[str] = response_id
+            while current is not None:
+                # (previous response id, messages)
+                turn = self._get_entry(current, refresh_ttl=True)
+                if turn is None:
+                    break
+                current, messages = turn
+                turns.append(messages)
+
+        history = None
+        if current is None:
+            history = [message for messages in reversed(turns) for message in messages]
+        self._record_lookup(history)
+        return history
+
+    def store(self, response_id: str, previous_response_id: Optional[str], messages: list[dict]) -> None:
+        with self._lock:
+            self._set_entry(response_id, (previous_response_id, messages))
+            self.stored += 1
+
+
+class SQLiteConversationStore(ConversationStore, SQLiteLRUStore):
+    """
+    LRU store with a TTL, persisted in a local SQLite database (survives
+    restarts, shared by the workers of a multi-worker server). A conversation
+    is restored with a single recursive query.
+    """
+
+    def __init__(
+        self,
+        *,
+        path: Union[str, Path] = CONVERSATION_STORE_PATH,
+        max_entries: int = CONVERSATION_STORE_MAX_ENTRIES,
+        ttl_seconds: float = CONVERSATION_STORE_TTL_SECONDS,
+    ) -> None:
+        # Every turn of an active conversation stays as long as the
+        # conversation does (the expiry doubles as the LRU order)
+        super().__init__(
+            path=path,
+            table="conversation_turns",
+            key_column="response_id",
+            lru_column="expires_at",
+            max_entries=max_entries,
+            ttl_seconds=ttl_seconds,
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_turns ("
+            " response_id TEXT PRIMARY KEY,"
+            " previous_response_id TEXT,"
+            " messages TEXT NOT NULL,"
+            " expires_at REAL NOT NULL"
+            ")"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS conversation_turns_expires_at ON conversation_turns (expires_at)"
+        )
+
+    def history(self, response_id: str) -> Optional[list[dict]]:
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "WITH RECURSIVE chain (response_id, previous_response_id, messages, depth) AS ("
+                " SELECT response_id, previous_response_id, messages, 0 FROM conversation_turns"
+                " WHERE response_id = ? AND expires_at > ?"
+                " UNION ALL"
+                " SELECT t.response_id, t.previous_response_id, t.messages, c.depth + 1"
+                " FROM conversation_turns t JOIN chain c ON t.response_id = c.previous_response_id"
+                " WHERE t.expires_at > ?"
+                ") SELECT response_id, previous_response_id, messages FROM chain ORDER BY depth DESC",
+                (response_id, now, now),
+            ).fetchall()
+            complete = bool(rows) and rows[0][1] is None
+            if complete:
+                self._conn.executemany(
+                    "UPDATE conversation_turns SET expires_at = ? WHERE response_id = ?",
+                    [(now + self.ttl_seconds, row[0]) for row in rows],
+                )
+
+        history = [message for row in rows for message in json.loads(row[2])] if complete else None
+        self._record_lookup(history)
+        return history
+
+    def store(self, response_id: str, previous_response_id: Optional[str], messages: list[dict]) -> None:
+        now = time.time()
+        serialized = json.dumps(messages, separators=(",", ":"), ensure_ascii=False, default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversation_turns (response_id, previous_response_id, messages, expires_at)"
+                " VALUES (?, ?, ?, ?)",
+                (response_id, previous_response_id, serialized, now + self.ttl_seconds),
+            )
+            self.stored += 1
+            self.expirations += self._conn.execute(
+                "DELETE FROM conversation_turns WHERE expires_at <= ?", (now,)
+            ).rowcount
+            self._evict_excess()
+
+
+def create_conversation_store(backend: str = CONVERSATION_STORE) -> Optional[ConversationStore]:
+    """
+    Create the conversation store configured via the `CONVERSATION_STORE` env
+    var ("memory", "sqlite" or empty for no server-side conversation state).
+    """
+    return create_lru_store(
+        backend,
+        env_var="CONVERSATION_STORE",
+        kind="conversation store",
+        in_memory=InMemoryConversationStore,
+        sqlite=SQLiteConversationStore,
+    )
+
+
+def normalize_message(message: Any) -> dict:
+    """
+    A message as a plain JSON dict, without the fields that are not set.
+    """
+    if isinstance(message, BaseModel):
+        message = message.model_dump(mode="json", exclude_none=True)
+    return {key: value for key, value in message.items() if value is not None}
@@ -0,0 +1,269 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from common.config import settings_section
+
+
+T = TypeVar("T")
+
+# How many new TTFT samples invalidate the cached percentile
+_PERCENTILE_REFRESH_INTERVAL = 32
+
+
+class HedgingPolicy:
+    """
+    Decides when an async upstream call gets a duplicate ("hedged") request:
+    if the first chunk (or, for non-streaming calls, the response) hasn't
+    arrived after the hedge delay, the same request is sent again (to an
+    alternate target, if the handler routes between several) and whichever
+    attempt responds first wins. The other one is cancelled.
+
+    The hedge delay is either the observed `percentile` of the time to first
+    token (once there are `min_samples` measurements) or a fixed `delay` (also
+    used until there are enough measurements), clamped to
+    [`min_delay`, `max_delay`]. At most `max_hedge_ratio` of the last `window`
+    requests are hedged, so that a slow upstream doesn't get twice the load.
+
+    Configured in the `hedging` section of the handler settings in
+    `config.yaml`:
+
+    ```yaml
+    hedging:
+      percentile: 95
+      delay: 2.0  # seconds (until there are enough TTFT samples)
+      max_hedge_ratio: 0.1
+    ```
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        *,
+        delay: Optional[float] = None,
+        percentile: Optional[float] = None,
+        min_samples: int = 20,
+        min_delay: float = 0.05,
+        max_delay: float = 30.0,
+        max_hedge_ratio: float = 0.1,
+        window: int = 1000,
+        alternate_target: bool = True,
+    ) -> None:
+        # pylint: disable=too-many-arguments
+        if delay is None and percentile is None:
+            raise ValueError("HedgingPolicy needs either `delay` or `percentile`")
+        if percentile is not None and not 0 < percentile < 100:
+            raise ValueError(f"`percentile` must be between 0 and 100 (got {percentile})")
+
+        self.delay = delay
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_hedge_ratio = max_hedge_ratio
+        self.alternate_target = alternate_target
+
+        self._ttft_samples: deque[float] = deque(maxlen=window)
+        self._samples_since_refresh = 0
+        self._percentile_delay: Optional[float] = None
+        # Whether each of the recent requests was hedged
+        self._recent: deque[bool] = deque(maxlen=window)
+        self._hedged_in_window = 0
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.hedges_capped = 0
+
+    @classmethod
+    def from_settings(cls, settings: Optional[dict[str, Any]]) -> Optional["HedgingPolicy"]:
+        """
+        None (no hedging) if the `hedging` section is missing or has
+        `enabled: false`.
+        """
+        settings = settings_section(settings)
+        if settings is None:
+            return None
+        return cls(**settings)
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        How long to wait for the first chunk before hedging (None - don't
+        hedge at all).
+        """
+        with self._lock:
+            delay = self.delay
+            if self.percentile is not None and len(self._ttft_samples) >= self.min_samples:
+                if self._percentile_delay is None or self._samples_since_refresh >= _PERCENTILE_REFRESH_INTERVAL:
+                    samples = sorted(self._ttft_samples)
+                    self._percentile_delay = samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))]
+                    self._samples_since_refresh = 0
+                delay = self._percentile_delay
+
+        if delay is None:
+            return None
+        return min(max(delay, self.min_delay), self.max_delay)
+
+    def acquire_hedge(self) -> bool:
+        """
+        Whether a hedge may be fired now (without exceeding `max_hedge_ratio`).
+        """
+        with self._lock:
+            if self._hedged_in_window + 1 > self.max_hedge_ratio * (len(self._recent) + 1):
+                self.hedges_capped += 1
+                return False
+            self.hedges_fired += 1
+            return True
+
+    def record_request(self, *, hedged: bool, hedge_won: bool, ttft_seconds: Optional[float]) -> None:
+        with self._lock:
+            self.requests += 1
+            if hedge_won:
+                self.hedges_won += 1
+
+            if len(self._recent) == self._recent.maxlen and self._recent[0]:
+                self._hedged_in_window -= 1
+            self._recent.append(hedged)
+            if hedged:
+                self._hedged_in_window += 1
+
+            if ttft_seconds is not None:
+                self._ttft_samples.append(ttft_seconds)
+                self._samples_since_refresh += 1
+
+    def stats(self) -> dict[str, Any]:
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges_fired": self.hedges_fired,
+                "hedges_won": self.hedges_won,
+                "hedges_capped": self.hedges_capped,
+                "hedge_rate": self.hedges_fired / self.requests if self.requests else 0.0,
+                "hedge_delay_ms": None if delay is None else delay * 1000,
+            }
+
+
+async def ahedged_call(start_attempt: Callable[[int], Awaitable[T]], policy: HedgingPolicy) -> T:
+    """
+    Await `start_attempt(0)`, and, if it takes longer than the hedge delay,
+    race it against `start_attempt(1)`.
+    """
+    race = _Race(policy)
+    try:
+        return await race.run(lambda attempt: asyncio.ensure_future(start_attempt(attempt)))
+    finally:
+        await race.cancel_losers()
+
+
+async def ahedged_stream(
+    start_attempt: Callable[[int], AsyncIterator[T]], policy: HedgingPolicy
+) -> AsyncGenerator[T, None]:
+    """
+    Stream from `start_attempt(0)`, and, if its first item takes longer than
+    the hedge delay, race it against `start_attempt(1)`. The rest of the
+    stream comes from the attempt that produced the first item first.
+    """
+    streams: dict[int, AsyncIterator[T]] = {}
+
+    def _start(attempt: int) -> asyncio.Future:
+        streams[attempt] = start_attempt(attempt)
+        return asyncio.ensure_future(_anext_or_done(streams[attempt]))
+
+    race = _Race(policy, on_loser_cancelled=lambda attempt: _aclose(streams[attempt]))
+    try:
+        has_item, first_item = await race.run(_start)
+    finally:
+        await race.cancel_losers()
+
+    winner_stream = streams[race.winner]
+    try:
+        if not has_item:
+            return
+        yield first_item
+        async for item in winner_stream:
+            yield item
+    finally:
+        await _aclose(winner_stream)
+
+
+class _Race:
+    """
+    A primary attempt and (after the hedge delay) at most one hedged attempt
+    - the first one to succeed wins. If an attempt fails, the race goes on as
+    long as the other attempt is still running.
+    """
+
+    def __init__(
+        self, policy: HedgingPolicy, on_loser_cancelled: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> None:
+        self.policy = policy
+        self.winner: Optional[int] = None
+        self._on_loser_cancelled = on_loser_cancelled
+        self._tasks: dict[asyncio.Future, int] = {}
+        self._started_at: dict[int, float] = {}
+
+    async def run(self, start: Callable[[int], asyncio.Future]) -> Any:
+        self._start(start, 0)
+        done, _ = await asyncio.wait(list(self._tasks), timeout=self.policy.hedge_delay())
+        hedged = False
+        if not done and self.policy.acquire_hedge():
+            hedged = True
+            self._start(start, 1)
+
+        errors: list[BaseException] = []
+        while True:
+            done, _ = await asyncio.wait(list(self._tasks), return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=self._tasks.__getitem__):
+                attempt = self._tasks.pop(task)
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                    continue
+
+                self.winner = attempt
+                self.policy.record_request(
+                    hedged=hedged,
+                    hedge_won=attempt > 0,
+                    ttft_seconds=time.perf_counter() - self._started_at[attempt],
+                )
+                return task.result()
+
+            if not self._tasks:
+                self.policy.record_request(hedged=hedged, hedge_won=False, ttft_seconds=None)
+                raise errors[0]
+
+    async def cancel_losers(self) -> None:
+        tasks, self._tasks = self._tasks, {}
+        if not tasks:
+            return
+        for task in tasks:
+            task.cancel()
+        # Unlike awaiting the tasks, doesn't raise their exceptions
+        await asyncio.wait(list(tasks))
+        for task, attempt in tasks.items():
+            if not task.cancelled():
+                task.exception()  # The loser's outcome doesn't matter (but has to be retrieved)
+            if self._on_loser_cancelled is not None:
+                await self._on_loser_cancelled(attempt)
+
+    def _start(self, start: Callable[[int], asyncio.Future], attempt: int) -> None:
+        self._started_at[attempt] = time.perf_counter()
+        self._tasks[start(attempt)] = attempt
+
+
+async def _anext_or_done(stream: AsyncIterator[T]) -> tuple[bool, Optional[T]]:
+    # StopAsyncIteration can't be the result of a task
+    try:
+        return True, await anext(stream)
+    except StopAsyncIteration:
+        return False, None
+
+
+async def _aclose(stream: AsyncIterator) -> None:
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
@@ -0,0 +1,393 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Optional, Union
+
+import httpx
+import litellm
+from litellm import AsyncHTTPHandler, HTTPHandler
+from openai import AsyncOpenAI, OpenAI
+
+from common.config import settings_section
+from common.utils import in_event_loop
+
+
+_DEFAULT_POOL_SETTINGS: dict[str, Any] = {
+    # Keep-alive limits of the connection pool of every client
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "http2": False,
+    # Timeouts (in seconds)
+    "connect_timeout": 5.0,
+    "read_timeout": 600.0,
+    "write_timeout": 600.0,
+    # How long a request may wait for a free connection
+    "pool_timeout": 30.0,
+    # Open connections before the first request needs them
+    "warm_up": True,
+    "warm_connections": 1,
+    # What to request to open a connection (by default - the `/models` endpoint
+    # for OpenAI targets; targets of other providers are not warmed up unless
+    # this is set)
+    "warm_up_url": None,
+}
+
+# Events of httpcore's request tracing that mark the end of the wait for a
+# connection from the pool (either a new connection is being opened or a
+# request is sent over a pooled one)
+_CONNECTION_ACQUIRED_EVENTS = (
+    "connect_tcp.started",
+    "connect_unix_socket.started",
+    "send_request_headers.started",
+)
+
+# Marks the warm-up requests (which are not counted in the stats)
+_WARM_UP_EXTENSION = "proxy_pool_warm_up"
+
+
+class UpstreamClientPool:
+    """
+    Long-lived upstream HTTP clients, one sync and one async client per target
+    model (each with its own connection pool), so that connections and TLS
+    sessions are reused across requests. Configured in the `http_pool` section
+    of the handler settings in `config.yaml`:
+
+    ```yaml
+    http_pool:
+      max_connections: 100
+      max_keepalive_connections: 20
+      http2: false
+      connect_timeout: 5
+      warm_connections: 2
+      targets:  # Per-target overrides
+        anthropic/claude-sonnet-4-5:
+          warm_up_url: https://api.anthropic.com
+    ```
+
+    For OpenAI targets the clients are OpenAI SDK clients (that is what
+    LiteLLM expects for them), created upon first use with the credentials
+    LiteLLM would use (`litellm.api_key` / `OPENAI_API_KEY`, ...). For the
+    other providers - `HTTPHandler` / `AsyncHTTPHandler`.
+
+    NOTE: Async clients are bound to the event loop they are first used in.
+    They are warmed up in the background the first time they are requested
+    (the LiteLLM Server has only one event loop, which doesn't exist yet when
+    the handlers are constructed).
+    """
+
+    def __init__(self, settings: Optional[dict[str, Any]] = None) -> None:
+        settings = dict(settings or {})
+        target_settings = settings.pop("targets", None) or {}
+
+        for section in (settings, *target_settings.values()):
+            unknown = set(section) - set(_DEFAULT_POOL_SETTINGS)
+            if unknown:
+                raise ValueError(f"Unknown http_pool settings: {', '.join(sorted(unknown))}")
+
+        self._defaults = {**_DEFAULT_POOL_SETTINGS, **settings}
+        self._target_settings = target_settings
+        # (target_model, is_async) -> client
+        self._clients: dict[tuple[str, bool], _PooledClient] = {}
+        self._lock = threading.Lock()
+        self._warm_up_tasks: set[asyncio.Task] = set()
+
+    @classmethod
+    def from_settings(cls, settings: Optional[dict[str, Any]]) -> Optional["UpstreamClientPool"]:
+        """
+        None (no pooling - LiteLLM's default clients are used) if the
+        `http_pool` section is missing or has `enabled: false`.
+        """
+        settings = settings_section(settings)
+        if settings is None:
+            return None
+        return cls(settings)
+
+    def settings_for(self, target_model: str) -> dict[str, Any]:
+        return {**self._defaults, **(self._target_settings.get(target_model) or {})}
+
+    def get_client(
+        self, target_model: str, *, is_async: bool, api_key: Optional[str] = None, api_base: Optional[str] = None
+    ) -> Any:
+        """
+        None (LiteLLM creates a client of its own) for the OpenAI targets if
+        the request comes with its own `api_key` / `api_base` (the OpenAI SDK
+        clients carry their credentials) or if there is no API key to create
+        the client with (LiteLLM reports it the way it always does).
+        """
+        pooled = self._clients.get((target_model, is_async))
+        if pooled is None:
+            pooled = self._get_or_create(target_model, is_async=is_async)
+        if pooled.is_openai and (api_key or api_base):
+            return None
+        return pooled.client
+
+    def warm_up(self, target_models: Iterable[str], *, background: bool = True) -> bool:
+        """
+        Open connections of the sync clients of `target_models` (in a daemon
+        thread, unless `background=False`). False if some of them couldn't be
+        opened (only known with `background=False`).
+        """
+        pooled_clients = [self._get_or_create(target_model, is_async=False) for target_model in target_models]
+        if background:
+            threading.Thread(
+                target=self._warm_up_sync, args=(pooled_clients,), name="http-pool-warm-up", daemon=True
+            ).start()
+            return True
+        return self._warm_up_sync(pooled_clients)
+
+    async def awarm_up(self, target_models: Iterable[str]) -> None:
+        """
+        Open connections of the async clients of `target_models` (has to be
+        awaited in the event loop that will use them).
+        """
+        pooled_clients = [
+            self._get_or_create(target_model, is_async=True, warm_up_in_background=False)
+            for target_model in target_models
+        ]
+        await asyncio.gather(*(pooled.awarm_up() for pooled in pooled_clients))
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {
+            f"{target_model} ({'async' if is_async else 'sync'})": pooled.stats()
+            for (target_model, is_async), pooled in list(self._clients.items())
+        }
+
+    def close(self) -> None:
+        """
+        Close the sync clients (async clients are closed by `aclose()`).
+        """
+        for (_, is_async), pooled in list(self._clients.items()):
+            if not is_async:
+                pooled.http_client.close()
+
+    async def aclose(self) -> None:
+        for (_, is_async), pooled in list(self._clients.items()):
+            if is_async:
+                await pooled.http_client.aclose()
+
+    def _get_or_create(
+        self, target_model: str, *, is_async: bool, warm_up_in_background: bool = True
+    ) -> "_PooledClient":
+        with self._lock:
+            pooled = self._clients.get((target_model, is_async))
+            if pooled is not None:
+                return pooled
+            pooled = _PooledClient(target_model, self.settings_for(target_model), is_async=is_async)
+            self._clients[(target_model, is_async)] = pooled
+
+        # Without a running loop, it will be warmed up by the first request
+        if is_async and warm_up_in_background and pooled.settings["warm_up"] and in_event_loop():
+            task = asyncio.ensure_future(pooled.awarm_up())
+            # Keep a reference, so that the task isn't garbage-collected
+            self._warm_up_tasks.add(task)
+            task.add_done_callback(self._warm_up_tasks.discard)
+        return pooled
+
+    @staticmethod
+    def _warm_up_sync(pooled_clients: list["_PooledClient"]) -> bool:
+        # Every one of them, even after a failure
+        results = [pooled.warm_up() for pooled in pooled_clients]
+        return all(results)
+
+
+class _PooledClient:
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, target_model: str, settings: dict[str, Any], *, is_async: bool) -> None:
+        self.target_model = target_model
+        self.settings = settings
+        self.is_async = is_async
+
+        self.requests = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.warmed_connections = 0
+        self._stats_lock = threading.Lock()
+        self._client: Any = None
+        self._client_lock = threading.Lock()
+
+        limits = httpx.Limits(
+            max_connections=settings["max_connections"],
+            max_keepalive_connections=settings["max_keepalive_connections"],
+            keepalive_expiry=settings["keepalive_expiry"],
+        )
+        self.timeout = httpx.Timeout(
+            connect=settings["connect_timeout"],
+            read=settings["read_timeout"],
+            write=settings["write_timeout"],
+            pool=settings["pool_timeout"],
+        )
+
+        try:
+            _, provider, _, _ = litellm.get_llm_provider(target_model)
+        except litellm.BadRequestError:
+            # E.g. a custom provider (see `common/replay.py`) that LiteLLM
+            # hasn't registered yet
+            provider = None
+        self.is_openai = provider == "openai"
+
+        if is_async:
+            self.transport: Union[httpx.HTTPTransport, httpx.AsyncHTTPTransport] = httpx.AsyncHTTPTransport(
+                limits=limits, http2=settings["http2"]
+            )
+            event_hooks = {"request": [self._aon_request]}
+            if self.is_openai:
+                self.http_client: Union[httpx.Client, httpx.AsyncClient] = httpx.AsyncClient(
+                    transport=self.transport, timeout=self.timeout, event_hooks=event_hooks
+                )
+            else:
+                # `AsyncHTTPHandler` doesn't take a client - it creates one on the pooled transport
+                self._client = AsyncHTTPHandler(
+                    timeout=self.timeout, transport=self.transport, event_hooks=event_hooks
+                )
+                self.http_client = self._client.client
+        else:
+            self.transport = httpx.HTTPTransport(limits=limits, http2=settings["http2"])
+            self.http_client = httpx.Client(
+                transport=self.transport, timeout=self.timeout, event_hooks={"request": [self._on_request]}
+            )
+            if not self.is_openai:
+                self._client = HTTPHandler(timeout=self.timeout, client=self.http_client)
+
+    @property
+    def client(self) -> Any:
+        """
+        None for an OpenAI target without an API key (yet).
+        """
+        if self._client is None and self.is_openai:
+            with self._client_lock:
+                if self._client is None:
+                    kwargs = _openai_client_kwargs()
+                    if kwargs["api_key"]:
+                        client_class = AsyncOpenAI if self.is_async else OpenAI
+                        self._client = client_class(**kwargs, http_client=self.http_client)
+        return self._client
+
+    def stats(self) -> dict[str, Any]:
+        # pylint: disable=protected-access
+        # httpx doesn't expose the state of its connection pool publicly
+        connections = list(getattr(getattr(self.transport, "_pool", None), "connections", ()))
+        idle = sum(1 for connection in connections if connection.is_idle())
+        closed = sum(1 for connection in connections if connection.is_closed())
+        with self._stats_lock:
+            return {
+                "connections": len(connections) - closed,
+                "in_use": len(connections) - idle - closed,
+                "idle": idle,
+                "requests": self.requests,
+                "wait_ms_mean": self.wait_seconds_total * 1000 / self.waits if self.waits else 0.0,
+                "wait_ms_max": self.wait_seconds_max * 1000,
+                "warmed_connections": self.warmed_connections,
+            }
+
+    def warm_up(self) -> bool:
+        """
+        False if the connections couldn't be opened.
+        """
+        url, headers = self._warm_up_request()
+        if url is None:
+            return not self.is_openai
+        count = max(1, self.settings["warm_connections"])
+        # Concurrent requests, so that every one of them opens its own connection
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            results = list(executor.map(lambda _: self._warm_up_connection(url, headers), range(count)))
+        self._record_warm_up(results)
+        return all(results)
+
+    async def awarm_up(self) -> bool:
+        url, headers = self._warm_up_request()
+        if url is None:
+            return not self.is_openai
+        count = max(1, self.settings["warm_connections"])
+        results = await asyncio.gather(*(self._awarm_up_connection(url, headers) for _ in range(count)))
+        self._record_warm_up(results)
+        return all(results)
+
+    def _warm_up_request(self) -> tuple[Optional[str], dict[str, str]]:
+        if self.settings["warm_up_url"]:
+            return self.settings["warm_up_url"], {}
+        if self.is_openai:
+            client = self.client
+            if client is None:
+                # TODO Replace with a logger ?
+                print(f"\033[1;33mNo API key to warm up the connections to {self.target_model} with\033[0m")
+                return None, {}
+            return f"{str(client.base_url).rstrip('/')}/models", {"Authorization": f"Bearer {client.api_key}"}
+        return None, {}
+
+    def _warm_up_connection(self, url: str, headers: dict[str, str]) -> bool:
+        try:
+            # Any response will do - it's only about opening the connection
+            self.http_client.get(url, headers=headers, extensions={_WARM_UP_EXTENSION: True}).close()
+            return True
+        except httpx.HTTPError as e:
+            print(f"\033[1;33mFailed to warm up a connection to {url} ({self.target_model}): {e!r}\033[0m")
+            return False
+
+    async def _awarm_up_connection(self, url: str, headers: dict[str, str]) -> bool:
+        try:
+            await (await self.http_client.get(url, headers=headers, extensions={_WARM_UP_EXTENSION: True})).aclose()
+            return True
+        except httpx.HTTPError as e:
+            print(f"\033[1;33mFailed to warm up a connection to {url} ({self.target_model}): {e!r}\033[0m")
+            return False
+
+    def _record_warm_up(self, results: list[bool]) -> None:
+        with self._stats_lock:
+            self.warmed_connections += sum(results)
+
+    def _record_wait(self, seconds: float) -> None:
+        with self._stats_lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def _make_trace(self):
+        """
+        A callback for httpcore's request tracing that records how long the
+        request waited for a connection from the pool.
+        """
+        started_at = time.perf_counter()
+        waiting = True
+
+        def _trace(event_name: str, info: dict) -> None:
+            # pylint: disable=unused-argument
+            nonlocal waiting
+            if waiting and event_name.endswith(_CONNECTION_ACQUIRED_EVENTS):
+                waiting = False
+                self._record_wait(time.perf_counter() - started_at)
+
+        return _trace
+
+    def _on_request(self, request: httpx.Request) -> None:
+        if request.extensions.get(_WARM_UP_EXTENSION):
+            return
+        with self._stats_lock:
+            self.requests += 1
+        request.extensions["trace"] = self._make_trace()
+
+    async def _aon_request(self, request: httpx.Request) -> None:
+        if request.extensions.get(_WARM_UP_EXTENSION):
+            return
+        with self._stats_lock:
+            self.requests += 1
+        trace = self._make_trace()
+
+        async def _atrace(event_name: str, info: dict) -> None:
+            trace(event_name, info)
+
+        request.extensions["trace"] = _atrace
+
+
+def _openai_client_kwargs() -> dict[str, Any]:
+    """
+    The credentials LiteLLM would create its own OpenAI client with.
+    """
+    return {
+        "api_key": litellm.api_key or litellm.openai_key or os.getenv("OPENAI_API_KEY"),
+        "base_url": litellm.api_base or os.getenv("OPENAI_BASE_URL") or os.getenv("OPENAI_API_BASE") or None,
+    }
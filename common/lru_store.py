@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Optional, TypeVar, Union
+
+from common.config import NUM_WORKERS, SHARED_STATE
+from common.shared_state import connect_sqlite
+
+
+Store = TypeVar("Store", bound="LRUStore")
+
+
+class LRUStore:
+    """
+    Base class of the bounded stores with a TTL (the response caches and the
+    conversation stores): at most `max_entries` entries, the least recently
+    used ones are evicted first.
+    """
+
+    def __init__(self, *, max_entries: int, ttl_seconds: float) -> None:
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class InMemoryLRUStore(LRUStore):
+    """
+    An `LRUStore` local to the process. The subclasses hold `_lock` around
+    `_get_entry()` / `_set_entry()`.
+    """
+
+    def __init__(self, *, max_entries: int, ttl_seconds: float) -> None:
+        super().__init__(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        # key -> (expires_at, value)
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        # The sync handlers are called from multiple threads
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key: str, *, refresh_ttl: bool = False) -> Optional[Any]:
+        """
+        The value under `key` (None if it's missing or has expired), which
+        becomes the most recently used one.
+        """
+        item = self._entries.get(key)
+        if item is None:
+            return None
+
+        expires_at, value = item
+        now = time.monotonic()
+        if expires_at <= now:
+            del self._entries[key]
+            self.expirations += 1
+            return None
+
+        if refresh_ttl:
+            self._entries[key] = (now + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        return value
+
+    def _set_entry(self, key: str, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+
+class SQLiteLRUStore(LRUStore):
+    """
+    An `LRUStore` persisted in a table of a local SQLite database (survives
+    restarts, shared by the workers of a multi-worker server). The rows are
+    identified by `key_column`, `lru_column` orders them from the least
+    recently used one. The subclasses create the table and hold `_lock`
+    around the use of `_conn`.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        *,
+        table: str,
+        key_column: str,
+        lru_column: str,
+        max_entries: int,
+        ttl_seconds: float,
+    ) -> None:
+        # pylint: disable=too-many-arguments
+        super().__init__(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.path = Path(path)
+        self._table = table
+        self._key_column = key_column
+        self._lru_column = lru_column
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(self.path)
+
+    def _evict_excess(self) -> None:
+        excess = self._conn.execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                f"DELETE FROM {self._table} WHERE {self._key_column} IN"
+                f" (SELECT {self._key_column} FROM {self._table} ORDER BY {self._lru_column} LIMIT ?)",
+                (excess,),
+            )
+            self.evictions += excess
+
+
+def create_lru_store(
+    backend: str, *, env_var: str, kind: str, in_memory: type[Store], sqlite: type[Store]
+) -> Optional[Store]:
+    """
+    The store of `kind` configured via the `env_var` env var: "memory"
+    (`in_memory`), "sqlite" (`sqlite`) or empty (None). With several workers
+    that share their state, "memory" falls back to "sqlite".
+    """
+    backend = backend.lower()
+    if not backend or backend in ("off", "none", "false"):
+        return None
+    if backend == "memory":
+        if NUM_WORKERS > 1 and SHARED_STATE:
+            # TODO Replace with a logger ?
+            print(
+                f"\033[1;33m{env_var}=memory would be a separate {kind} in every one of the {NUM_WORKERS} "
+                f"workers (NUM_WORKERS) - using the shared `sqlite` {kind} instead\033[0m"
+            )
+            return sqlite()
+        return in_memory()
+    if backend == "sqlite":
+        return sqlite()
+    raise ValueError(f"Unknown {kind} backend: {backend!r} (expected 'memory' or 'sqlite')")
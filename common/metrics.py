@@ -0,0 +1,437 @@
+import errno
+import json
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Optional, Sequence
+
+from common.config import PROXY_METRICS_HOST, PROXY_METRICS_PORT, PROXY_METRICS_SYNC_INTERVAL
+from common.shared_state import SharedState
+from common.startup import startup_profile
+
+# Upper bounds of the histogram buckets (in seconds, except for the rates)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CHUNK_GAP_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+STAGE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 5e-3, 0.025, 0.1, 1.0, 10.0)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 1000)
+
+
+class Histogram:
+    """
+    A Prometheus-style histogram with fixed buckets. An observation costs a
+    binary search and a few additions under a lock.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str], buckets: Sequence[float]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._series: dict[tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values: tuple[str, ...], value: float) -> None:
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[idx] += 1
+            series[-1] += value
+
+    def snapshot(self) -> dict[tuple[str, ...], Any]:
+        with self._lock:
+            return {label_values: list(series) for label_values, series in self._series.items()}
+
+    @staticmethod
+    def merge(snapshots: list[dict[tuple[str, ...], Any]]) -> dict[tuple[str, ...], Any]:
+        merged: dict[tuple[str, ...], Any] = {}
+        for snapshot in snapshots:
+            for label_values, series in snapshot.items():
+                total = merged.get(label_values)
+                if total is None:
+                    merged[label_values] = list(series)
+                else:
+                    merged[label_values] = [a + b for a, b in zip(total, series)]
+        return merged
+
+    def render(self, snapshot: Optional[dict[tuple[str, ...], Any]] = None) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        for label_values, series in snapshot.items():
+            labels = _format_labels(self.label_names, label_values)
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{upper_bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values: tuple[str, ...], amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def snapshot(self) -> dict[tuple[str, ...], Any]:
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(snapshots: list[dict[tuple[str, ...], Any]]) -> dict[tuple[str, ...], Any]:
+        merged: dict[tuple[str, ...], Any] = {}
+        for snapshot in snapshots:
+            for label_values, value in snapshot.items():
+                merged[label_values] = merged.get(label_values, 0) + value
+        return merged
+
+    def render(self, snapshot: Optional[dict[tuple[str, ...], Any]] = None) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        if snapshot is None:
+            snapshot = self.snapshot()
+        for label_values, value in snapshot.items():
+            lines.append(f"{self.name}{{{_format_labels(self.label_names, label_values)}}} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    A gauge whose values are read from its sources (callables that return
+    label values -> value) when the metrics are rendered. The values of
+    several workers are combined with `aggregate` ("sum", "min" or "max").
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str], *, aggregate: str = "sum") -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.aggregate = aggregate
+        self._sources: list[Callable[[], dict[tuple[str, ...], float]]] = []
+
+    def add_source(self, source: Callable[[], dict[tuple[str, ...], float]]) -> None:
+        self._sources.append(source)
+
+    def snapshot(self) -> dict[tuple[str, ...], Any]:
+        snapshot: dict[tuple[str, ...], Any] = {}
+        for source in self._sources:
+            snapshot.update(source())
+        return snapshot
+
+    def merge(self, snapshots: list[dict[tuple[str, ...], Any]]) -> dict[tuple[str, ...], Any]:
+        combine = {"sum": sum, "min": min, "max": max}[self.aggregate]
+        values: dict[tuple[str, ...], list] = {}
+        for snapshot in snapshots:
+            for label_values, value in snapshot.items():
+                values.setdefault(label_values, []).append(value)
+        return {label_values: combine(worker_values) for label_values, worker_values in values.items()}
+
+    def render(self, snapshot: Optional[dict[tuple[str, ...], Any]] = None) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        if snapshot is None:
+            snapshot = self.snapshot()
+        for label_values, value in snapshot.items():
+            lines.append(f"{self.name}{{{_format_labels(self.label_names, label_values)}}} {value}")
+        return lines
+
+
+class ProxyMetrics:
+    """
+    Latency metrics of the proxy handlers (see `ProxyLLM`), labelled with the
+    target model and the call type (`completion`, `acompletion`, `streaming`
+    or `astreaming`):
+      - total request duration (as seen by the handler)
+      - time to first chunk and gaps between chunks (streams)
+      - output tokens per second
+      - time spent in every stage of the pipeline (chunk conversion, tracing,
+        other hooks, the upstream call)
+      - admission control (see `common/admission.py`): queue depth, requests
+        in flight and time spent in the queue per target, rejected requests
+      - rate limit pacing (see `common/rate_limits.py`): the delays of the
+        calls and the estimated remaining quotas
+      - context budget trimming (see `common/context_budget.py`): the
+        messages and the prompt tokens left out
+      - provider prompt caching: the prompt tokens, the ones read from and
+        written to the prompt cache of the provider, and the streams that
+        ended without usage
+      - the cold-start profile of the process (see `common/startup.py`)
+
+    With `share()`, every worker of a multi-worker server publishes its
+    metrics to the shared state (see `common/shared_state.py`), and the
+    worker that serves them renders the metrics of all the workers.
+    """
+
+    def __init__(self) -> None:
+        labels = ("target_model", "call_type")
+        self.requests = Counter("proxy_requests_total", "Requests handled by the proxy.", (*labels, "outcome"))
+        self.stream_aborts = Counter(
+            "proxy_stream_aborts_total", "Streams aborted before the end of the response.", (*labels, "reason")
+        )
+        self.reclaimed_connections = Counter(
+            "proxy_reclaimed_upstream_connections_total",
+            "Upstream streams closed before they were consumed in full.",
+            ("target_model",),
+        )
+        self.usage_fallbacks = Counter(
+            "proxy_stream_usage_fallbacks_total",
+            "Streams that ended without upstream usage (LiteLLM counted their tokens locally).",
+            ("target_model",),
+        )
+        self.prompt_tokens = Counter(
+            "proxy_prompt_tokens_total", "Prompt tokens reported by the upstream usage.", ("target_model",)
+        )
+        self.cached_tokens = Counter(
+            "proxy_prompt_cached_tokens_total",
+            "Prompt tokens the upstream provider served from its prompt cache.",
+            ("target_model",),
+        )
+        self.cache_creation_tokens = Counter(
+            "proxy_prompt_cache_creation_tokens_total",
+            "Prompt tokens the upstream provider wrote to its prompt cache.",
+            ("target_model",),
+        )
+        self.context_trimmed_messages = Counter(
+            "proxy_context_trimmed_messages_total",
+            "Messages of long conversations left out to fit the context budget.",
+            ("target_model",),
+        )
+        self.context_trimmed_tokens = Counter(
+            "proxy_context_trimmed_tokens_total",
+            "Prompt tokens saved by trimming long conversations to the context budget.",
+            ("target_model",),
+        )
+        self.request_duration = Histogram(
+            "proxy_request_duration_seconds", "Time from the start of a request to its end.", labels, LATENCY_BUCKETS
+        )
+        self.time_to_first_chunk = Histogram(
+            "proxy_time_to_first_chunk_seconds",
+            "Time from the start of a streamed request to its first chunk.",
+            labels,
+            LATENCY_BUCKETS,
+        )
+        self.inter_chunk_gap = Histogram(
+            "proxy_inter_chunk_gap_seconds", "Time between consecutive chunks of a stream.", labels, CHUNK_GAP_BUCKETS
+        )
+        self.tokens_per_second = Histogram(
+            "proxy_output_tokens_per_second",
+            "Output tokens per second (chunks per second for streams without usage).",
+            labels,
+            TOKEN_RATE_BUCKETS,
+        )
+        self.stage_duration = Histogram(
+            "proxy_stage_duration_seconds", "Time spent in a stage of the proxy pipeline.", ("stage",), STAGE_BUCKETS
+        )
+        self.admission_queue_depth = Gauge(
+            "proxy_admission_queue_depth", "Requests waiting to be admitted to a target.", ("target_model",)
+        )
+        self.admission_in_flight = Gauge(
+            "proxy_admission_in_flight", "Admitted requests in flight to a target.", ("target_model",)
+        )
+        self.admission_wait = Histogram(
+            "proxy_admission_wait_seconds",
+            "Time a request waited to be admitted to its target.",
+            ("target_model", "priority"),
+            LATENCY_BUCKETS,
+        )
+        self.admission_rejections = Counter(
+            "proxy_admission_rejections_total",
+            "Requests rejected by admission control or rate limit pacing (429).",
+            ("target_model", "priority", "reason"),
+        )
+        self.rate_limit_pacing = Histogram(
+            "proxy_rate_limit_pacing_seconds",
+            "Time a call was held back to stay under the rate limits of its target.",
+            ("target_model",),
+            LATENCY_BUCKETS,
+        )
+        self.rate_limit_remaining = Gauge(
+            "proxy_rate_limit_remaining",
+            "Estimated remaining requests / tokens of an upstream quota.",
+            ("bucket", "limit"),
+            aggregate="min",
+        )
+        self.startup = Gauge(
+            "proxy_startup_milestone_seconds",
+            "Seconds from the start of the process to a milestone of its startup.",
+            ("milestone",),
+            aggregate="max",
+        )
+        self.startup.add_source(startup_profile.milestone_values)
+        self._metrics = (
+            self.requests,
+            self.stream_aborts,
+            self.reclaimed_connections,
+            self.usage_fallbacks,
+            self.prompt_tokens,
+            self.cached_tokens,
+            self.cache_creation_tokens,
+            self.context_trimmed_messages,
+            self.context_trimmed_tokens,
+            self.request_duration,
+            self.time_to_first_chunk,
+            self.inter_chunk_gap,
+            self.tokens_per_second,
+            self.stage_duration,
+            self.admission_queue_depth,
+            self.admission_in_flight,
+            self.admission_wait,
+            self.admission_rejections,
+            self.rate_limit_pacing,
+            self.rate_limit_remaining,
+            self.startup,
+        )
+        self._server: Optional[ThreadingHTTPServer] = None
+        self.shared_state: Optional[SharedState] = None
+        self.sync_interval = PROXY_METRICS_SYNC_INTERVAL
+
+    def share(self, shared_state: SharedState, interval: float = PROXY_METRICS_SYNC_INTERVAL) -> None:
+        """
+        Publish the metrics of this worker to `shared_state` every `interval`
+        seconds (from a daemon thread), and render the metrics of all the
+        workers of the server. Does nothing if they are already shared.
+        """
+        if self.shared_state is not None:
+            return
+        self.shared_state = shared_state
+        self.sync_interval = interval
+        shared_state.execute(
+            "CREATE TABLE IF NOT EXISTS metrics_snapshots ("
+            " worker TEXT PRIMARY KEY,"
+            " run TEXT NOT NULL,"
+            " published_at REAL NOT NULL,"
+            " snapshot TEXT NOT NULL"
+            ")"
+        )
+        # The workers of the previous runs of the server
+        shared_state.execute("DELETE FROM metrics_snapshots WHERE run != ?", (shared_state.run_id,))
+        threading.Thread(target=self._publish_periodically, name="metrics-publisher", daemon=True).start()
+
+    def publish(self) -> None:
+        snapshot = {
+            metric.name: [[list(label_values), value] for label_values, value in metric.snapshot().items()]
+            for metric in self._metrics
+        }
+        self.shared_state.execute(
+            "INSERT OR REPLACE INTO metrics_snapshots (worker, run, published_at, snapshot) VALUES (?, ?, ?, ?)",
+            (self.shared_state.worker_id, self.shared_state.run_id, time.time(), json.dumps(snapshot)),
+        )
+
+    def _publish_periodically(self) -> None:
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.publish()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # TODO Replace with a logger ?
+                print(f"\033[1;31mFailed to publish the proxy metrics: {e!r}\033[0m")
+
+    def observe_stage(self, stage: str, seconds: float) -> None:
+        self.stage_duration.observe((stage,), seconds)
+
+    def render(self) -> str:
+        """
+        All the metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        if self.shared_state is None:
+            for metric in self._metrics:
+                lines.extend(metric.render())
+            return "\n".join(lines) + "\n"
+
+        self.publish()
+        # The workers that stopped publishing are gone - their counters and
+        # histograms still count, their gauges don't
+        live_since = time.time() - 3 * self.sync_interval
+        workers = [
+            (published_at >= live_since, json.loads(snapshot))
+            for published_at, snapshot in self.shared_state.execute(
+                "SELECT published_at, snapshot FROM metrics_snapshots WHERE run = ?", (self.shared_state.run_id,)
+            )
+        ]
+        for metric in self._metrics:
+            snapshots = [
+                {tuple(label_values): value for label_values, value in snapshot.get(metric.name, ())}
+                for live, snapshot in workers
+                if live or not isinstance(metric, Gauge)
+            ]
+            lines.extend(metric.render(metric.merge(snapshots)))
+        return "\n".join(lines) + "\n"
+
+    def start_server(self, port: int, host: str = "0.0.0.0") -> None:
+        """
+        Serve the metrics at `http://<host>:<port>/metrics` from a daemon thread
+        (independently of the LiteLLM Server and its event loop). Does nothing
+        if the server is already running.
+        """
+        if self._server is not None:
+            return
+
+        metrics = self
+
+        class _MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # pylint: disable=invalid-name
+                if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+                pass  # Don't spam the console with scrapes
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            if self.shared_state is None or e.errno != errno.EADDRINUSE:
+                raise
+            # Another worker of the server serves the metrics (of all the workers)
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        # TODO Replace with a logger ?
+        print(f"\033[1;34mServing proxy metrics at http://{host}:{port}/metrics\033[0m")
+
+
+proxy_metrics = ProxyMetrics()
+
+
+def create_proxy_metrics(
+    port: int = PROXY_METRICS_PORT, host: str = PROXY_METRICS_HOST, shared_state: Optional[SharedState] = None
+) -> Optional[ProxyMetrics]:
+    """
+    The shared `proxy_metrics` (with its HTTP server started) if the
+    `PROXY_METRICS_PORT` env var is set, otherwise None (no metrics are
+    collected). With `shared_state`, the metrics of all the workers of the
+    server are served (by whichever worker gets the port).
+    """
+    if not port:
+        return None
+    if shared_state is not None:
+        proxy_metrics.share(shared_state)
+    proxy_metrics.start_server(port, host)
+    return proxy_metrics
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...]) -> str:
+    return ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in zip(label_names, label_values))
+
+
+def _escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,245 @@
+import threading
+from typing import Any, Optional, Protocol
+
+from common.context_budget import ContextBudget
+from common.metrics import ProxyMetrics
+
+
+_CACHE_CONTROL_EPHEMERAL = {"type": "ephemeral"}
+# Providers that need explicit `cache_control` hints to cache a prompt prefix
+# (OpenAI and most of the others cache prefixes automatically)
+_EXPLICIT_CACHE_CONTROL_PREFIXES = ("anthropic/", "bedrock/", "vertex_ai/")
+
+
+class PromptTransform(Protocol):
+    # pylint: disable=too-few-public-methods
+
+    def __call__(self, messages: list, *, target_model: str) -> list: ...
+
+
+class InjectSystemPrompt:
+    """
+    Inject a system prompt at a stable position, so that the beginning of the
+    prompt stays the same from one turn of a conversation to the next and
+    providers can serve it from their prompt caches.
+
+    Positions:
+      - "prepend": a separate system message at the very beginning
+      - "merge": appended to the content of the leading system message, if
+        there is one (otherwise the same as "prepend")
+      - "append": a separate system message at the very end (changes the tail
+        of the prompt on every turn, which defeats prompt caching)
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, content: str, *, position: str = "prepend") -> None:
+        if position not in ("prepend", "merge", "append"):
+            raise ValueError(f"Unknown system prompt position: {position!r} (expected 'prepend', 'merge' or 'append')")
+        self.position = position
+        self.message = {"role": "system", "content": content}
+
+    def __call__(self, messages: list, *, target_model: str) -> list:
+        if self.position == "append":
+            return messages + [self.message]
+
+        if self.position == "merge" and messages and messages[0].get("role") == "system":
+            merged = dict(messages[0])
+            merged["content"] = _merge_content(merged.get("content"), self.message["content"])
+            return [merged] + messages[1:]
+
+        return [self.message] + messages
+
+
+class AddCacheControl:
+    """
+    Mark the end of the leading system messages (the part of the prompt that
+    is the most stable across turns) with an Anthropic-style `cache_control`
+    breakpoint.
+
+    Modes:
+      - "auto": only for providers that need explicit hints (Anthropic and
+        Anthropic models on Bedrock / Vertex AI)
+      - "always": for every target model
+      - "never": disabled
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, *, mode: str = "auto") -> None:
+        if mode not in ("auto", "always", "never"):
+            raise ValueError(f"Unknown cache_control mode: {mode!r} (expected 'auto', 'always' or 'never')")
+        self.mode = mode
+
+    def __call__(self, messages: list, *, target_model: str) -> list:
+        if self.mode == "never" or (
+            self.mode == "auto" and not target_model.startswith(_EXPLICIT_CACHE_CONTROL_PREFIXES)
+        ):
+            return messages
+
+        last_system_idx = -1
+        for idx, message in enumerate(messages):
+            if message.get("role") != "system":
+                break
+            last_system_idx = idx
+        if last_system_idx < 0:
+            return messages
+
+        message = dict(messages[last_system_idx])
+        message["content"] = _with_cache_control(message.get("content"))
+        return messages[:last_system_idx] + [message] + messages[last_system_idx + 1 :]
+
+
+class PromptTransformPipeline:
+    """
+    A sequence of prompt transforms, usually built from the
+    `proxy_handler_settings.<provider>.prompt_transforms` section of
+    `config.yaml`:
+
+    ```yaml
+    prompt_transforms:
+      - type: inject_system_prompt
+        position: prepend  # prepend | merge | append
+      - type: cache_control
+        mode: auto  # auto | always | never
+      - type: context_budget
+        strategy: drop  # drop | summarize
+    ```
+
+    `inject_system_prompt` uses the handler's own system prompt unless
+    `content` is specified. `context_budget` (see `common/context_budget.py`)
+    counts what it trims in `metrics`.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, transforms: list[PromptTransform]) -> None:
+        self.transforms = tuple(transforms)
+
+    @classmethod
+    def from_settings(
+        cls,
+        settings: Optional[list[dict[str, Any]]],
+        *,
+        system_prompt: Optional[str] = None,
+        metrics: Optional[ProxyMetrics] = None,
+    ) -> "PromptTransformPipeline":
+        if settings is None:
+            settings = [{"type": "inject_system_prompt"}]
+
+        transforms: list[PromptTransform] = []
+        for transform_settings in settings:
+            transform_settings = dict(transform_settings)
+            transform_type = transform_settings.pop("type", None)
+
+            if transform_type == "inject_system_prompt":
+                content = transform_settings.pop("content", system_prompt)
+                if content is None:
+                    raise ValueError("`inject_system_prompt` needs `content` (the handler has no system prompt)")
+                transforms.append(InjectSystemPrompt(content, **transform_settings))
+            elif transform_type == "cache_control":
+                transforms.append(AddCacheControl(**transform_settings))
+            elif transform_type == "context_budget":
+                transforms.append(ContextBudget(metrics=metrics, **transform_settings))
+            else:
+                raise ValueError(f"Unknown prompt transform type: {transform_type!r}")
+
+        return cls(transforms)
+
+    def __call__(self, messages: list, *, target_model: str) -> list:
+        for transform in self.transforms:
+            messages = transform(messages, target_model=target_model)
+        return messages
+
+    def stats(self) -> dict[str, Any]:
+        """
+        The stats of the transforms that keep any (e.g. the tokens saved by
+        `context_budget`), by transform class.
+        """
+        return {
+            type(transform).__name__: transform.stats() for transform in self.transforms if hasattr(transform, "stats")
+        }
+
+
+class PromptCacheStats:
+    """
+    Accumulates how many prompt tokens the upstream providers served from
+    their prompt caches (as reported in the `usage` of the responses), and
+    how many streamed responses came without any usage (`usage_fallbacks` -
+    LiteLLM counts their tokens locally instead).
+    """
+
+    def __init__(self) -> None:
+        self.responses = 0
+        self.usage_fallbacks = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.cache_creation_tokens = 0
+        self._lock = threading.Lock()
+
+    def record_usage(self, usage: Any) -> None:
+        if usage is None:
+            return
+
+        prompt_tokens, cached_tokens, cache_creation_tokens = prompt_cache_usage(usage)
+        with self._lock:
+            self.responses += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self.cache_creation_tokens += cache_creation_tokens
+
+    def record_missing_usage(self) -> None:
+        with self._lock:
+            self.usage_fallbacks += 1
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "responses": self.responses,
+            "usage_fallbacks": self.usage_fallbacks,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_creation_tokens": self.cache_creation_tokens,
+            "cached_ratio": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+        }
+
+
+def prompt_cache_usage(usage: Any) -> tuple[int, int, int]:
+    """
+    The prompt tokens of the `usage` of a response, the ones read from the
+    prompt cache of the provider and the ones written to it (OpenAI reports
+    the former in `prompt_tokens_details`, Anthropic both as separate
+    fields).
+    """
+    details = _get(usage, "prompt_tokens_details")
+    cached_tokens = (_get(details, "cached_tokens") if details is not None else None) or _get(
+        usage, "cache_read_input_tokens"
+    )
+    return (
+        _get(usage, "prompt_tokens") or 0,
+        cached_tokens or 0,
+        _get(usage, "cache_creation_input_tokens") or 0,
+    )
+
+
+def _get(obj: Any, key: str) -> Any:
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
+
+
+def _merge_content(existing: Any, addition: str) -> Any:
+    if isinstance(existing, list):
+        return existing + [{"type": "text", "text": addition}]
+    if existing:
+        return f"{existing}\n\n{addition}"
+    return addition
+
+
+def _with_cache_control(content: Any) -> Any:
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, "cache_control": _CACHE_CONTROL_EPHEMERAL}]
+    if isinstance(content, list) and content:
+        last_block = dict(content[-1])
+        last_block["cache_control"] = _CACHE_CONTROL_EPHEMERAL
+        return content[:-1] + [last_block]
+    return content
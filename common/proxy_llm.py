@@ -0,0 +1,1582 @@
+# pylint: disable=too-many-lines
+import asyncio
+import copy
+import inspect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, AsyncGenerator, Awaitable, Callable, Generator, Optional, Sequence, Union
+
+import httpx
+import litellm
+from litellm import (
+    CustomLLM,
+    CustomStreamWrapper,
+    GenericStreamingChunk,
+    HTTPHandler,
+    ModelResponse,
+    ModelResponseStream,
+    AsyncHTTPHandler,
+)
+
+from common.admission import AdmissionController, AdmissionRejectedError, AdmissionTicket
+from common.chunk_coalescer import ChunkCoalescer
+from common.chunk_converter import StreamingChunkConverter
+from common.config import (
+    PIPELINE_STAGE_TIMING,
+    PROMPT_CACHE_STATS,
+    RESPONSE_CACHE_REPLAY_PACING,
+    STARTUP_WARM_UP,
+    STREAM_INCLUDE_USAGE,
+    STREAM_PASSTHROUGH,
+    WRITE_RECORDINGS,
+    WRITE_TRACES_TO_FILES,
+)
+from common.conversation_store import ConversationNotFoundError, ConversationStore, normalize_message
+from common.hedging import HedgingPolicy, ahedged_call, ahedged_stream
+from common.http_pool import UpstreamClientPool
+from common.metrics import ProxyMetrics
+from common.prompt_transforms import PromptCacheStats, prompt_cache_usage
+from common.rate_limits import RateLimitPacer, RateLimitReservation, retry_after_of
+from common.replay import RECORDING_FORMAT_VERSION, write_recording
+from common.response_cache import (
+    ResponseCache,
+    StreamCacheRecorder,
+    areplay_stream,
+    make_cache_key,
+    replay_stream,
+    response_from_cache_entry,
+    response_to_cache_entry,
+)
+from common.routing import TargetRouter
+from common.single_flight import SingleFlight
+from common.startup import startup_profile, warm_up
+from common.stream_control import SlowConsumerError, StreamControl, aclose_stream, close_stream
+from common.tool_call_assembler import AssembledToolCall, ToolCallAssembler
+from common.trace_session import StreamTraceSession
+from common.trace_storage import TracePolicy, trace_retention
+from common.trace_writer import snapshot, trace_writer
+from common.tracing_in_markdown import write_error_trace, write_request_trace, write_response_trace
+from common.utils import ProxyError, final_chunk_usage, generate_timestamp_utc, in_event_loop
+
+OutputChunk = Union[GenericStreamingChunk, ModelResponseStream]
+
+# Hooks can be either plain functions or coroutine functions
+PreRequestHook = Callable[["ProxyCall"], Optional[Awaitable[None]]]
+# Same as the pre-request hooks, but run for every upstream attempt once its
+# target was chosen (for whatever depends on the target model)
+PreUpstreamHook = PreRequestHook
+# Receives the upstream chunk and the chunk that is about to be yielded to
+# LiteLLM (the same object in passthrough mode), returns the chunk to yield
+ChunkHook = Callable[["ProxyCall", ModelResponseStream, OutputChunk], Union[OutputChunk, Awaitable[OutputChunk]]]
+PostResponseHook = Callable[["ProxyCall"], Optional[Awaitable[None]]]
+# Receives every tool call of a stream as soon as it is complete (plain
+# functions only - they run within the stream, anything slow is to be
+# scheduled rather than awaited)
+ToolCallHook = Callable[["ProxyCall", AssembledToolCall], None]
+
+
+class ProxyCall:
+    """
+    The state of a single call that goes through a `ProxyLLM` handler. Hooks
+    read it and may modify it (e.g. a pre-request hook replaces `messages`,
+    which are then sent upstream).
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-few-public-methods
+
+    __slots__ = (
+        "calling_method",
+        "timestamp",
+        "target_model",
+        "messages_original",
+        "messages",
+        "messages_request",
+        "optional_params",
+        "litellm_params",
+        "logger_fn",
+        "headers",
+        "timeout",
+        "client",
+        "stream",
+        "is_async",
+        "request_key",
+        "response",
+        "error",
+        "completed",
+        "traced",
+        "request_traced",
+        "trace_session",
+        "cache_recorder",
+        "replay_recorder",
+        "started_at",
+        "upstream_started_at",
+        "first_token_at",
+        "first_chunk_at",
+        "last_chunk_at",
+        "chunk_count",
+        "usage",
+        "tool_calls",
+        "response_id",
+        "previous_response_id",
+        "conversation_messages",
+        "reply_fragments",
+        "response_id_stamped",
+        "response_headers",
+        "rate_limit_reservation",
+        "exclude_targets",
+        "extras",
+    )
+
+    def __init__(
+        self,
+        *,
+        calling_method: str,
+        target_model: str,
+        messages: list,
+        optional_params: dict,
+        litellm_params: Optional[dict],
+        logger_fn: Optional[Callable],
+        headers: Optional[dict],
+        timeout: Optional[Union[float, httpx.Timeout]],
+        client: Optional[Union[HTTPHandler, AsyncHTTPHandler]],
+    ) -> None:
+        # pylint: disable=too-many-arguments
+        self.calling_method = calling_method
+        self.timestamp = generate_timestamp_utc()
+        self.target_model = target_model
+        self.messages_original = messages
+        self.messages = messages
+        # The messages as the pre-request hooks left them, set once the first
+        # target was chosen - the pre-upstream hooks of every attempt start
+        # from them
+        self.messages_request: Optional[list] = None
+        self.optional_params = optional_params
+        self.litellm_params = litellm_params
+        self.logger_fn = logger_fn
+        self.headers = headers
+        self.timeout = timeout
+        self.client = client
+        self.stream = calling_method in ("streaming", "astreaming")
+        self.is_async = calling_method in ("acompletion", "astreaming")
+
+        self.request_key: Optional[str] = None
+        # Set once the upstream response was received (non-streaming calls)
+        self.response: Optional[ModelResponse] = None
+        # Set if the upstream call (or the stream) failed
+        self.error: Optional[BaseException] = None
+        # True once the upstream response was received / consumed in full
+        self.completed = False
+        # Whether the call was sampled for tracing (see `TracePolicy`)
+        self.traced = False
+        # Whether the request trace was written
+        self.request_traced = False
+        self.trace_session: Optional[StreamTraceSession] = None
+        self.cache_recorder: Optional[StreamCacheRecorder] = None
+        # Records the upstream chunks for `common/replay.py`
+        self.replay_recorder: Optional[StreamCacheRecorder] = None
+        # `time.perf_counter()` values
+        self.started_at = time.perf_counter()
+        self.upstream_started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        # Only tracked when metrics are collected
+        self.first_chunk_at: Optional[float] = None
+        self.last_chunk_at: Optional[float] = None
+        self.chunk_count = 0
+        # The usage reported by the final chunk of the stream
+        self.usage: Optional[Any] = None
+        # Only with `tool_call_hooks`
+        self.tool_calls: Optional[ToolCallAssembler] = None
+        # Only with a `conversation_store` - the id of the response for the
+        # client to continue the conversation from, the new messages of the
+        # request and the text of the reply (streams)
+        self.response_id: Optional[str] = None
+        self.previous_response_id: Optional[str] = None
+        self.conversation_messages: Optional[list[dict]] = None
+        self.reply_fragments: Optional[list[str]] = None
+        self.response_id_stamped = False
+        # The headers of the upstream response (as LiteLLM reports them)
+        self.response_headers: Optional[dict] = None
+        self.rate_limit_reservation: Optional[RateLimitReservation] = None
+        # Targets the router should avoid (e.g. the one a hedged request is
+        # a duplicate of)
+        self.exclude_targets: tuple[str, ...] = ()
+        # For the hooks of the subclasses to keep their per-call state in
+        self.extras: dict[str, Any] = {}
+
+    def new_attempt(self, suffix: str) -> "ProxyCall":
+        """
+        A fresh copy of the call for another attempt at the same upstream
+        request (the trace files of the attempt get `suffix` appended to the
+        timestamp).
+        """
+        attempt = copy.copy(self)
+        attempt.timestamp = f"{self.timestamp}_{suffix}"
+        attempt.response = None
+        attempt.error = None
+        attempt.completed = False
+        attempt.request_traced = False
+        attempt.trace_session = None
+        attempt.cache_recorder = None
+        attempt.replay_recorder = None
+        attempt.upstream_started_at = None
+        attempt.first_token_at = None
+        attempt.first_chunk_at = None
+        attempt.last_chunk_at = None
+        attempt.chunk_count = 0
+        attempt.usage = None
+        attempt.tool_calls = None
+        attempt.reply_fragments = None
+        attempt.response_id_stamped = False
+        attempt.response_headers = None
+        attempt.rate_limit_reservation = None
+        attempt.exclude_targets = ()
+        attempt.extras = dict(self.extras)
+        return attempt
+
+
+class StageTimer:
+    """
+    Accumulates the wall-clock time spent in every stage of the pipeline (the
+    upstream call, chunk conversion and every individual hook). Every
+    measurement also goes to the `metrics` histograms, if given.
+    """
+
+    def __init__(self, metrics: Optional[ProxyMetrics] = None) -> None:
+        self.metrics = metrics
+        # stage -> [calls, total seconds, max seconds]
+        self._stages: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            totals = self._stages.get(stage)
+            if totals is None:
+                totals = self._stages[stage] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += seconds
+            if seconds > totals[2]:
+                totals[2] = seconds
+        if self.metrics is not None:
+            self.metrics.observe_stage(stage, seconds)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {
+                stage: {
+                    "calls": calls,
+                    "total_ms": total * 1000,
+                    "mean_ms": total * 1000 / calls,
+                    "max_ms": max_seconds * 1000,
+                }
+                for stage, (calls, total, max_seconds) in self._stages.items()
+            }
+
+    def timed(self, stage: str, fn: Callable) -> Callable:
+        """
+        Wrap `fn` (a plain function or a coroutine function) so that every call
+        of it is recorded under `stage`.
+        """
+        if inspect.iscoroutinefunction(fn):
+
+            async def _timed_async(*args, **kwargs):
+                started_at = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started_at)
+
+            return _timed_async
+
+        def _timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started_at)
+
+        return _timed
+
+
+class HookPipeline:
+    """
+    Pre-request, pre-upstream, per-chunk and post-response hooks compiled (once, when the
+    handler is constructed) into as few callables as possible, in a sync and
+    an async flavour. Async hooks are run to completion when called from the
+    sync flavour, sync hooks are simply called from the async one.
+
+    Per-chunk stages are None when there are no chunk hooks at all, so that
+    the streaming loops don't even have to check anything per chunk.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(
+        self,
+        *,
+        pre_request_hooks: Sequence[PreRequestHook] = (),
+        pre_upstream_hooks: Sequence[PreUpstreamHook] = (),
+        chunk_hooks: Sequence[ChunkHook] = (),
+        post_response_hooks: Sequence[PostResponseHook] = (),
+        timer: Optional[StageTimer] = None,
+    ) -> None:
+        if timer is not None:
+            pre_request_hooks = [timer.timed(f"pre_request:{_hook_name(h)}", h) for h in pre_request_hooks]
+            pre_upstream_hooks = [timer.timed(f"pre_upstream:{_hook_name(h)}", h) for h in pre_upstream_hooks]
+            chunk_hooks = [timer.timed(f"chunk:{_hook_name(h)}", h) for h in chunk_hooks]
+            post_response_hooks = [timer.timed(f"post_response:{_hook_name(h)}", h) for h in post_response_hooks]
+
+        self.pre_request = _chain_call_hooks([_to_sync(h) for h in pre_request_hooks])
+        self.apre_request = _achain_call_hooks([_to_async(h) for h in pre_request_hooks])
+        self.pre_upstream = _chain_call_hooks([_to_sync(h) for h in pre_upstream_hooks])
+        self.apre_upstream = _achain_call_hooks([_to_async(h) for h in pre_upstream_hooks])
+        self.post_response = _chain_call_hooks([_to_sync(h) for h in post_response_hooks])
+        self.apost_response = _achain_call_hooks([_to_async(h) for h in post_response_hooks])
+
+        self.chunk: Optional[Callable] = _chain_chunk_hooks([_to_sync(h) for h in chunk_hooks])
+        # As long as none of the chunk hooks is async, the async streams call
+        # the sync chain directly instead of awaiting a coroutine per chunk
+        self.achunk_is_async = any(inspect.iscoroutinefunction(h) for h in chunk_hooks)
+        if self.achunk_is_async:
+            self.achunk: Optional[Callable] = _achain_chunk_hooks([_to_async(h) for h in chunk_hooks])
+        else:
+            self.achunk = self.chunk
+
+    def bind_chunk_processor(
+        self, call: ProxyCall, convert_chunk: Optional[Callable[[ModelResponseStream], GenericStreamingChunk]]
+    ) -> Optional[Callable]:
+        """
+        A single per-stream callable that turns an upstream chunk into the
+        chunk to yield (a coroutine function if `achunk_is_async`), or None
+        when the upstream chunks are to be yielded as they are.
+        """
+        hooks = self.achunk
+        if hooks is None:
+            return convert_chunk
+
+        if self.achunk_is_async:
+            if convert_chunk is None:
+
+                async def _aprocess_passthrough(chunk):
+                    return await hooks(call, chunk, chunk)
+
+                return _aprocess_passthrough
+
+            async def _aprocess(chunk):
+                return await hooks(call, chunk, convert_chunk(chunk))
+
+            return _aprocess
+
+        if convert_chunk is None:
+            return lambda chunk: hooks(call, chunk, chunk)
+        return lambda chunk: hooks(call, chunk, convert_chunk(chunk))
+
+    def bind_sync_chunk_processor(
+        self, call: ProxyCall, convert_chunk: Optional[Callable[[ModelResponseStream], GenericStreamingChunk]]
+    ) -> Optional[Callable]:
+        """
+        Same as `bind_chunk_processor`, but always a plain function (for the
+        sync streams).
+        """
+        hooks = self.chunk
+        if hooks is None:
+            return convert_chunk
+        if convert_chunk is None:
+            return lambda chunk: hooks(call, chunk, chunk)
+        return lambda chunk: hooks(call, chunk, convert_chunk(chunk))
+
+
+class ProxyLLM(CustomLLM):
+    # pylint: disable=too-many-positional-arguments,too-many-arguments,too-many-instance-attributes,too-many-locals
+    # pylint: disable=too-many-statements,too-many-branches
+    """
+    Base class for custom handlers that forward requests to an upstream model.
+    The four LiteLLM entry points all run the same flow:
+
+    1. pre-request hooks (rewrite the messages / params)
+    2. response cache lookup, request coalescing
+    3. the upstream call (to `target_model`, or to whichever of the
+       equivalent targets of the `router` is expected to be the fastest),
+       preceded by the pre-upstream hooks (whatever depends on the chosen
+       target, e.g. the prompt transforms, and tracing of the request) -
+       these run for every attempt (see `hedging`), each time on the
+       messages as the pre-request hooks left them
+    4. chunk coalescing (with a `chunk_coalescer`, see
+       `common/chunk_coalescer.py`), chunk conversion and per-chunk hooks
+       (streams only)
+    5. post-response hooks (usage stats, tracing, caching) - these also run
+       when the upstream call fails or never starts (a pre-upstream hook
+       failed, the admission control turned the call away), with
+       `call.error` set
+
+    Subclasses customize it by passing their own hooks to `__init__` (see
+    `yoda_example/yoda_speak.py`). The built-in features (tracing, prompt
+    cache stats, the response cache) are hooks too, and are only added to the
+    pipeline when they are enabled. Cache hits are returned without going
+    through the per-chunk and post-response hooks.
+
+    With a `conversation_store` (see `common/conversation_store.py`) every
+    response gets an id of its own, and the conversation so far is stored
+    under it. A client continues the conversation by sending only the new
+    messages together with `previous_response_id` (the Responses API way),
+    and the handler puts the whole conversation back together before any
+    other hook runs. The stored calls skip the response cache and request
+    coalescing.
+
+    With a `hedging` policy, the async entry points send a duplicate request
+    when the first chunk takes too long (see `common/hedging.py`).
+
+    With `admission` control, the upstream calls wait for a slot of their
+    target (in the order of their priority class) or are rejected with a 429
+    (see `common/admission.py`). With a rate limit `pacer`, they also wait
+    for the rate limits of their target to allow them (see
+    `common/rate_limits.py`). Rate limit errors (ours and the upstream ones)
+    reach LiteLLM as they are, so clients get a 429 rather than a 500.
+
+    A stream that is closed before its end (e.g. the client disconnected)
+    closes the upstream stream right away, which releases its connection.
+    `stream_control` adds a bounded buffer and a slow-consumer policy to the
+    async streams (see `common/stream_control.py`).
+
+    With `tool_call_hooks`, the tool calls of the streams are put together
+    (every index of every choice, see `common/tool_call_assembler.py`) and
+    passed to the hooks one by one, as soon as each of them is complete -
+    with `parse_tool_call_arguments=True`, as soon as its arguments are
+    complete JSON (parsed into `parsed_arguments`).
+
+    With `stream_include_usage=True` (`STREAM_INCLUDE_USAGE` env var) the
+    upstream streams are asked for their usage, which is passed on to LiteLLM
+    with the final chunk, so that LiteLLM doesn't have to count the tokens of
+    the response itself. The streams that end without usage anyway are
+    counted in the metrics (and in `prompt_cache_stats`).
+
+    With `prompt_cache_stats=True` (`PROMPT_CACHE_STATS` env var) the prompt
+    tokens the upstream providers served from their prompt caches are
+    accumulated in `prompt_cache_stats` (see `PromptCacheStats`).
+
+    With `stage_timing=True` (`PIPELINE_STAGE_TIMING` env var) every stage is
+    timed - see `stage_timings()`.
+
+    With `write_traces=True` (`WRITE_TRACES_TO_FILES` env var) the requests
+    sampled by `trace_policy` (and the failed ones) are traced to `.traces/`
+    (see `common/trace_storage.py` for sampling, caps, compression and
+    retention).
+
+    With `write_recordings=True` (`WRITE_RECORDINGS` env var) every complete
+    upstream exchange is written to `.traces/` in a machine-replayable format
+    (see `common/replay.py`).
+
+    With `startup_warm_up=True` (`STARTUP_WARM_UP` env var) the handler
+    prepares its upstream clients, tokenizers and cache while it is being
+    constructed (see `warm_up()`), and the cold-start profile of the process
+    is reported with the first served response.
+
+    With `metrics` (see `common/metrics.py`), the duration, the time to first
+    chunk, the gaps between chunks and the output token rate of every call,
+    as well as the time spent in every stage, are aggregated into histograms.
+    """
+
+    def __init__(
+        self,
+        *,
+        target_model: Optional[str] = None,
+        pre_request_hooks: Sequence[PreRequestHook] = (),
+        pre_upstream_hooks: Sequence[PreUpstreamHook] = (),
+        chunk_hooks: Sequence[ChunkHook] = (),
+        post_response_hooks: Sequence[PostResponseHook] = (),
+        passthrough_stream: bool = STREAM_PASSTHROUGH,
+        chunk_coalescer: Optional[ChunkCoalescer] = None,
+        tool_call_hooks: Sequence[ToolCallHook] = (),
+        parse_tool_call_arguments: bool = True,
+        conversation_store: Optional[ConversationStore] = None,
+        stream_include_usage: bool = STREAM_INCLUDE_USAGE,
+        prompt_cache_stats: bool = PROMPT_CACHE_STATS,
+        response_cache: Optional[ResponseCache] = None,
+        single_flight: Optional[SingleFlight] = None,
+        client_pool: Optional[UpstreamClientPool] = None,
+        router: Optional[TargetRouter] = None,
+        hedging: Optional[HedgingPolicy] = None,
+        admission: Optional[AdmissionController] = None,
+        pacer: Optional[RateLimitPacer] = None,
+        metrics: Optional[ProxyMetrics] = None,
+        stream_control: Optional[StreamControl] = None,
+        write_traces: bool = WRITE_TRACES_TO_FILES,
+        trace_policy: Optional[TracePolicy] = None,
+        write_recordings: bool = WRITE_RECORDINGS,
+        stage_timing: bool = PIPELINE_STAGE_TIMING,
+        startup_warm_up: bool = STARTUP_WARM_UP,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(**kwargs)
+        if target_model is None:
+            if router is None:
+                raise ValueError("Either `target_model` or `router` is required")
+            # Identifies the model in the cache keys
+            target_model = router.targets[0]
+        self.target_model = target_model
+        self.passthrough_stream = passthrough_stream
+        self.chunk_coalescer = chunk_coalescer
+        self.tool_call_hooks = tuple(tool_call_hooks)
+        self.parse_tool_call_arguments = parse_tool_call_arguments
+        self.conversation_store = conversation_store
+        self.stream_include_usage = stream_include_usage
+        self.response_cache = response_cache
+        self.single_flight = single_flight
+        self.client_pool = client_pool
+        self.router = router
+        self.hedging = hedging
+        self.admission = admission
+        self.pacer = pacer
+        self.metrics = metrics
+        self.stream_control = stream_control or StreamControl()
+        self._rate_limit_updates: set[asyncio.Future] = set()
+        self.write_traces = write_traces
+        self.trace_policy = trace_policy or TracePolicy.from_env()
+        self.write_recordings = write_recordings
+        self.prompt_cache_stats = PromptCacheStats() if prompt_cache_stats else None
+        # The stage durations are part of the metrics
+        self.stage_timer = StageTimer(metrics) if stage_timing or metrics is not None else None
+
+        pre_request_hooks = list(pre_request_hooks)
+        pre_upstream_hooks = list(pre_upstream_hooks)
+        chunk_hooks = list(chunk_hooks)
+        post_response_hooks = [self._record_first_response, *post_response_hooks]
+        if metrics is not None:
+            chunk_hooks.insert(0, self._observe_chunk)
+        if metrics is not None or prompt_cache_stats or pacer is not None:
+            # Only the usage stats, the metrics and the pacer need the usage
+            # of the streams
+            chunk_hooks.insert(0, self._record_stream_usage)
+        if metrics is not None or prompt_cache_stats:
+            post_response_hooks.insert(0, self._record_response_usage)
+        if conversation_store is not None:
+            # Before any other hook, so that they all see the whole conversation
+            pre_request_hooks.insert(0, self._restore_conversation)
+            chunk_hooks.append(self._record_reply)
+        if tool_call_hooks or conversation_store is not None:
+            chunk_hooks.append(self._assemble_tool_calls)
+            post_response_hooks.append(self._finish_tool_calls)
+        if write_traces:
+            pre_request_hooks.append(self._sample_trace)
+            # After the other pre-upstream hooks, so that the trace shows the
+            # request as it is sent upstream
+            pre_upstream_hooks.append(self._trace_request)
+            chunk_hooks.append(self._trace_chunk)
+            post_response_hooks.append(self._trace_response)
+        if write_recordings:
+            chunk_hooks.append(self._record_chunk_for_replay)
+            post_response_hooks.append(self._write_recording)
+        if response_cache is not None:
+            chunk_hooks.append(self._record_chunk_for_cache)
+            post_response_hooks.append(self._store_in_cache)
+        if conversation_store is not None:
+            # After the hooks that trace and record the response as it came
+            # from upstream (it gets the handler's own response id)
+            post_response_hooks.append(self._store_conversation)
+        if router is not None:
+            chunk_hooks.append(self._record_first_token)
+            post_response_hooks.append(self._record_route_outcome)
+        if pacer is not None:
+            post_response_hooks.append(self._update_rate_limits)
+        if metrics is not None:
+            # Last, so that the request duration includes the other hooks
+            post_response_hooks.append(self._observe_request)
+
+        if conversation_store is not None:
+            # After the hooks that record the chunks as they came from upstream
+            chunk_hooks.append(self._stamp_response_id)
+
+        self.pipeline = HookPipeline(
+            pre_request_hooks=pre_request_hooks,
+            pre_upstream_hooks=pre_upstream_hooks,
+            chunk_hooks=chunk_hooks,
+            post_response_hooks=post_response_hooks,
+            timer=self.stage_timer,
+        )
+
+        if self.stage_timer is None:
+            self._upstream_completion = self.upstream_completion
+            self._aupstream_completion = self.aupstream_completion
+        else:
+            self._upstream_completion = self.stage_timer.timed("upstream", self.upstream_completion)
+            self._aupstream_completion = self.stage_timer.timed("upstream", self.aupstream_completion)
+
+        if metrics is not None and admission is not None:
+            metrics.admission_queue_depth.add_source(
+                lambda: {(target,): depth for target, depth in admission.queue_depths().items()}
+            )
+            metrics.admission_in_flight.add_source(
+                lambda: {(target,): in_flight for target, in_flight in admission.in_flight().items()}
+            )
+        if metrics is not None and pacer is not None:
+            metrics.rate_limit_remaining.add_source(pacer.remaining)
+
+        if write_traces or write_recordings:
+            trace_retention.start()
+
+        if startup_warm_up:
+            self.warm_up()
+        elif client_pool is not None:
+            # The async clients are warmed up once there is an event loop
+            client_pool.warm_up(
+                target
+                for target in (router.targets if router is not None else [target_model])
+                if client_pool.settings_for(target)["warm_up"]
+            )
+
+    def warm_up(self) -> None:
+        """
+        Prepare the upstream clients, the tokenizers and the response cache
+        for the first requests (see `common/startup.py`). Called by the
+        constructor with `startup_warm_up=True` (`STARTUP_WARM_UP` env var).
+        """
+        warm_up(
+            self.router.targets if self.router is not None else [self.target_model],
+            client_pool=self.client_pool,
+            response_cache=self.response_cache,
+        )
+
+    def stage_timings(self) -> dict[str, dict[str, float]]:
+        return {} if self.stage_timer is None else self.stage_timer.stats()
+
+    def upstream_completion(self, call: ProxyCall) -> Union[ModelResponse, CustomStreamWrapper]:
+        return litellm.completion(**self._upstream_kwargs(call))
+
+    async def aupstream_completion(self, call: ProxyCall) -> Union[ModelResponse, CustomStreamWrapper]:
+        return await litellm.acompletion(**self._upstream_kwargs(call))
+
+    def completion(
+        self,
+        model: str,
+        messages: list,
+        api_base: str,
+        custom_prompt_dict: dict,
+        model_response: ModelResponse,
+        print_verbose: Callable,
+        encoding,
+        api_key,
+        logging_obj,
+        optional_params: dict,
+        acompletion=None,
+        litellm_params=None,
+        logger_fn=None,
+        headers=None,
+        timeout: Optional[Union[float, httpx.Timeout]] = None,
+        client: Optional[HTTPHandler] = None,
+    ) -> ModelResponse:
+        try:
+            call = self._new_call(
+                "completion", messages, optional_params, litellm_params, logger_fn, headers, timeout, client
+            )
+            self.pipeline.pre_request(call)
+
+            cache_entry = self._lookup_cache(call)
+            if cache_entry is not None:
+                return response_from_cache_entry(cache_entry)
+
+            return self._complete_upstream(call)
+
+        except (litellm.RateLimitError, ConversationNotFoundError):
+            raise
+        except Exception as e:
+            raise ProxyError(e) from e
+
+    async def acompletion(
+        self,
+        model: str,
+        messages: list,
+        api_base: str,
+        custom_prompt_dict: dict,
+        model_response: ModelResponse,
+        print_verbose: Callable,
+        encoding,
+        api_key,
+        logging_obj,
+        optional_params: dict,
+        acompletion=None,
+        litellm_params=None,
+        logger_fn=None,
+        headers=None,
+        timeout: Optional[Union[float, httpx.Timeout]] = None,
+        client: Optional[AsyncHTTPHandler] = None,
+    ) -> ModelResponse:
+        try:
+            call = self._new_call(
+                "acompletion", messages, optional_params, litellm_params, logger_fn, headers, timeout, client
+            )
+            await self.pipeline.apre_request(call)
+
+            cache_entry = self._lookup_cache(call)
+            if cache_entry is not None:
+                return response_from_cache_entry(cache_entry)
+
+            upstream_call = partial(
+                self._acomplete_upstream if self.hedging is None else self._ahedged_complete_upstream, call
+            )
+            if call.request_key is not None and self.single_flight is not None:
+                # Concurrent identical requests share one upstream call
+                return await self.single_flight.call(call.request_key, upstream_call)
+            return await upstream_call()
+
+        except (litellm.RateLimitError, ConversationNotFoundError):
+            raise
+        except Exception as e:
+            raise ProxyError(e) from e
+
+    def streaming(
+        self,
+        model: str,
+        messages: list,
+        api_base: str,
+        custom_prompt_dict: dict,
+        model_response: ModelResponse,
+        print_verbose: Callable,
+        encoding,
+        api_key,
+        logging_obj,
+        optional_params: dict,
+        acompletion=None,
+        litellm_params=None,
+        logger_fn=None,
+        headers=None,
+        timeout: Optional[Union[float, httpx.Timeout]] = None,
+        client: Optional[HTTPHandler] = None,
+    ) -> Generator[OutputChunk, None, None]:
+        try:
+            call = self._new_call(
+                "streaming", messages, optional_params, litellm_params, logger_fn, headers, timeout, client
+            )
+            self.pipeline.pre_request(call)
+
+            cache_entry = self._lookup_cache(call)
+            if cache_entry is not None:
+                yield from replay_stream(cache_entry, pacing=RESPONSE_CACHE_REPLAY_PACING)
+                return
+
+            try:
+                yield from self._stream_upstream(call)
+            except GeneratorExit:
+                self._record_stream_abort(call, "client_disconnected")
+                raise
+
+        except (litellm.RateLimitError, ConversationNotFoundError):
+            raise
+        except Exception as e:
+            raise ProxyError(e) from e
+
+    async def astreaming(
+        self,
+        model: str,
+        messages: list,
+        api_base: str,
+        custom_prompt_dict: dict,
+        model_response: ModelResponse,
+        print_verbose: Callable,
+        encoding,
+        api_key,
+        logging_obj,
+        optional_params: dict,
+        acompletion=None,
+        litellm_params=None,
+        logger_fn=None,
+        headers=None,
+        timeout: Optional[Union[float, httpx.Timeout]] = None,
+        client: Optional[AsyncHTTPHandler] = None,
+    ) -> AsyncGenerator[OutputChunk, None]:
+        try:
+            call = self._new_call(
+                "astreaming", messages, optional_params, litellm_params, logger_fn, headers, timeout, client
+            )
+            await self.pipeline.apre_request(call)
+
+            cache_entry = self._lookup_cache(call)
+            if cache_entry is not None:
+                async for chunk in areplay_stream(cache_entry, pacing=RESPONSE_CACHE_REPLAY_PACING):
+                    yield chunk
+                return
+
+            upstream_stream = partial(
+                self._astream_upstream if self.hedging is None else self._ahedged_stream_upstream, call
+            )
+            if call.request_key is not None and self.single_flight is not None:
+                # Concurrent identical requests share one upstream stream (and
+                # the chunk / post-response hooks of the first of them)
+                resp_stream = self.single_flight.stream(call.request_key, upstream_stream)
+            else:
+                resp_stream = upstream_stream()
+            resp_stream = self.stream_control.abuffered(resp_stream)
+
+            try:
+                async for chunk in resp_stream:
+                    yield chunk
+            except (GeneratorExit, asyncio.CancelledError):
+                self._record_stream_abort(call, "client_disconnected")
+                raise
+            except SlowConsumerError:
+                self._record_stream_abort(call, "slow_consumer")
+                raise
+            finally:
+                # Close the upstream right away, rather than whenever the
+                # generators get garbage collected
+                await aclose_stream(resp_stream)
+
+        except (litellm.RateLimitError, ConversationNotFoundError):
+            raise
+        except Exception as e:
+            raise ProxyError(e) from e
+
+    def _new_call(
+        self,
+        calling_method: str,
+        messages: list,
+        optional_params: dict,
+        litellm_params: Optional[dict],
+        logger_fn: Optional[Callable],
+        headers: Optional[dict],
+        timeout: Optional[Union[float, httpx.Timeout]],
+        client: Optional[Union[HTTPHandler, AsyncHTTPHandler]],
+    ) -> ProxyCall:
+        return ProxyCall(
+            calling_method=calling_method,
+            target_model=self.target_model,
+            messages=messages,
+            optional_params=optional_params,
+            litellm_params=litellm_params,
+            logger_fn=logger_fn,
+            headers=headers,
+            timeout=timeout,
+            client=client,
+        )
+
+    def _lookup_cache(self, call: ProxyCall) -> Optional[dict]:
+        """
+        Compute the key that identifies identical requests (for the response
+        cache and for request coalescing) and look the request up in the
+        response cache. Has to be called after the pre-request hooks (the
+        pre-upstream ones, e.g. the prompt transforms, are the handler's own
+        and run later, for the target of each attempt). Calls that are
+        stored in the conversation store skip both.
+        """
+        if self.response_cache is None and self.single_flight is None:
+            return None
+        if call.response_id is not None:
+            # Every response of a stored conversation is a response of its own
+            return None
+        call.request_key = make_cache_key(
+            target_model=call.target_model,
+            messages=call.messages,
+            optional_params=call.optional_params,
+            stream=call.stream,
+        )
+        if self.response_cache is None:
+            return None
+        cache_entry = self.response_cache.get(call.request_key)
+        if cache_entry is not None and self.metrics is not None:
+            self.metrics.requests.inc((call.target_model, call.calling_method, "cache_hit"))
+        return cache_entry
+
+    def _new_chunk_converter(self) -> Optional[Callable[[ModelResponseStream], GenericStreamingChunk]]:
+        if self.passthrough_stream:
+            return None
+        convert_chunk = StreamingChunkConverter()
+        if self.stage_timer is not None:
+            return self.stage_timer.timed("chunk:convert", convert_chunk)
+        return convert_chunk
+
+    def _choose_target(self, call: ProxyCall) -> None:
+        if call.messages_request is None:
+            call.messages_request = call.messages
+        else:
+            # Another attempt - its pre-upstream hooks start over (for its own
+            # target)
+            call.messages = call.messages_request
+        if self.router is not None:
+            call.target_model = self.router.choose(call.messages, exclude=call.exclude_targets)
+
+    def _prepare_upstream(self, call: ProxyCall) -> None:
+        self._choose_target(call)
+        self.pipeline.pre_upstream(call)
+
+    async def _aprepare_upstream(self, call: ProxyCall) -> None:
+        self._choose_target(call)
+        await self.pipeline.apre_upstream(call)
+
+    def _admit(self, call: ProxyCall) -> Optional[AdmissionTicket]:
+        """
+        Wait for a slot of the target (admission control), then for the rate
+        limits of the target to allow the call (pacing).
+        """
+        priority = self._priority_of(call)
+        ticket = None
+        try:
+            if self.admission is not None:
+                ticket = self.admission.acquire(call.target_model, priority)
+                self._record_admission(ticket)
+            if self.pacer is not None:
+                call.rate_limit_reservation = self.pacer.pace(call.target_model, call.messages, call.optional_params)
+                self._record_pacing(call)
+        except BaseException as e:
+            self._admission_failed(call, priority, ticket, e)
+            raise
+        return ticket
+
+    async def _aadmit(self, call: ProxyCall) -> Optional[AdmissionTicket]:
+        priority = self._priority_of(call)
+        ticket = None
+        try:
+            if self.admission is not None:
+                ticket = await self.admission.aacquire(call.target_model, priority)
+                self._record_admission(ticket)
+            if self.pacer is not None:
+                call.rate_limit_reservation = await self.pacer.apace(
+                    call.target_model, call.messages, call.optional_params
+                )
+                self._record_pacing(call)
+        except BaseException as e:
+            self._admission_failed(call, priority, ticket, e)
+            raise
+        return ticket
+
+    def _priority_of(self, call: ProxyCall) -> str:
+        return "" if self.admission is None else self.admission.priority_of(call.litellm_params)
+
+    def _admission_failed(
+        self, call: ProxyCall, priority: str, ticket: Optional[AdmissionTicket], error: BaseException
+    ) -> None:
+        if ticket is not None:
+            ticket.release()
+        if isinstance(error, AdmissionRejectedError) and self.metrics is not None:
+            self.metrics.admission_rejections.inc((call.target_model, priority, error.reason))
+
+    def _record_admission(self, ticket: AdmissionTicket) -> None:
+        if self.metrics is not None:
+            self.metrics.admission_wait.observe((ticket.target, ticket.priority), ticket.wait_time)
+
+    def _record_pacing(self, call: ProxyCall) -> None:
+        if self.metrics is not None:
+            self.metrics.rate_limit_pacing.observe((call.target_model,), call.rate_limit_reservation.delay)
+
+    def _begin_upstream(self, call: ProxyCall) -> None:
+        if self.router is not None:
+            self.router.start(call.target_model)
+        if call.stream and self.response_cache is not None:
+            call.cache_recorder = StreamCacheRecorder()
+        if call.stream and self.write_recordings:
+            call.replay_recorder = StreamCacheRecorder()
+        call.upstream_started_at = time.perf_counter()
+
+    def _complete_upstream(self, call: ProxyCall) -> ModelResponse:
+        ticket = None
+        try:
+            # Inside, so that the post-response hooks also see the calls that
+            # were turned away (by the admission control) or failed to prepare
+            self._prepare_upstream(call)
+            ticket = self._admit(call)
+            self._begin_upstream(call)
+            call.response = self._upstream_completion(call)
+            call.response_headers = _response_headers(call.response)
+            call.completed = True
+            return call.response
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            if ticket is not None:
+                ticket.release()
+            self.pipeline.post_response(call)
+
+    async def _acomplete_upstream(self, call: ProxyCall) -> ModelResponse:
+        ticket = None
+        try:
+            await self._aprepare_upstream(call)
+            ticket = await self._aadmit(call)
+            self._begin_upstream(call)
+            call.response = await self._aupstream_completion(call)
+            call.response_headers = _response_headers(call.response)
+            call.completed = True
+            return call.response
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            if ticket is not None:
+                ticket.release()
+            await self.pipeline.apost_response(call)
+
+    def _stream_upstream(self, call: ProxyCall) -> Generator[OutputChunk, None, None]:
+        ticket = None
+        resp_stream: Optional[CustomStreamWrapper] = None
+        chunks = None
+        try:
+            self._prepare_upstream(call)
+            ticket = self._admit(call)
+            self._begin_upstream(call)
+            resp_stream = self._upstream_completion(call)
+            call.response_headers = _response_headers(resp_stream)
+            chunks = resp_stream if self.chunk_coalescer is None else self.chunk_coalescer.coalesce(resp_stream)
+
+            process_chunk = self.pipeline.bind_sync_chunk_processor(call, self._new_chunk_converter())
+            if process_chunk is None:
+                yield from chunks
+            else:
+                for chunk in chunks:
+                    yield process_chunk(chunk)
+
+            call.completed = True
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            if chunks is not None and chunks is not resp_stream:
+                chunks.close()
+            if resp_stream is not None and not call.completed:
+                self._close_upstream(call, resp_stream)
+            if ticket is not None:
+                ticket.release()
+            self.pipeline.post_response(call)
+
+    async def _astream_upstream(self, call: ProxyCall) -> AsyncGenerator[OutputChunk, None]:
+        ticket = None
+        resp_stream: Optional[CustomStreamWrapper] = None
+        chunks = None
+        try:
+            await self._aprepare_upstream(call)
+            ticket = await self._aadmit(call)
+            self._begin_upstream(call)
+            resp_stream = await self._aupstream_completion(call)
+            call.response_headers = _response_headers(resp_stream)
+            chunks = resp_stream if self.chunk_coalescer is None else self.chunk_coalescer.acoalesce(resp_stream)
+
+            process_chunk = self.pipeline.bind_chunk_processor(call, self._new_chunk_converter())
+            if process_chunk is None:
+                async for chunk in chunks:
+                    yield chunk
+            elif self.pipeline.achunk_is_async:
+                async for chunk in chunks:
+                    yield await process_chunk(chunk)
+            else:
+                async for chunk in chunks:
+                    yield process_chunk(chunk)
+
+            call.completed = True
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            if chunks is not None and chunks is not resp_stream:
+                # Stops reading the upstream before it gets closed
+                await chunks.aclose()
+            if resp_stream is not None and not call.completed:
+                await self._aclose_upstream(call, resp_stream)
+            if ticket is not None:
+                ticket.release()
+            await self.pipeline.apost_response(call)
+
+    def _close_upstream(self, call: ProxyCall, resp_stream: CustomStreamWrapper) -> None:
+        try:
+            close_stream(resp_stream)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"\033[1;33mFailed to close the upstream stream ({call.target_model}): {e!r}\033[0m")
+            return
+        self._record_reclaimed_connection(call)
+
+    async def _aclose_upstream(self, call: ProxyCall, resp_stream: CustomStreamWrapper) -> None:
+        try:
+            await aclose_stream(resp_stream)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"\033[1;33mFailed to close the upstream stream ({call.target_model}): {e!r}\033[0m")
+            return
+        self._record_reclaimed_connection(call)
+
+    def _record_reclaimed_connection(self, call: ProxyCall) -> None:
+        self.stream_control.record_reclaimed_connection()
+        if self.metrics is not None:
+            self.metrics.reclaimed_connections.inc((call.target_model,))
+
+    def _record_stream_abort(self, call: ProxyCall, reason: str) -> None:
+        self.stream_control.record_abort(reason)
+        if self.metrics is not None:
+            self.metrics.stream_aborts.inc((call.target_model, call.calling_method, reason))
+
+    def _hedge_attempt(self, call: ProxyCall, attempt: int) -> ProxyCall:
+        if attempt == 0:
+            return call
+        hedge_call = call.new_attempt(f"HEDGE{attempt}")
+        if self.router is not None and self.hedging.alternate_target:
+            hedge_call.exclude_targets = (call.target_model,)
+        return hedge_call
+
+    async def _ahedged_complete_upstream(self, call: ProxyCall) -> ModelResponse:
+        return await ahedged_call(
+            lambda attempt: self._acomplete_upstream(self._hedge_attempt(call, attempt)), self.hedging
+        )
+
+    def _ahedged_stream_upstream(self, call: ProxyCall) -> AsyncGenerator[OutputChunk, None]:
+        return ahedged_stream(lambda attempt: self._astream_upstream(self._hedge_attempt(call, attempt)), self.hedging)
+
+    def _upstream_kwargs(self, call: ProxyCall) -> dict[str, Any]:
+        if self.client_pool is None:
+            client = call.client
+        else:
+            # Whatever client LiteLLM passed to the custom handler is meant for
+            # the handler itself, not for the upstream provider
+            client = self.client_pool.get_client(
+                call.target_model,
+                is_async=call.is_async,
+                api_key=call.optional_params.get("api_key"),
+                api_base=call.optional_params.get("api_base") or call.optional_params.get("base_url"),
+            )
+        kwargs = {
+            "model": call.target_model,
+            "messages": call.messages,
+            "logger_fn": call.logger_fn,
+            "headers": call.headers or {},
+            "timeout": call.timeout,
+            "client": client,
+            # Drop any params that are not supported by the provider
+            "drop_params": True,
+            **call.optional_params,
+        }
+        if call.stream and self.stream_include_usage:
+            stream_options = kwargs.get("stream_options") or {}
+            if not stream_options.get("include_usage"):
+                # Dropped for the providers that don't support it (`drop_params`)
+                kwargs["stream_options"] = {**stream_options, "include_usage": True}
+        return kwargs
+
+    # Built-in hooks
+
+    def _restore_conversation(self, call: ProxyCall) -> None:
+        # Not to be sent upstream
+        params = dict(call.optional_params)
+        previous_response_id = params.pop("previous_response_id", None)
+        extra_body = params.get("extra_body")
+        if isinstance(extra_body, dict) and "previous_response_id" in extra_body:
+            # Where the OpenAI SDK puts the params it doesn't know
+            extra_body = dict(extra_body)
+            previous_response_id = previous_response_id or extra_body.pop("previous_response_id")
+            if extra_body:
+                params["extra_body"] = extra_body
+            else:
+                del params["extra_body"]
+        call.optional_params = params
+
+        call.response_id = self.conversation_store.new_response_id()
+        call.conversation_messages = [normalize_message(message) for message in call.messages]
+        if previous_response_id:
+            history = self.conversation_store.history(previous_response_id)
+            if history is None:
+                raise ConversationNotFoundError(previous_response_id, model=call.target_model)
+            call.previous_response_id = previous_response_id
+            call.messages = history + call.conversation_messages
+
+    @staticmethod
+    def _record_reply(call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk):
+        choices = upstream_chunk.choices
+        if choices:
+            content = choices[0].delta.content
+            if content:
+                if call.reply_fragments is None:
+                    call.reply_fragments = []
+                call.reply_fragments.append(content)
+        return chunk
+
+    @staticmethod
+    def _stamp_response_id(call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk):
+        # pylint: disable=unused-argument
+        # LiteLLM gives every chunk of the stream the id of the first chunk
+        # that has one (every passthrough chunk has one)
+        if isinstance(chunk, ModelResponseStream):
+            chunk.id = call.response_id
+        elif not call.response_id_stamped:
+            chunk = _IdentifiedChunk(chunk, call.response_id)
+            call.response_id_stamped = True
+        return chunk
+
+    def _store_conversation(self, call: ProxyCall) -> None:
+        if not call.completed or call.response_id is None:
+            return
+        if call.response is not None:
+            call.response.id = call.response_id
+            reply = normalize_message(call.response.choices[0].message)
+        else:
+            content = "".join(call.reply_fragments or ())
+            tool_calls = (
+                [tool_call.to_dict() for tool_call in call.tool_calls.tool_calls(0)] if call.tool_calls else []
+            )
+            reply = {"role": "assistant", "content": content or (None if tool_calls else "")}
+            if tool_calls:
+                reply["tool_calls"] = tool_calls
+            reply = normalize_message(reply)
+        self.conversation_store.store(
+            call.response_id, call.previous_response_id, call.conversation_messages + [reply]
+        )
+
+    def _assemble_tool_calls(self, call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk):
+        if call.tool_calls is None:
+            # The arguments are only parsed for the tool call hooks
+            call.tool_calls = ToolCallAssembler(
+                parse_json=self.parse_tool_call_arguments and bool(self.tool_call_hooks)
+            )
+        for tool_call in call.tool_calls.feed(upstream_chunk):
+            self._run_tool_call_hooks(call, tool_call)
+        return chunk
+
+    def _finish_tool_calls(self, call: ProxyCall) -> None:
+        # Only the tool calls of a stream that was read to the end are complete
+        if call.tool_calls is not None and call.completed:
+            for tool_call in call.tool_calls.finish():
+                self._run_tool_call_hooks(call, tool_call)
+
+    def _run_tool_call_hooks(self, call: ProxyCall, tool_call: AssembledToolCall) -> None:
+        for hook in self.tool_call_hooks:
+            hook(call, tool_call)
+
+    def _record_stream_usage(self, call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk):
+        # pylint: disable=unused-argument
+        usage = final_chunk_usage(upstream_chunk)
+        if usage is not None:
+            call.usage = usage
+        return chunk
+
+    @staticmethod
+    def _record_first_response(call: ProxyCall) -> None:
+        if startup_profile.awaiting_first_response and call.error is None:
+            startup_profile.first_response_served(call.started_at)
+
+    def _record_response_usage(self, call: ProxyCall) -> None:
+        usage = getattr(call.response, "usage", None) if call.response is not None else call.usage
+        if usage is not None:
+            if self.prompt_cache_stats is not None:
+                self.prompt_cache_stats.record_usage(usage)
+            if self.metrics is not None:
+                prompt_tokens, cached_tokens, cache_creation_tokens = prompt_cache_usage(usage)
+                labels = (call.target_model,)
+                self.metrics.prompt_tokens.inc(labels, prompt_tokens)
+                self.metrics.cached_tokens.inc(labels, cached_tokens)
+                self.metrics.cache_creation_tokens.inc(labels, cache_creation_tokens)
+        elif call.stream and call.completed:
+            # LiteLLM falls back to counting the tokens of the response locally
+            if self.prompt_cache_stats is not None:
+                self.prompt_cache_stats.record_missing_usage()
+            if self.metrics is not None:
+                self.metrics.usage_fallbacks.inc((call.target_model,))
+
+    def _sample_trace(self, call: ProxyCall) -> None:
+        call.traced = self.trace_policy.sample(call.target_model)
+
+    def _trace_request(self, call: ProxyCall) -> None:
+        if call.traced:
+            self._submit_request_trace(call)
+
+    @staticmethod
+    def _submit_request_trace(call: ProxyCall) -> None:
+        call.request_traced = True
+        if call.previous_response_id is not None:
+            # Only the new turn - the rest of the conversation is in the traces
+            # of the previous turns
+            trace_writer.submit(
+                write_request_trace,
+                timestamp=call.timestamp,
+                calling_method=call.calling_method,
+                messages_original=snapshot(call.messages_original),
+                params_complapi=snapshot(call.optional_params),
+                messages_respapi=snapshot(call.conversation_messages),
+                params_respapi={"previous_response_id": call.previous_response_id},
+            )
+            return
+        trace_writer.submit(
+            write_request_trace,
+            timestamp=call.timestamp,
+            calling_method=call.calling_method,
+            messages_original=snapshot(call.messages_original),
+            messages_complapi=snapshot(call.messages),
+            params_complapi=snapshot(call.optional_params),
+        )
+
+    @staticmethod
+    def _trace_chunk(call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk) -> OutputChunk:
+        if not call.traced:
+            return chunk
+        trace_session = call.trace_session
+        if trace_session is None:
+            trace_session = call.trace_session = StreamTraceSession(
+                timestamp=call.timestamp, calling_method=call.calling_method
+            )
+        trace_session.add_chunk(
+            complapi_chunk=upstream_chunk,
+            # In passthrough mode there are no generic chunks
+            generic_chunk=None if chunk is upstream_chunk else chunk,
+        )
+        return chunk
+
+    def _trace_response(self, call: ProxyCall) -> None:
+        if not call.traced:
+            # Failed calls are traced even if they weren't sampled (but not
+            # the ones the client walked away from)
+            if not isinstance(call.error, Exception) or not self.trace_policy.always_on_error:
+                return
+        if not call.request_traced:
+            # Not sampled, or failed before the request trace was written
+            # (the pre-upstream hooks)
+            self._submit_request_trace(call)
+
+        if call.trace_session is not None:
+            call.trace_session.close(error=call.error)
+        elif call.response is not None:
+            trace_writer.submit(
+                write_response_trace,
+                timestamp=call.timestamp,
+                calling_method=call.calling_method,
+                response_complapi=snapshot(call.response),
+            )
+        elif call.error is not None:
+            trace_writer.submit(
+                write_error_trace, timestamp=call.timestamp, calling_method=call.calling_method, error=repr(call.error)
+            )
+
+    @staticmethod
+    def _record_chunk_for_cache(call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk):
+        # pylint: disable=unused-argument
+        call.cache_recorder.add_chunk(chunk)
+        return chunk
+
+    @staticmethod
+    def _record_chunk_for_replay(call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk):
+        call.replay_recorder.add_chunk(upstream_chunk)
+        return chunk
+
+    @staticmethod
+    def _write_recording(call: ProxyCall) -> None:
+        # Only complete exchanges can be replayed
+        if not call.completed:
+            return
+        recording = {
+            "version": RECORDING_FORMAT_VERSION,
+            "timestamp": call.timestamp,
+            "calling_method": call.calling_method,
+            "target_model": call.target_model,
+            "messages": snapshot(call.messages),
+            "optional_params": snapshot(call.optional_params),
+            "stream": call.stream,
+            "duration": time.perf_counter() - call.upstream_started_at,
+        }
+        if call.stream:
+            recording.update(call.replay_recorder.to_cache_entry())
+        else:
+            recording.update(response_to_cache_entry(call.response))
+        trace_writer.submit(write_recording, timestamp=call.timestamp, recording=recording)
+
+    def _record_first_token(self, call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk):
+        # pylint: disable=unused-argument
+        if call.first_token_at is None:
+            call.first_token_at = time.perf_counter()
+            self.router.first_token(call.target_model, call.first_token_at - call.upstream_started_at)
+        return chunk
+
+    def _record_route_outcome(self, call: ProxyCall) -> None:
+        if call.upstream_started_at is None:
+            # Turned away before it was sent upstream - not routed
+            return
+        if not call.stream and call.completed:
+            # For non-streaming requests the whole response is the "first token"
+            self.router.first_token(call.target_model, time.perf_counter() - call.upstream_started_at)
+        elif call.first_token_at is None and call.error is not None and not isinstance(call.error, Exception):
+            # Cancelled before the first token (e.g. lost a hedged race) - the
+            # time so far is a lower bound of the target's TTFT, and without
+            # it a target that never wins would never look slow
+            self.router.first_token(call.target_model, time.perf_counter() - call.upstream_started_at)
+        # A client going away (GeneratorExit, CancelledError) is not the
+        # target's fault
+        self.router.finish(call.target_model, error=isinstance(call.error, Exception))
+
+    def _update_rate_limits(self, call: ProxyCall) -> None:
+        reservation = call.rate_limit_reservation
+        if reservation is None:
+            return
+        if isinstance(call.error, litellm.RateLimitError):
+            update, args = self.pacer.backoff, (reservation, retry_after_of(call.error))
+        else:
+            usage = call.usage if call.stream else getattr(call.response, "usage", None)
+            update, args = self.pacer.update, (reservation, call.response_headers, usage)
+
+        if call.is_async and self.pacer.shared_state is not None:
+            # The transaction may have to wait for the other workers - in a
+            # worker thread rather than on the event loop, and without holding
+            # up the response
+            task = asyncio.ensure_future(asyncio.to_thread(update, *args))
+            # Keep a reference, so that the task isn't garbage-collected
+            self._rate_limit_updates.add(task)
+            task.add_done_callback(self._rate_limit_updates.discard)
+        else:
+            update(*args)
+
+    def _observe_chunk(self, call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk):
+        # pylint: disable=unused-argument
+        now = time.perf_counter()
+        if call.last_chunk_at is None:
+            call.first_chunk_at = now
+            self.metrics.time_to_first_chunk.observe((call.target_model, call.calling_method), now - call.started_at)
+        else:
+            self.metrics.inter_chunk_gap.observe((call.target_model, call.calling_method), now - call.last_chunk_at)
+        call.last_chunk_at = now
+        call.chunk_count += 1
+        return chunk
+
+    def _observe_request(self, call: ProxyCall) -> None:
+        now = time.perf_counter()
+        labels = (call.target_model, call.calling_method)
+        if call.completed:
+            outcome = "success"
+        elif isinstance(call.error, Exception):
+            outcome = "error"
+        else:
+            # GeneratorExit, CancelledError (the client went away, a hedged
+            # attempt lost the race)
+            outcome = "cancelled"
+        self.metrics.requests.inc((*labels, outcome))
+        self.metrics.request_duration.observe(labels, now - call.started_at)
+        if not call.completed:
+            return
+
+        if call.stream:
+            # Streams without usage are measured in chunks (roughly a token each)
+            usage = call.usage
+            duration = (call.last_chunk_at or now) - (call.first_chunk_at or now)
+            tokens = getattr(usage, "completion_tokens", None) if usage is not None else call.chunk_count
+        else:
+            usage = getattr(call.response, "usage", None)
+            duration = now - call.started_at
+            tokens = getattr(usage, "completion_tokens", None)
+        if tokens and duration > 0:
+            self.metrics.tokens_per_second.observe(labels, tokens / duration)
+
+    def _store_in_cache(self, call: ProxyCall) -> None:
+        # Only complete responses are cached
+        if not call.completed:
+            return
+        if call.stream:
+            self.response_cache.set(call.request_key, call.cache_recorder.to_cache_entry())
+        else:
+            self.response_cache.set(call.request_key, response_to_cache_entry(call.response))
+
+
+class _IdentifiedChunk(dict):
+    """
+    A `GenericStreamingChunk` with an `id` attribute (that LiteLLM picks up
+    as the id of the response).
+    """
+
+    __slots__ = ("id",)
+
+    def __init__(self, chunk: GenericStreamingChunk, response_id: str) -> None:
+        super().__init__(chunk)
+        self.id = response_id
+
+
+def _response_headers(response: Any) -> Optional[dict]:
+    return (getattr(response, "_hidden_params", None) or {}).get("additional_headers")
+
+
+def _hook_name(hook: Callable) -> str:
+    return getattr(hook, "__name__", None) or type(hook).__name__
+
+
+def _to_sync(hook: Callable) -> Callable:
+    if not inspect.iscoroutinefunction(hook):
+        return hook
+
+    def _run_sync(*args):
+        return _run_coroutine_sync(hook(*args))
+
+    return _run_sync
+
+
+def _to_async(hook: Callable) -> Callable:
+    if inspect.iscoroutinefunction(hook):
+        return hook
+
+    async def _run_async(*args):
+        return hook(*args)
+
+    return _run_async
+
+
+def _run_coroutine_sync(coro: Awaitable) -> Any:
+    if not in_event_loop():
+        return asyncio.run(coro)
+    # The sync handlers are not supposed to be called from an event loop, but
+    # if they are, the coroutine can't be run on that (blocked) loop
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
+def _noop(call: ProxyCall) -> None:
+    # pylint: disable=unused-argument
+    pass
+
+
+async def _anoop(call: ProxyCall) -> None:
+    # pylint: disable=unused-argument
+    pass
+
+
+def _chain_call_hooks(hooks: list[Callable]) -> Callable[[ProxyCall], None]:
+    if not hooks:
+        return _noop
+    if len(hooks) == 1:
+        return hooks[0]
+    hooks = tuple(hooks)
+
+    def _run_hooks(call: ProxyCall) -> None:
+        for hook in hooks:
+            hook(call)
+
+    return _run_hooks
+
+
+def _achain_call_hooks(hooks: list[Callable]) -> Callable[[ProxyCall], Awaitable[None]]:
+    if not hooks:
+        return _anoop
+    if len(hooks) == 1:
+        return hooks[0]
+    hooks = tuple(hooks)
+
+    async def _arun_hooks(call: ProxyCall) -> None:
+        for hook in hooks:
+            await hook(call)
+
+    return _arun_hooks
+
+
+def _chain_chunk_hooks(hooks: list[Callable]) -> Optional[Callable]:
+    if not hooks:
+        return None
+    if len(hooks) == 1:
+        return hooks[0]
+    hooks = tuple(hooks)
+
+    def _run_chunk_hooks(call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk) -> OutputChunk:
+        for hook in hooks:
+            chunk = hook(call, upstream_chunk, chunk)
+        return chunk
+
+    return _run_chunk_hooks
+
+
+def _achain_chunk_hooks(hooks: list[Callable]) -> Optional[Callable]:
+    if not hooks:
+        return None
+    if len(hooks) == 1:
+        return hooks[0]
+    hooks = tuple(hooks)
+
+    async def _arun_chunk_hooks(
+        call: ProxyCall, upstream_chunk: ModelResponseStream, chunk: OutputChunk
+    ) -> OutputChunk:
+        for hook in hooks:
+            chunk = await hook(call, upstream_chunk, chunk)
+        return chunk
+
+    return _arun_chunk_hooks
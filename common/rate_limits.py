@@ -0,0 +1,470 @@
+import asyncio
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Iterator, Mapping, Optional
+
+from common.admission import AdmissionRejectedError
+from common.config import settings_section
+from common.shared_state import SharedState
+
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+class _Bucket:
+    """
+    A token bucket of one limit (requests or tokens) of an upstream quota.
+    The level may go below zero - the reservations that are waiting for the
+    bucket to refill.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ("capacity", "rate", "level", "updated_at", "consumed")
+
+    def __init__(self, capacity: float, window: float, now: float) -> None:
+        self.capacity = capacity
+        # Refill per second
+        self.rate = capacity / window
+        self.level = capacity
+        self.updated_at = now
+        # Everything reserved so far (to tell which reservations a snapshot
+        # from the response headers doesn't know about yet)
+        self.consumed = 0.0
+
+    @classmethod
+    def from_state(cls, state: list) -> "_Bucket":
+        bucket = cls.__new__(cls)
+        bucket.capacity, bucket.rate, bucket.level, bucket.updated_at, bucket.consumed = state
+        return bucket
+
+    def to_state(self) -> list:
+        return [self.capacity, self.rate, self.level, self.updated_at, self.consumed]
+
+    def refill(self, now: float) -> None:
+        # Another worker may have refilled the bucket a moment "later"
+        self.level = min(self.capacity, self.level + self.rate * max(now - self.updated_at, 0.0))
+        self.updated_at = max(now, self.updated_at)
+
+    def wait_time(self, cost: float) -> float:
+        if self.level >= cost:
+            return 0.0
+        return (cost - self.level) / self.rate
+
+    def consume(self, cost: float) -> None:
+        self.level -= cost
+        self.consumed += cost
+
+    def sync(self, capacity: float, remaining: float, consumed_since: float, window: float) -> None:
+        self.capacity = capacity
+        self.rate = capacity / window
+        self.level = min(capacity, remaining - consumed_since)
+
+
+class _Quota:
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self) -> None:
+        self.requests: Optional[_Bucket] = None
+        self.tokens: Optional[_Bucket] = None
+        self.paused_until = 0.0
+
+        self.paced = 0
+        self.pacing_time = 0.0
+        self.rejected = 0
+        self.upstream_rate_limited = 0
+
+    def to_state(self) -> dict[str, Any]:
+        return {
+            "requests": None if self.requests is None else self.requests.to_state(),
+            "tokens": None if self.tokens is None else self.tokens.to_state(),
+            "paused_until": self.paused_until,
+        }
+
+    def restore(self, state: dict[str, Any]) -> None:
+        for kind in ("requests", "tokens"):
+            setattr(self, kind, None if state[kind] is None else _Bucket.from_state(state[kind]))
+        self.paused_until = state["paused_until"]
+
+
+class RateLimitReservation:
+    """
+    The share of an upstream quota taken by one request.
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ("bucket", "estimated_tokens", "delay", "requests_mark", "tokens_mark")
+
+    def __init__(self, bucket: str, estimated_tokens: int, delay: float) -> None:
+        self.bucket = bucket
+        self.estimated_tokens = estimated_tokens
+        self.delay = delay
+        # `consumed` of the buckets right after the reservation (None - the
+        # limit wasn't known yet)
+        self.requests_mark: Optional[float] = None
+        self.tokens_mark: Optional[float] = None
+
+
+class RateLimitPacer:
+    """
+    Paces the upstream calls so that they stay under the rate limits of the
+    upstream quotas, rather than finding out about the limits from failed
+    calls (and making things worse by retrying them).
+
+    Every quota (one per target by default - a model behind an API key) is
+    modelled with two token buckets, requests and tokens, that refill over
+    `window` seconds. The buckets are synced with the `x-ratelimit-*` headers
+    of the upstream responses (`anthropic-ratelimit-*` too) - or set up from
+    `requests_per_minute` / `tokens_per_minute`, if the limits are known in
+    advance. Every call reserves one request and its estimated tokens (the
+    prompt, estimated from its length, plus `max_tokens`) and waits until
+    the buckets have them. A call that would have to wait longer than
+    `max_wait` seconds is rejected right away with a 429 (see
+    `AdmissionRejectedError`). An upstream 429 pauses the whole quota for
+    its `Retry-After`.
+
+    With `shared_state` (see `common/shared_state.py`), the buckets are
+    shared by the workers of a multi-worker server, so that together they
+    stay under the limits (the counters of `stats()` are per worker).
+
+    Configured in the `rate_limits` section of the handler settings in
+    `config.yaml` (targets with a common `bucket` share a quota):
+
+    ```yaml
+    rate_limits:
+      max_wait: 30
+      targets:
+        openai/gpt-4o:
+          tokens_per_minute: 30000
+        openai/gpt-4o-mini:
+          bucket: openai
+    ```
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        *,
+        max_wait: float = 30.0,
+        window: float = 60.0,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        chars_per_token: float = 4.0,
+        default_completion_tokens: int = 256,
+        default_retry_after: float = 1.0,
+        targets: Optional[dict[str, dict[str, Any]]] = None,
+        shared_state: Optional[SharedState] = None,
+    ) -> None:
+        # pylint: disable=too-many-arguments
+        self.max_wait = max_wait
+        self.window = window
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.chars_per_token = chars_per_token
+        self.default_completion_tokens = default_completion_tokens
+        self.default_retry_after = default_retry_after
+        self.target_settings = dict(targets or {})
+
+        self.shared_state = shared_state
+
+        self._quotas: dict[str, _Quota] = {}
+        self._lock = threading.Lock()
+        if shared_state is None:
+            self._clock = time.monotonic
+        else:
+            # The only clock the workers have in common
+            self._clock = time.time
+            shared_state.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_quotas (bucket TEXT PRIMARY KEY, state TEXT NOT NULL)"
+            )
+
+    @classmethod
+    def from_settings(
+        cls, settings: Optional[dict[str, Any]], shared_state: Optional[SharedState] = None
+    ) -> Optional["RateLimitPacer"]:
+        """
+        None (no pacing) if the `rate_limits` section is missing or has
+        `enabled: false`.
+        """
+        settings = settings_section(settings)
+        if settings is None:
+            return None
+        return cls(**settings, shared_state=shared_state)
+
+    def bucket_of(self, target: str) -> str:
+        return (self.target_settings.get(target) or {}).get("bucket") or target
+
+    def estimate_tokens(self, messages: list, optional_params: dict) -> int:
+        """
+        The prompt tokens estimated from the length of the messages (a
+        tokenizer would cost more than the estimate is off by), plus the
+        completion tokens the request may use - which is what providers
+        count against the token limits when they admit a request.
+        """
+        chars = 0
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                chars += len(content)
+            elif isinstance(content, list):
+                chars += sum(len(part.get("text") or "") for part in content if isinstance(part, dict))
+            # Roles and the other per-message overhead
+            chars += 16
+        max_tokens = optional_params.get("max_completion_tokens") or optional_params.get("max_tokens")
+        return int(chars / self.chars_per_token) + int(max_tokens or self.default_completion_tokens)
+
+    def reserve(self, target: str, messages: list, optional_params: dict) -> RateLimitReservation:
+        """
+        Take one request and the estimated tokens of a call from the quota of
+        `target`. The call has to wait `reservation.delay` seconds before it
+        is sent (see `pace()` / `apace()`).
+        """
+        bucket = self.bucket_of(target)
+        estimated_tokens = self.estimate_tokens(messages, optional_params)
+        with self._locked_quota(bucket, target) as (quota, now):
+            delay = max(quota.paused_until - now, 0.0)
+            for limit, cost in ((quota.requests, 1), (quota.tokens, estimated_tokens)):
+                if limit is not None:
+                    limit.refill(now)
+                    delay = max(delay, limit.wait_time(cost))
+
+            if delay > self.max_wait:
+                quota.rejected += 1
+                raise AdmissionRejectedError(
+                    f"The rate limits of {bucket} would hold the request for {delay:.1f} seconds",
+                    model=target,
+                    retry_after=delay,
+                    reason="rate_limit",
+                )
+
+            reservation = RateLimitReservation(bucket, estimated_tokens, delay)
+            if quota.requests is not None:
+                quota.requests.consume(1)
+                reservation.requests_mark = quota.requests.consumed
+            if quota.tokens is not None:
+                quota.tokens.consume(estimated_tokens)
+                reservation.tokens_mark = quota.tokens.consumed
+            if delay > 0:
+                quota.paced += 1
+                quota.pacing_time += delay
+        return reservation
+
+    def pace(self, target: str, messages: list, optional_params: dict) -> RateLimitReservation:
+        """
+        `reserve()` and wait (blocking the thread) until the call can be sent.
+        """
+        reservation = self.reserve(target, messages, optional_params)
+        if reservation.delay > 0:
+            time.sleep(reservation.delay)
+        return reservation
+
+    async def areserve(self, target: str, messages: list, optional_params: dict) -> RateLimitReservation:
+        """
+        `reserve()` - with `shared_state`, in a worker thread, since its
+        transaction may have to wait for the other workers to release the
+        write lock (which would block the event loop).
+        """
+        if self.shared_state is None:
+            return self.reserve(target, messages, optional_params)
+        return await asyncio.to_thread(self.reserve, target, messages, optional_params)
+
+    async def apace(self, target: str, messages: list, optional_params: dict) -> RateLimitReservation:
+        """
+        `areserve()` and wait until the call can be sent.
+        """
+        reservation = await self.areserve(target, messages, optional_params)
+        if reservation.delay > 0:
+            await asyncio.sleep(reservation.delay)
+        return reservation
+
+    def update(
+        self, reservation: RateLimitReservation, headers: Optional[Mapping[str, Any]], usage: Optional[Any] = None
+    ) -> None:
+        """
+        Sync the quota of a call with the rate limit headers of its response.
+        Without token headers, the estimate of the call is corrected with the
+        usage reported by the response instead.
+        """
+        limits = parse_rate_limit_headers(headers or {})
+        with self._locked_quota(reservation.bucket) as (quota, now):
+            for kind, mark in (("requests", reservation.requests_mark), ("tokens", reservation.tokens_mark)):
+                limit = limits.get(kind)
+                if limit is None or limit[0] is None or limit[1] is None:
+                    continue
+                capacity, remaining, reset = limit
+                bucket = getattr(quota, kind)
+                if bucket is None:
+                    bucket = _Bucket(capacity, self.window, now)
+                    setattr(quota, kind, bucket)
+                bucket.refill(now)
+                # The calls reserved after this one are not in the snapshot yet
+                bucket.sync(capacity, remaining, 0.0 if mark is None else bucket.consumed - mark, self.window)
+                if remaining <= 0 and reset:
+                    quota.paused_until = max(quota.paused_until, now + reset)
+
+            total_tokens = getattr(usage, "total_tokens", None)
+            if "tokens" not in limits and quota.tokens is not None and total_tokens:
+                quota.tokens.level -= total_tokens - reservation.estimated_tokens
+
+    def backoff(self, reservation: RateLimitReservation, retry_after: Optional[float]) -> None:
+        """
+        The upstream rejected a call with a 429 - pause the whole quota.
+        """
+        with self._locked_quota(reservation.bucket) as (quota, now):
+            quota.upstream_rate_limited += 1
+            quota.paused_until = max(quota.paused_until, now + (retry_after or self.default_retry_after))
+            for bucket in (quota.requests, quota.tokens):
+                if bucket is not None:
+                    bucket.refill(now)
+                    bucket.level = min(bucket.level, 0.0)
+
+    def remaining(self) -> dict[tuple[str, str], float]:
+        """
+        (bucket, "requests" / "tokens") -> the estimated remaining quota
+        """
+        result = {}
+        for name in list(self._quotas):
+            with self._locked_quota(name) as (quota, now):
+                for kind in ("requests", "tokens"):
+                    bucket = getattr(quota, kind)
+                    if bucket is not None:
+                        bucket.refill(now)
+                        result[(name, kind)] = bucket.level
+        return result
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        stats = {}
+        for name in list(self._quotas):
+            with self._locked_quota(name) as (quota, now):
+                stats[name] = {
+                    "paced": quota.paced,
+                    "pacing_time": quota.pacing_time,
+                    "rejected": quota.rejected,
+                    "upstream_rate_limited": quota.upstream_rate_limited,
+                    "paused_for": max(quota.paused_until - now, 0.0),
+                }
+                for kind in ("requests", "tokens"):
+                    bucket = getattr(quota, kind)
+                    if bucket is not None:
+                        bucket.refill(now)
+                        stats[name][f"{kind}_limit"] = bucket.capacity
+                        stats[name][f"{kind}_remaining"] = bucket.level
+        return stats
+
+    @contextmanager
+    def _locked_quota(self, bucket: str, target: Optional[str] = None) -> Iterator[tuple[_Quota, float]]:
+        """
+        The quota of `bucket` and the current time, locked for the duration of
+        the `with` block (across the workers, with `shared_state`).
+        """
+        with self._lock:
+            if self.shared_state is None:
+                now = self._clock()
+                yield self._quota(target or bucket, bucket, now), now
+                return
+
+            with self.shared_state.transaction() as conn:
+                row = conn.execute("SELECT state FROM rate_limit_quotas WHERE bucket = ?", (bucket,)).fetchone()
+                now = self._clock()
+                quota = self._quota(target or bucket, bucket, now)
+                if row is not None:
+                    quota.restore(json.loads(row[0]))
+                yield quota, now
+                conn.execute(
+                    "INSERT OR REPLACE INTO rate_limit_quotas (bucket, state) VALUES (?, ?)",
+                    (bucket, json.dumps(quota.to_state())),
+                )
+
+    def _quota(self, target: str, bucket: str, now: float) -> _Quota:
+        quota = self._quotas.get(bucket)
+        if quota is None:
+            quota = self._quotas[bucket] = _Quota()
+            settings = self.target_settings.get(target) or {}
+            requests_per_minute = settings.get("requests_per_minute", self.requests_per_minute)
+            tokens_per_minute = settings.get("tokens_per_minute", self.tokens_per_minute)
+            # The limits are per minute, whatever the window of the buckets
+            if requests_per_minute:
+                quota.requests = _Bucket(requests_per_minute * self.window / 60, self.window, now)
+            if tokens_per_minute:
+                quota.tokens = _Bucket(tokens_per_minute * self.window / 60, self.window, now)
+        return quota
+
+
+def parse_rate_limit_headers(headers: Mapping[str, Any]) -> dict[str, tuple[Optional[float], Optional[float], float]]:
+    """
+    "requests" / "tokens" -> (limit, remaining, seconds until reset) from the
+    rate limit headers of an upstream response - either the raw ones or the
+    ones LiteLLM puts into `_hidden_params["additional_headers"]` (prefixed
+    with `llm_provider-`).
+    """
+    headers = {str(name).lower(): value for name, value in headers.items()}
+    limits = {}
+    for kind in ("requests", "tokens"):
+        limit, remaining, reset = (
+            _rate_limit_header(headers, kind, field) for field in ("limit", "remaining", "reset")
+        )
+        if limit is None and remaining is None:
+            continue
+        limits[kind] = (_to_float(limit), _to_float(remaining), parse_reset(reset))
+    return limits
+
+
+def _rate_limit_header(headers: dict[str, Any], kind: str, field: str) -> Optional[Any]:
+    for name in (
+        f"x-ratelimit-{field}-{kind}",
+        f"llm_provider-x-ratelimit-{field}-{kind}",
+        f"anthropic-ratelimit-{kind}-{field}",
+        f"llm_provider-anthropic-ratelimit-{kind}-{field}",
+    ):
+        value = headers.get(name)
+        if value is not None:
+            return value
+    return None
+
+
+def parse_reset(value: Any) -> float:
+    """
+    Seconds until a rate limit resets, from either a duration (`6m0s`,
+    `20ms`, `1.5`) or a point in time (`2024-01-01T00:00:30Z`).
+    """
+    if value is None:
+        return 0.0
+    value = str(value).strip()
+    number = _to_float(value)
+    if number is not None:
+        return max(number, 0.0)
+    parts = _DURATION_PART.findall(value)
+    if parts:
+        units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+        return sum(float(amount) * units[unit] for amount, unit in parts)
+    try:
+        reset_at = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return 0.0
+    if reset_at.tzinfo is None:
+        reset_at = reset_at.replace(tzinfo=timezone.utc)
+    return max((reset_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def retry_after_of(error: BaseException) -> Optional[float]:
+    """
+    The `Retry-After` of an upstream rate limit error (if it has one).
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(
+        error, "litellm_response_headers", None
+    )
+    value = (headers or {}).get("retry-after")
+    return None if value is None else parse_reset(value)
+
+
+def _to_float(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
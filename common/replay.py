@@ -0,0 +1,270 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+from pathlib import Path
+from typing import AsyncGenerator, Callable, Generator, Iterable, Iterator, Optional, Sequence, Union
+
+import httpx
+from litellm import AsyncHTTPHandler, CustomLLM, HTTPHandler, ModelResponse, ModelResponseStream
+
+from common.config import TRACES_DIR, load_handler_settings
+from common.response_cache import areplay_stream, make_cache_key, replay_stream, response_from_cache_entry
+from common.utils import ProxyError
+
+
+RECORDING_FORMAT_VERSION = 1
+RECORDING_FILE_SUFFIX = "_RECORDING.json"
+
+
+def recording_key(messages: list, stream: bool) -> str:
+    """
+    Recordings are matched by the messages that were sent upstream (the model
+    and the params of the replay provider may differ from the recorded ones).
+    """
+    return make_cache_key(target_model="", messages=messages, optional_params={}, stream=stream)
+
+
+def write_recording(*, timestamp: str, recording: dict) -> None:
+    """
+    Write one recorded upstream exchange (see `ProxyLLM(write_recordings=...)`)
+    to `<timestamp>_RECORDING.json`. Meant to run on the trace writer thread.
+    """
+    TRACES_DIR.mkdir(parents=True, exist_ok=True)
+    with (TRACES_DIR / f"{timestamp}{RECORDING_FILE_SUFFIX}").open("w", encoding="utf-8") as f:
+        json.dump(recording, f, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def load_recordings(paths: Iterable[Union[str, Path]]) -> list[dict]:
+    """
+    Load recordings from files and folders (every `*_RECORDING.json` in them),
+    in the order they were recorded in.
+    """
+    files: list[Path] = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files.extend(sorted(path.glob(f"*{RECORDING_FILE_SUFFIX}")))
+        else:
+            files.append(path)
+
+    recordings = []
+    for file in files:
+        with file.open(encoding="utf-8") as f:
+            recording = json.load(f)
+        if recording.get("version") != RECORDING_FORMAT_VERSION:
+            raise ValueError(f"Unsupported recording format version in {file}: {recording.get('version')!r}")
+        recordings.append(recording)
+    return recordings
+
+
+class ReplayLLM(CustomLLM):
+    # pylint: disable=too-many-positional-arguments,too-many-arguments,too-many-instance-attributes,too-many-locals
+    """
+    A stand-in for an upstream provider that serves recorded responses and
+    streams (see `WRITE_RECORDINGS`) instead of calling a real model - for
+    load-testing and profiling the proxy with the shapes of real traffic,
+    offline and for free.
+
+    - `match: exact` - a request gets a recording of the same messages (if
+      there are several, they are served in turn); unmatched requests are
+      either an error (`on_miss: error`) or get the next recording in order
+      (`on_miss: sequential`)
+    - `match: sequential` - all the recordings are served in the order they
+      were recorded in, regardless of the requests (round and round)
+
+    Streams are replayed with the original timing of the chunks (including
+    the time to the first one) scaled by `pacing` (1.0 - the original speed,
+    0.5 - twice as fast, 0 - no delays at all). Non-streamed responses are
+    delayed by their original duration times `pacing`.
+
+    Configured in the `replay` section of `proxy_handler_settings`:
+
+    ```yaml
+    replay:
+      paths:
+        - .traces
+      match: exact
+      on_miss: sequential
+      pacing: 1.0
+    ```
+    """
+
+    def __init__(
+        self,
+        *,
+        recordings: Optional[Sequence[dict]] = None,
+        paths: Sequence[Union[str, Path]] = (TRACES_DIR,),
+        match: str = "exact",
+        on_miss: str = "sequential",
+        pacing: float = 1.0,
+        **kwargs,
+    ) -> None:
+        super().__init__(**kwargs)
+        if match not in ("exact", "sequential"):
+            raise ValueError(f"Unknown match mode: {match!r} (expected 'exact' or 'sequential')")
+        if on_miss not in ("error", "sequential"):
+            raise ValueError(f"Unknown on_miss policy: {on_miss!r} (expected 'error' or 'sequential')")
+        self.paths = tuple(paths)
+        self.match = match
+        self.on_miss = on_miss
+        self.pacing = pacing
+
+        self._recordings = None if recordings is None else list(recordings)
+        # Built lazily, so that importing the handler doesn't load the
+        # recordings of a provider nobody uses
+        self._by_key: Optional[dict[str, Iterator[dict]]] = None
+        self._sequences: dict[bool, Iterator[dict]] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        return {"recordings": len(self._recordings or ()), "hits": self.hits, "misses": self.misses}
+
+    def completion(
+        self,
+        model: str,
+        messages: list,
+        api_base: str,
+        custom_prompt_dict: dict,
+        model_response: ModelResponse,
+        print_verbose: Callable,
+        encoding,
+        api_key,
+        logging_obj,
+        optional_params: dict,
+        acompletion=None,
+        litellm_params=None,
+        logger_fn=None,
+        headers=None,
+        timeout: Optional[Union[float, httpx.Timeout]] = None,
+        client: Optional[HTTPHandler] = None,
+    ) -> ModelResponse:
+        try:
+            recording = self._next_recording(messages, stream=False)
+            delay = recording["duration"] * self.pacing
+            if delay > 0:
+                time.sleep(delay)
+            return response_from_cache_entry(recording)
+
+        except Exception as e:
+            raise ProxyError(e) from e
+
+    async def acompletion(
+        self,
+        model: str,
+        messages: list,
+        api_base: str,
+        custom_prompt_dict: dict,
+        model_response: ModelResponse,
+        print_verbose: Callable,
+        encoding,
+        api_key,
+        logging_obj,
+        optional_params: dict,
+        acompletion=None,
+        litellm_params=None,
+        logger_fn=None,
+        headers=None,
+        timeout: Optional[Union[float, httpx.Timeout]] = None,
+        client: Optional[AsyncHTTPHandler] = None,
+    ) -> ModelResponse:
+        try:
+            recording = self._next_recording(messages, stream=False)
+            delay = recording["duration"] * self.pacing
+            if delay > 0:
+                await asyncio.sleep(delay)
+            return response_from_cache_entry(recording)
+
+        except Exception as e:
+            raise ProxyError(e) from e
+
+    def streaming(
+        self,
+        model: str,
+        messages: list,
+        api_base: str,
+        custom_prompt_dict: dict,
+        model_response: ModelResponse,
+        print_verbose: Callable,
+        encoding,
+        api_key,
+        logging_obj,
+        optional_params: dict,
+        acompletion=None,
+        litellm_params=None,
+        logger_fn=None,
+        headers=None,
+        timeout: Optional[Union[float, httpx.Timeout]] = None,
+        client: Optional[HTTPHandler] = None,
+    ) -> Generator[ModelResponseStream, None, None]:
+        try:
+            yield from replay_stream(self._next_recording(messages, stream=True), pacing=self.pacing)
+
+        except Exception as e:
+            raise ProxyError(e) from e
+
+    async def astreaming(
+        self,
+        model: str,
+        messages: list,
+        api_base: str,
+        custom_prompt_dict: dict,
+        model_response: ModelResponse,
+        print_verbose: Callable,
+        encoding,
+        api_key,
+        logging_obj,
+        optional_params: dict,
+        acompletion=None,
+        litellm_params=None,
+        logger_fn=None,
+        headers=None,
+        timeout: Optional[Union[float, httpx.Timeout]] = None,
+        client: Optional[AsyncHTTPHandler] = None,
+    ) -> AsyncGenerator[ModelResponseStream, None]:
+        try:
+            async for chunk in areplay_stream(self._next_recording(messages, stream=True), pacing=self.pacing):
+                yield chunk
+
+        except Exception as e:
+            raise ProxyError(e) from e
+
+    def _next_recording(self, messages: list, *, stream: bool) -> dict:
+        with self._lock:
+            if self._by_key is None:
+                self._index_recordings()
+
+            if self.match == "exact":
+                matching = self._by_key.get(recording_key(messages, stream))
+                if matching is not None:
+                    self.hits += 1
+                    return next(matching)
+                self.misses += 1
+                if self.on_miss == "error":
+                    raise ValueError(f"None of the {len(self._recordings)} recordings matches the request")
+
+            sequence = self._sequences.get(stream)
+            if sequence is None:
+                raise ValueError(f"There are no recordings of {'streamed' if stream else 'non-streamed'} responses")
+            return next(sequence)
+
+    def _index_recordings(self) -> None:
+        if self._recordings is None:
+            self._recordings = load_recordings(self.paths)
+
+        by_key: dict[str, list[dict]] = {}
+        by_stream: dict[bool, list[dict]] = {}
+        for recording in self._recordings:
+            stream = recording["stream"]
+            by_key.setdefault(recording_key(recording["messages"], stream), []).append(recording)
+            by_stream.setdefault(stream, []).append(recording)
+
+        self._by_key = {key: itertools.cycle(matching) for key, matching in by_key.items()}
+        self._sequences = {stream: itertools.cycle(sequence) for stream, sequence in by_stream.items()}
+
+
+replay_llm = ReplayLLM(**load_handler_settings("replay"))
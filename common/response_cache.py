@@ -0,0 +1,237 @@
+import asyncio
+import hashlib
+import json
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import AsyncGenerator, Generator, Optional, Union
+
+from litellm import GenericStreamingChunk, ModelResponse, ModelResponseStream
+
+from common.config import (
+    RESPONSE_CACHE,
+    RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_PATH,
+    RESPONSE_CACHE_TTL_SECONDS,
+)
+from common.lru_store import InMemoryLRUStore, LRUStore, SQLiteLRUStore, create_lru_store
+
+
+# Parameters that don't affect the content of the response
+_PARAMS_EXCLUDED_FROM_KEY = frozenset(("stream", "stream_options"))
+
+
+def make_cache_key(*, target_model: str, messages: list, optional_params: dict, stream: bool) -> str:
+    """
+    Canonical hash of an upstream request: the same model, messages and
+    params always produce the same key, regardless of the order of dict keys.
+    """
+    payload = {
+        "target_model": target_model,
+        "messages": messages,
+        "optional_params": {k: v for k, v in optional_params.items() if k not in _PARAMS_EXCLUDED_FROM_KEY},
+        "stream": stream,
+    }
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(LRUStore, ABC):
+    """
+    Base class of exact-match response caches. Entries are JSON-serializable
+    dicts (see `response_to_cache_entry` and `StreamCacheRecorder`).
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key: str, entry: dict) -> None:
+        raise NotImplementedError
+
+    def warm_up(self) -> None:
+        """
+        Prepare the cache for the first requests (see `common/startup.py`).
+        """
+
+
+class InMemoryResponseCache(ResponseCache, InMemoryLRUStore):
+    """
+    LRU cache with a TTL, local to the process.
+    """
+
+    def __init__(
+        self, *, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS
+    ) -> None:
+        super().__init__(max_entries=max_entries, ttl_seconds=ttl_seconds)
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def set(self, key: str, entry: dict) -> None:
+        with self._lock:
+            self._set_entry(key, entry)
+
+
+class SQLiteResponseCache(ResponseCache, SQLiteLRUStore):
+    """
+    LRU cache with a TTL, persisted in a local SQLite database (survives
+    restarts).
+    """
+
+    def __init__(
+        self,
+        *,
+        path: Union[str, Path] = RESPONSE_CACHE_PATH,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+    ) -> None:
+        super().__init__(
+            path=path,
+            table="response_cache",
+            key_column="key",
+            lru_column="accessed_at",
+            max_entries=max_entries,
+            ttl_seconds=ttl_seconds,
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY,"
+            " entry TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL"
+            ")"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_cache_accessed_at ON response_cache (accessed_at)")
+
+    def warm_up(self) -> None:
+        # Reads the whole database, so that it's in the OS page cache
+        with self._lock:
+            self._conn.execute("SELECT COUNT(*), SUM(LENGTH(entry)) FROM response_cache").fetchone()
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT entry, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            entry, expires_at = row
+            if expires_at <= now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(entry)
+
+    def set(self, key: str, entry: dict) -> None:
+        now = time.time()
+        serialized = json.dumps(entry, separators=(",", ":"), default=str)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, entry, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, serialized, now + self.ttl_seconds, now),
+            )
+            self._evict_excess()
+
+
+def create_response_cache(backend: str = RESPONSE_CACHE) -> Optional[ResponseCache]:
+    """
+    Create the response cache configured via the `RESPONSE_CACHE` env var
+    ("memory", "sqlite" or empty for no caching).
+    """
+    return create_lru_store(
+        backend,
+        env_var="RESPONSE_CACHE",
+        kind="response cache",
+        in_memory=InMemoryResponseCache,
+        sqlite=SQLiteResponseCache,
+    )
+
+
+def response_to_cache_entry(response: ModelResponse) -> dict:
+    return {"response": response.model_dump(mode="json")}
+
+
+def response_from_cache_entry(entry: dict) -> ModelResponse:
+    return ModelResponse(**entry["response"])
+
+
+class StreamCacheRecorder:
+    """
+    Collects the chunks of a stream (together with their timing) so that the
+    stream can be replayed from the cache later. Only complete streams should
+    be stored - call `to_cache_entry()` after the stream was fully consumed.
+    """
+
+    def __init__(self) -> None:
+        self._started_at = time.monotonic()
+        self._chunks: list[dict] = []
+        self._offsets: list[float] = []
+        self._passthrough = False
+
+    def add_chunk(self, chunk: Union[GenericStreamingChunk, ModelResponseStream]) -> None:
+        self._offsets.append(time.monotonic() - self._started_at)
+        if isinstance(chunk, ModelResponseStream):
+            self._passthrough = True
+            self._chunks.append(chunk.model_dump(mode="json"))
+        else:
+            self._chunks.append(dict(chunk))
+
+    def to_cache_entry(self) -> dict:
+        return {
+            "chunk_type": "model_response_stream" if self._passthrough else "generic",
+            "chunks": self._chunks,
+            "offsets": self._offsets,
+        }
+
+
+def _restore_chunk(entry: dict, chunk: dict) -> Union[GenericStreamingChunk, ModelResponseStream]:
+    if entry["chunk_type"] == "model_response_stream":
+        return ModelResponseStream(**chunk)
+    # A copy, so that whatever LiteLLM does with the chunk doesn't affect the
+    # cached entry
+    return GenericStreamingChunk(**chunk)
+
+
+def replay_stream(
+    entry: dict, *, pacing: float = 0.0
+) -> Generator[Union[GenericStreamingChunk, ModelResponseStream], None, None]:
+    """
+    Replay a cached stream. With `pacing` > 0 the chunks are spaced out
+    according to the original timing (scaled by `pacing`, i.e. 1.0 means the
+    original speed), otherwise they are yielded as fast as they are consumed.
+    """
+    started_at = time.monotonic()
+    for chunk, offset in zip(entry["chunks"], entry["offsets"]):
+        if pacing > 0:
+            delay = started_at + offset * pacing - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield _restore_chunk(entry, chunk)
+
+
+async def areplay_stream(
+    entry: dict, *, pacing: float = 0.0
+) -> AsyncGenerator[Union[GenericStreamingChunk, ModelResponseStream], None]:
+    """
+    Async version of `replay_stream`.
+    """
+    started_at = time.monotonic()
+    for chunk, offset in zip(entry["chunks"], entry["offsets"]):
+        if pacing > 0:
+            delay = started_at + offset * pacing - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield _restore_chunk(entry, chunk)
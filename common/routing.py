@@ -0,0 +1,199 @@
+import hashlib
+import json
+import random
+import threading
+from collections import OrderedDict
+from typing import Any, Iterable, Optional, Sequence
+
+from common.config import settings_section
+
+
+class _TargetStats:
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self) -> None:
+        # None until the first measurement
+        self.ttft_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+
+
+class TargetRouter:
+    """
+    Routes every request to one of several equivalent upstream targets, based
+    on live measurements of every target:
+      - an EWMA of the time to first token (the whole response time for
+        non-streaming requests)
+      - an EWMA of the error rate
+      - the number of requests in flight
+
+    The expected latency of a target is its TTFT multiplied by the number of
+    requests it would be serving, plus `error_penalty` seconds times its error
+    rate. Targets without measurements yet are assumed to be as fast as the
+    average of the measured ones. A small share of requests (`explore_ratio`)
+    goes to a random target, so that the measurements of the targets that are
+    out of favour keep getting updated.
+
+    With `sticky=True` all the turns of a conversation (recognized by the
+    messages up to the first user message) go to the same target, so that its
+    prompt cache stays warm - unless that target got `sticky_tolerance` times
+    slower than the best one or fails more than half of the time. Another
+    attempt at a request that excludes the target of its conversation (a
+    hedged one) goes elsewhere, but the conversation stays with its target.
+
+    Configured in the `routing` section of the handler settings in
+    `config.yaml`:
+
+    ```yaml
+    routing:
+      targets:
+        - openai/gpt-4o
+        - azure/gpt-4o
+      sticky: true
+    ```
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(
+        self,
+        targets: Sequence[str],
+        *,
+        ewma_alpha: float = 0.2,
+        error_penalty: float = 10.0,
+        explore_ratio: float = 0.05,
+        sticky: bool = True,
+        sticky_tolerance: float = 2.0,
+        sticky_max_conversations: int = 10000,
+    ) -> None:
+        # pylint: disable=too-many-arguments
+        if not targets:
+            raise ValueError("TargetRouter needs at least one target")
+        self.targets = tuple(targets)
+        self.ewma_alpha = ewma_alpha
+        self.error_penalty = error_penalty
+        self.explore_ratio = explore_ratio
+        self.sticky = sticky
+        self.sticky_tolerance = sticky_tolerance
+        self.sticky_max_conversations = sticky_max_conversations
+
+        self._stats = {target: _TargetStats() for target in self.targets}
+        # conversation key -> target
+        self._conversations: OrderedDict[str, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.sticky_hits = 0
+        self.sticky_reroutes = 0
+
+    @classmethod
+    def from_settings(cls, settings: Optional[dict[str, Any]]) -> Optional["TargetRouter"]:
+        """
+        None if the `routing` section is missing or has `enabled: false` (the
+        handler's own `target_model` is used for every request).
+        """
+        settings = settings_section(settings)
+        if settings is None:
+            return None
+        return cls(settings.pop("targets", None) or [], **settings)
+
+    def choose(self, messages: list, *, exclude: Iterable[str] = ()) -> str:
+        exclude = frozenset(exclude)
+        candidates = [target for target in self.targets if target not in exclude] or list(self.targets)
+        conversation_key = _conversation_key(messages) if self.sticky else None
+
+        with self._lock:
+            scores = self._scores(candidates)
+            best = min(candidates, key=scores.__getitem__)
+            if len(candidates) > 1 and random.random() < self.explore_ratio:
+                best = random.choice(candidates)
+
+            if conversation_key is None:
+                return best
+
+            sticky_target = self._conversations.get(conversation_key)
+            if sticky_target in exclude and sticky_target not in scores:
+                # Only this attempt goes elsewhere
+                return best
+            if sticky_target in scores and self._is_healthy(sticky_target, scores, best):
+                self._conversations.move_to_end(conversation_key)
+                self.sticky_hits += 1
+                return sticky_target
+
+            if sticky_target is not None:
+                # Unhealthy - the conversation moves on to the best target
+                self.sticky_reroutes += 1
+            self._conversations[conversation_key] = best
+            self._conversations.move_to_end(conversation_key)
+            while len(self._conversations) > self.sticky_max_conversations:
+                self._conversations.popitem(last=False)
+            return best
+
+    def start(self, target: str) -> None:
+        with self._lock:
+            stats = self._stats[target]
+            stats.in_flight += 1
+            stats.requests += 1
+
+    def first_token(self, target: str, ttft_seconds: float) -> None:
+        with self._lock:
+            stats = self._stats[target]
+            if stats.ttft_ewma is None:
+                stats.ttft_ewma = ttft_seconds
+            else:
+                stats.ttft_ewma += self.ewma_alpha * (ttft_seconds - stats.ttft_ewma)
+
+    def finish(self, target: str, *, error: bool) -> None:
+        with self._lock:
+            stats = self._stats[target]
+            stats.in_flight -= 1
+            if error:
+                stats.errors += 1
+            stats.error_rate += self.ewma_alpha * ((1.0 if error else 0.0) - stats.error_rate)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "targets": {
+                    target: {
+                        "ttft_ewma_ms": None if stats.ttft_ewma is None else stats.ttft_ewma * 1000,
+                        "error_rate": stats.error_rate,
+                        "in_flight": stats.in_flight,
+                        "requests": stats.requests,
+                        "errors": stats.errors,
+                    }
+                    for target, stats in self._stats.items()
+                },
+                "sticky_conversations": len(self._conversations),
+                "sticky_hits": self.sticky_hits,
+                "sticky_reroutes": self.sticky_reroutes,
+            }
+
+    def _scores(self, candidates: list[str]) -> dict[str, float]:
+        measured = [self._stats[t].ttft_ewma for t in candidates if self._stats[t].ttft_ewma is not None]
+        default_ttft = sum(measured) / len(measured) if measured else 0.0
+
+        scores = {}
+        for target in candidates:
+            stats = self._stats[target]
+            ttft = default_ttft if stats.ttft_ewma is None else stats.ttft_ewma
+            scores[target] = ttft * (1 + stats.in_flight) + stats.error_rate * self.error_penalty
+        return scores
+
+    def _is_healthy(self, target: str, scores: dict[str, float], best: str) -> bool:
+        if self._stats[target].error_rate > 0.5:
+            return False
+        return scores[target] <= scores[best] * self.sticky_tolerance
+
+
+def _conversation_key(messages: list) -> Optional[str]:
+    """
+    The messages up to (and including) the first user message stay the same
+    for all the turns of a conversation.
+    """
+    for idx, message in enumerate(messages):
+        if message.get("role") == "user":
+            prefix = json.dumps(messages[: idx + 1], sort_keys=True, ensure_ascii=False, default=str)
+            return hashlib.sha1(prefix.encode("utf-8")).hexdigest()
+    return None
@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+from common.config import SHARED_STATE, SHARED_STATE_PATH
+
+
+def connect_sqlite(path: Union[str, Path]) -> sqlite3.Connection:
+    """
+    A connection to a local SQLite database that several threads and worker
+    processes share: WAL mode (readers don't block the writer), autocommit
+    (explicit transactions only) and a `timeout` of how long to wait for the
+    other workers to release the write lock. The callers serialize the use of
+    the connection across threads themselves.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30.0)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SharedState:
+    """
+    A local SQLite database (WAL mode) for the state that the worker
+    processes of a multi-worker LiteLLM Server (see `NUM_WORKERS`) have to
+    share: the rate limit buckets (see `common/rate_limits.py`) and the
+    metrics (see `common/metrics.py`). Every process has its own connection,
+    the modules create their own tables.
+
+    `run_id` tells the workers of the current server apart from the ones of
+    the previous runs (by default - the parent process, which is the process
+    manager of the workers).
+    """
+
+    def __init__(self, path: Union[str, Path] = SHARED_STATE_PATH, *, run_id: Optional[str] = None) -> None:
+        self.path = Path(path)
+        self.run_id = run_id or str(os.getppid())
+        self.worker_id = str(os.getpid())
+
+        self._lock = threading.Lock()
+        self._conn = connect_sqlite(self.path)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        A write transaction - the other workers can read in the meantime, but
+        not write.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def execute(self, sql: str, parameters: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, parameters).fetchall()
+
+
+# None (every worker keeps its state to itself) unless `SHARED_STATE` is set
+# (it is by default with `NUM_WORKERS` > 1)
+shared_state: Optional[SharedState] = SharedState() if SHARED_STATE else None
@@ -0,0 +1,177 @@
+import asyncio
+import copy
+from collections import deque
+from typing import Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+from pydantic import BaseModel
+
+from common.config import REQUEST_COALESCING_MAX_LAG
+from common.utils import ProxyError
+
+
+T = TypeVar("T")
+
+
+class SlowSubscriberError(ProxyError):
+    pass
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical async calls: while a call with a given key
+    is in flight, other calls with the same key attach to it instead of
+    starting their own.
+
+    Streams are fanned out to every subscriber. The upstream stream is read by
+    a separate task that never waits for the subscribers - every subscriber
+    reads the shared chunks at its own pace. A subscriber that falls more than
+    `max_lag` chunks behind is cut off (with `SlowSubscriberError`), so a slow
+    client neither holds up the others nor makes the flight keep unbounded
+    history in memory. New subscribers can attach to a stream only until its
+    first chunk is dropped from that history.
+
+    Every subscriber gets its own copy of the results, because LiteLLM
+    post-processes (and mutates) what the handlers return.
+    """
+
+    def __init__(self, *, max_lag: int = REQUEST_COALESCING_MAX_LAG) -> None:
+        self.max_lag = max(1, max_lag)
+        self._calls: dict[str, asyncio.Future] = {}
+        self._streams: dict[str, _StreamFlight] = {}
+
+        self.leaders = 0
+        self.followers = 0
+        self.slow_subscribers = 0
+
+    async def call(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        future = self._calls.get(key)
+        if future is None:
+            self.leaders += 1
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._forget_call(key, future))
+            # The call is shielded, so that the leader going away (e.g. the
+            # client disconnecting) doesn't cancel it for the followers
+            return _copy_result(await asyncio.shield(future))
+
+        self.followers += 1
+        return _copy_result(await asyncio.shield(future))
+
+    async def stream(self, key: str, fn: Callable[[], AsyncIterator[T]]) -> AsyncGenerator[T, None]:
+        flight = self._streams.get(key)
+        if flight is None or not flight.accepts_subscribers():
+            self.leaders += 1
+            flight = _StreamFlight(fn(), max_lag=self.max_lag, on_done=lambda f: self._forget_stream(key, f))
+            self._streams[key] = flight
+        else:
+            self.followers += 1
+
+        try:
+            async for chunk in flight.subscribe():
+                yield _copy_result(chunk)
+        except SlowSubscriberError:
+            self.slow_subscribers += 1
+            raise
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "slow_subscribers": self.slow_subscribers,
+            "in_flight": len(self._calls) + len(self._streams),
+        }
+
+    def _forget_call(self, key: str, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+    def _forget_stream(self, key: str, flight: "_StreamFlight") -> None:
+        if self._streams.get(key) is flight:
+            del self._streams[key]
+
+
+class _StreamFlight:
+    def __init__(self, source: AsyncIterator, *, max_lag: int, on_done: Callable[["_StreamFlight"], None]) -> None:
+        self._max_lag = max_lag
+        self._on_done = on_done
+        # Chunks that at least one of the subscribers hasn't read yet.
+        # `self._base` is the absolute index of `self._chunks[0]`
+        self._chunks: deque = deque()
+        self._base = 0
+        self._positions: dict[int, int] = {}
+        self._next_subscriber_id = 0
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._new_data = asyncio.Event()
+        self._task = asyncio.ensure_future(self._pump(source))
+
+    def accepts_subscribers(self) -> bool:
+        return not self._done and self._base == 0
+
+    async def subscribe(self) -> AsyncGenerator[Any, None]:
+        subscriber_id = self._next_subscriber_id
+        self._next_subscriber_id += 1
+        self._positions[subscriber_id] = self._base
+        try:
+            while True:
+                position = self._positions[subscriber_id]
+                end = self._base + len(self._chunks)
+
+                if position < end:
+                    if end - position > self._max_lag:
+                        raise SlowSubscriberError(
+                            f"Stream subscriber fell more than {self._max_lag} chunks behind the upstream"
+                        )
+                    chunk = self._chunks[position - self._base]
+                    self._positions[subscriber_id] = position + 1
+                    self._trim()
+                    yield chunk
+                    continue
+
+                if self._done:
+                    if self._error is not None:
+                        raise self._error
+                    return
+
+                new_data = self._new_data
+                await new_data.wait()
+        finally:
+            del self._positions[subscriber_id]
+            self._trim()
+            if not self._positions and not self._done:
+                # Nobody is listening anymore - don't keep generating tokens
+                self._task.cancel()
+
+    def _trim(self) -> None:
+        lowest = min(self._positions.values(), default=self._base + len(self._chunks))
+        while self._base < lowest:
+            self._chunks.popleft()
+            self._base += 1
+
+    def _notify(self) -> None:
+        self._new_data.set()
+        self._new_data = asyncio.Event()
+
+    async def _pump(self, source: AsyncIterator) -> None:
+        try:
+            async for chunk in source:
+                self._chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self._error = ProxyError("Coalesced upstream stream was cancelled")
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # Delivered to every subscriber
+            self._error = e
+        finally:
+            self._done = True
+            self._on_done(self)
+            self._notify()
+            aclose = getattr(source, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+
+def _copy_result(result: T) -> T:
+    if isinstance(result, BaseModel):
+        return result.model_copy(deep=True)
+    return copy.copy(result)
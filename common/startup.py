@@ -0,0 +1,240 @@
+import importlib
+import os
+import threading
+import time
+from typing import Optional, Sequence
+
+import litellm
+
+import common
+from common.config import STARTUP_PROFILE, STARTUP_WARM_UP_TIMEOUT
+from common.http_pool import UpstreamClientPool
+from common.response_cache import ResponseCache
+from common.utils import in_event_loop
+
+
+_WARM_UP_MESSAGES = [{"role": "user", "content": "Warm-up"}]
+
+
+def process_age() -> Optional[float]:
+    """
+    Seconds since the current process started (None where `/proc` is not
+    available).
+    """
+    try:
+        with open("/proc/self/stat", encoding="ascii") as f:
+            # The fields that follow the command name (which may contain spaces)
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", encoding="ascii") as f:
+            uptime = float(f.read().split()[0])
+        # The 22nd field - the start time in clock ticks since boot
+        started_at = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+    return max(0.0, uptime - started_at)
+
+
+class StartupProfile:
+    """
+    The cold-start profile of the process - when (in seconds since the
+    process started) it reached every milestone of its startup:
+      - `handler_imports_started` - the first module of `common` is imported
+        (everything before that is the interpreter, LiteLLM and the LiteLLM
+        Server starting up)
+      - `handlers_imported` - the last handler is imported and constructed
+      - `warm_up_done` - the last handler is warmed up (see `warm_up()`)
+      - `first_request_received` / `first_response_served` - the first request
+        the handlers served
+
+    Plus the time spent in every step of the warm-up. Where the age of the
+    process is unknown, the times are counted from the first import of
+    `common` instead.
+    """
+
+    def __init__(self) -> None:
+        age = process_age()
+        # The start of the process on the `time.perf_counter()` scale
+        self._origin = common.IMPORTS_STARTED_AT if age is None else time.perf_counter() - age
+        self._lock = threading.Lock()
+        self.milestones: dict[str, float] = {}
+        self.warm_up_steps: dict[str, float] = {}
+        self.awaiting_first_response = True
+
+        self.mark("handler_imports_started", common.IMPORTS_STARTED_AT)
+
+    def mark(self, milestone: str, at: Optional[float] = None) -> float:
+        """
+        Record that `milestone` was reached `at` (a `time.perf_counter()`
+        value, now by default). Returns the seconds since the process started.
+        """
+        seconds = (time.perf_counter() if at is None else at) - self._origin
+        with self._lock:
+            self.milestones[milestone] = seconds
+        return seconds
+
+    def record_warm_up_step(self, step: str, seconds: float) -> None:
+        with self._lock:
+            self.warm_up_steps[step] = self.warm_up_steps.get(step, 0.0) + seconds
+
+    def first_response_served(self, request_started_at: float) -> None:
+        """
+        Record the first served request (only the first call does anything).
+        """
+        with self._lock:
+            if not self.awaiting_first_response:
+                return
+            self.awaiting_first_response = False
+        self.mark("first_request_received", request_started_at)
+        self.mark("first_response_served")
+        if STARTUP_PROFILE:
+            self.print_summary()
+
+    def report(self) -> dict[str, dict[str, float]]:
+        with self._lock:
+            return {"milestones": dict(self.milestones), "warm_up_steps": dict(self.warm_up_steps)}
+
+    def milestone_values(self) -> dict[tuple[str, ...], float]:
+        """
+        The milestones as the values of a metrics gauge (see `common/metrics.py`).
+        """
+        with self._lock:
+            return {(milestone,): seconds for milestone, seconds in self.milestones.items()}
+
+    def print_summary(self) -> None:
+        report = self.report()
+        milestones = ", ".join(
+            f"{milestone.replace('_', ' ')} at {seconds:.2f}s" for milestone, seconds in report["milestones"].items()
+        )
+        steps = ", ".join(f"{step} {seconds:.2f}s" for step, seconds in report["warm_up_steps"].items())
+        # TODO Replace with a logger ?
+        print(f"\033[1;34mStartup profile (since the process started): {milestones}\033[0m")
+        if steps:
+            print(f"\033[1;34mWarm-up steps: {steps}\033[0m")
+
+
+startup_profile = StartupProfile()
+
+
+def warm_up(
+    target_models: Sequence[str],
+    *,
+    client_pool: Optional[UpstreamClientPool] = None,
+    response_cache: Optional[ResponseCache] = None,
+    timeout: float = STARTUP_WARM_UP_TIMEOUT,
+) -> None:
+    """
+    Prepare what the first requests to `target_models` would otherwise pay
+    for, before the handler is done being constructed (the LiteLLM Server
+    constructs the handlers in its startup, before it reports ready):
+      - open connections of the sync clients of `client_pool` (waiting for
+        them for at most `timeout` seconds - they keep opening in the
+        background after that); the async clients are warmed up as soon as
+        the event loop of the server runs
+      - load the tokenizers of the targets
+      - go through LiteLLM's completion and streaming code paths of the
+        targets (with mock responses, nothing is sent upstream or logged),
+        which imports what LiteLLM imports lazily
+      - load `response_cache` (see `ResponseCache.warm_up()`)
+    """
+    startup_profile.mark("handlers_imported")
+    started_at = time.perf_counter()
+
+    connections = None
+    connections_opened = threading.Event()
+    if client_pool is not None:
+        pooled_targets = [target for target in target_models if client_pool.settings_for(target)["warm_up"]]
+        # Opened while the rest is warmed up
+        connections = threading.Thread(
+            target=_open_connections,
+            args=(client_pool, pooled_targets, connections_opened),
+            name="http-pool-warm-up",
+            daemon=True,
+        )
+        connections.start()
+        # Without a running loop, the async clients are warmed up with the
+        # first request
+        if in_event_loop():
+            for target in pooled_targets:
+                # Creates the client and schedules its warm-up in the running loop
+                client_pool.get_client(target, is_async=True)
+
+    warmed_up = True
+    step_started_at = time.perf_counter()
+    for target in target_models:
+        warmed_up = _try_warm_up(target, "tokenizer", _warm_up_tokenizer) and warmed_up
+    startup_profile.record_warm_up_step("tokenizers", time.perf_counter() - step_started_at)
+
+    step_started_at = time.perf_counter()
+    for target in target_models:
+        warmed_up = _try_warm_up(target, "LiteLLM", _warm_up_litellm) and warmed_up
+    # The mock responses don't get as far as the SDK of the provider, which
+    # imports its API resources lazily (the OpenAI SDK - upon the first
+    # `client.chat`, LiteLLM uses it for OpenAI and many compatible targets)
+    importlib.import_module("openai.resources")
+    startup_profile.record_warm_up_step("litellm", time.perf_counter() - step_started_at)
+
+    if response_cache is not None:
+        step_started_at = time.perf_counter()
+        try:
+            response_cache.warm_up()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            # TODO Replace with a logger ?
+            print(f"\033[1;33mFailed to warm up the response cache: {e!r}\033[0m")
+            warmed_up = False
+        startup_profile.record_warm_up_step("response_cache", time.perf_counter() - step_started_at)
+
+    if connections is not None:
+        connections.join(max(0.0, timeout - (time.perf_counter() - started_at)))
+        if connections.is_alive():
+            # TODO Replace with a logger ?
+            print(
+                f"\033[1;33mThe upstream connections are still opening after {timeout}s "
+                "(STARTUP_WARM_UP_TIMEOUT), continuing in the background\033[0m"
+            )
+        warmed_up = connections_opened.is_set() and warmed_up
+
+    seconds = startup_profile.mark("warm_up_done")
+    if STARTUP_PROFILE and warmed_up:
+        # TODO Replace with a logger ?
+        print(
+            f"\033[1;34mWarmed up {', '.join(target_models)} in {time.perf_counter() - started_at:.2f}s "
+            f"({seconds:.2f}s since the process started)\033[0m"
+        )
+    elif STARTUP_PROFILE:
+        print(
+            f"\033[1;33mThe warm-up of {', '.join(target_models)} was incomplete (see above), "
+            f"took {time.perf_counter() - started_at:.2f}s ({seconds:.2f}s since the process started)\033[0m"
+        )
+
+
+def _open_connections(client_pool: UpstreamClientPool, target_models: list[str], opened: threading.Event) -> None:
+    started_at = time.perf_counter()
+    try:
+        if client_pool.warm_up(target_models, background=False):
+            opened.set()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # TODO Replace with a logger ?
+        print(f"\033[1;33mFailed to open the upstream connections: {e!r}\033[0m")
+    startup_profile.record_warm_up_step("connections", time.perf_counter() - started_at)
+
+
+def _warm_up_tokenizer(target_model: str) -> None:
+    litellm.token_counter(model=target_model, messages=_WARM_UP_MESSAGES)
+
+
+def _warm_up_litellm(target_model: str) -> None:
+    kwargs = {"model": target_model, "messages": _WARM_UP_MESSAGES, "mock_response": "Warm-up", "no-log": True}
+    litellm.completion(**kwargs)
+    for _ in litellm.completion(stream=True, **kwargs):
+        pass
+
+
+def _try_warm_up(target_model: str, what: str, warm_up_fn) -> bool:
+    try:
+        warm_up_fn(target_model)
+        return True
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        # Not fatal - the first request will pay for it instead
+        # TODO Replace with a logger ?
+        print(f"\033[1;33mFailed to warm up the {what} of {target_model}: {e!r}\033[0m")
+        return False
@@ -0,0 +1,156 @@
+import asyncio
+import inspect
+import threading
+from typing import Any, AsyncGenerator, AsyncIterator, TypeVar
+
+from common.config import SLOW_CONSUMER_POLICY, SLOW_CONSUMER_TIMEOUT, STREAM_BUFFER_SIZE
+from common.utils import ProxyError
+
+
+T = TypeVar("T")
+
+_END = object()
+
+
+class SlowConsumerError(ProxyError):
+    pass
+
+
+class StreamControl:
+    """
+    What happens to an async stream when its consumer (the client) goes away
+    or doesn't keep up, plus counters of such streams.
+
+    With `buffer_size` > 0 the upstream is read by a separate task into a
+    bounded buffer of that many chunks, so that short stalls of the client
+    don't hold up reading the upstream. When the buffer is full:
+      - `slow_consumer_policy="block"` - the reading waits for the client
+        (the upstream is slowed down by TCP flow control)
+      - `slow_consumer_policy="abort"` - if the client doesn't read anything
+        for `slow_consumer_timeout` seconds, the upstream stream is closed
+        (releasing its connection) and the client gets `SlowConsumerError`
+
+    With `buffer_size=0` the chunks go from the upstream to the client
+    directly, like before.
+    """
+
+    def __init__(
+        self,
+        *,
+        buffer_size: int = STREAM_BUFFER_SIZE,
+        slow_consumer_policy: str = SLOW_CONSUMER_POLICY,
+        slow_consumer_timeout: float = SLOW_CONSUMER_TIMEOUT,
+    ) -> None:
+        if slow_consumer_policy not in ("block", "abort"):
+            raise ValueError(f"Unknown slow consumer policy: {slow_consumer_policy!r} (expected 'block' or 'abort')")
+        self.buffer_size = max(0, buffer_size)
+        self.slow_consumer_policy = slow_consumer_policy
+        self.slow_consumer_timeout = slow_consumer_timeout
+
+        self._lock = threading.Lock()
+        # reason ("client_disconnected", "slow_consumer") -> count
+        self.aborted_streams: dict[str, int] = {}
+        # Upstream streams closed before they were consumed in full
+        self.reclaimed_connections = 0
+
+    def record_abort(self, reason: str) -> None:
+        with self._lock:
+            self.aborted_streams[reason] = self.aborted_streams.get(reason, 0) + 1
+
+    def record_reclaimed_connection(self) -> None:
+        with self._lock:
+            self.reclaimed_connections += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "aborted_streams": dict(self.aborted_streams),
+                "reclaimed_connections": self.reclaimed_connections,
+            }
+
+    def abuffered(self, stream: AsyncIterator[T]) -> AsyncIterator[T]:
+        """
+        `stream` behind a bounded buffer (or `stream` itself, if buffering is
+        off). Closing the result closes `stream`.
+        """
+        if self.buffer_size == 0:
+            return stream
+        return self._abuffered(stream)
+
+    async def _abuffered(self, stream: AsyncIterator[T]) -> AsyncGenerator[T, None]:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.buffer_size)
+        errors: list[BaseException] = []
+
+        async def _read() -> None:
+            try:
+                async for chunk in stream:
+                    await self._put(queue, chunk)
+            except SlowConsumerError as e:
+                # Delivered right away, without the buffered chunks
+                errors.append(e)
+                return
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # Delivered after the buffered chunks
+                errors.append(e)
+            finally:
+                await aclose_stream(stream)
+            await queue.put(_END)
+
+        reader = asyncio.ensure_future(_read())
+        try:
+            while True:
+                if errors and isinstance(errors[0], SlowConsumerError):
+                    raise errors[0]
+                chunk = await queue.get()
+                if chunk is _END:
+                    if errors:
+                        raise errors[0]
+                    return
+                yield chunk
+        finally:
+            if not reader.done():
+                reader.cancel()
+            # Let the reader close the upstream stream before going any further
+            await asyncio.wait([reader])
+            if not reader.cancelled():
+                reader.exception()
+
+    async def _put(self, queue: asyncio.Queue, chunk: Any) -> None:
+        if self.slow_consumer_policy == "block":
+            await queue.put(chunk)
+            return
+        try:
+            await asyncio.wait_for(queue.put(chunk), timeout=self.slow_consumer_timeout)
+        except asyncio.TimeoutError as e:
+            raise SlowConsumerError(
+                f"The client hasn't read anything for {self.slow_consumer_timeout} seconds"
+                f" with {self.buffer_size} chunks buffered - aborting the stream"
+            ) from e
+
+
+def close_stream(stream: Any) -> None:
+    """
+    Close a sync stream - either a generator or LiteLLM's `CustomStreamWrapper`
+    (which, depending on the LiteLLM version, may not be closeable itself, but
+    wraps a closeable provider stream), releasing its connection.
+    """
+    close = getattr(stream, "close", None)
+    if close is None:
+        close = getattr(getattr(stream, "completion_stream", None), "close", None)
+    if close is not None:
+        close()
+
+
+async def aclose_stream(stream: Any) -> None:
+    """
+    Async version of `close_stream`.
+    """
+    for target in (stream, getattr(stream, "completion_stream", None)):
+        for method_name in ("aclose", "close"):
+            close = getattr(target, method_name, None)
+            if close is None:
+                continue
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+            return
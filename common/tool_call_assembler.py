@@ -0,0 +1,255 @@
+import json
+from typing import Any, Collection, Optional
+
+
+class AssembledToolCall:
+    """
+    A tool call of a streamed response, put together from its deltas. The
+    argument fragments are kept in a list and joined once, when `arguments`
+    is read (rather than concatenated delta by delta, which copies the whole
+    string every time).
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    __slots__ = (
+        "choice_index",
+        "index",
+        "id",
+        "type",
+        "name",
+        "complete",
+        "parsed_arguments",
+        "parse_error",
+        "_fragments",
+        "_arguments",
+        "_scanner",
+    )
+
+    def __init__(self, choice_index: int, index: int, *, parse_json: bool = False) -> None:
+        self.choice_index = choice_index
+        self.index = index
+        self.id: Optional[str] = None
+        self.type = "function"
+        self.name: Optional[str] = None
+        # True once no more deltas are expected (see `ToolCallAssembler`)
+        self.complete = False
+        # Only with `parse_json=True`
+        self.parsed_arguments: Any = None
+        self.parse_error: Optional[ValueError] = None
+        self._fragments: list[str] = []
+        self._arguments: Optional[str] = ""
+        self._scanner = _JsonScanner() if parse_json else None
+
+    @property
+    def arguments(self) -> str:
+        if self._arguments is None:
+            self._arguments = "".join(self._fragments)
+            self._fragments = [self._arguments]
+        return self._arguments
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        The tool call in the format of the `tool_calls` of a chat completion
+        message.
+        """
+        return {"id": self.id, "type": self.type, "function": {"name": self.name, "arguments": self.arguments}}
+
+    def _append(self, fragment: str) -> bool:
+        """
+        Returns True if the fragment completes the JSON of the arguments.
+        """
+        self._fragments.append(fragment)
+        self._arguments = None
+        return self._scanner is not None and self._scanner.feed(fragment)
+
+    def _complete(self) -> None:
+        self.complete = True
+        if self._scanner is None:
+            return
+        try:
+            self.parsed_arguments = json.loads(self.arguments) if self.arguments.strip() else {}
+        except ValueError as e:
+            self.parse_error = e
+
+
+class ToolCallAssembler:
+    """
+    Puts together the tool calls of a stream - every tool call index of every
+    choice (while `common.utils.to_generic_streaming_chunk` can only pass on
+    one tool call per chunk). Create one instance per stream and `feed()` it
+    every upstream chunk; it returns the tool calls that the chunk completed,
+    so that their consumers don't have to wait for the end of the stream.
+
+    A tool call is complete:
+      - with `parse_json=True` - as soon as its arguments are a complete JSON
+        value (tracked incrementally, a fragment is only scanned once), and
+        the arguments are parsed into `parsed_arguments`
+      - once a chunk continues only tool calls with higher indices in the
+        same choice (the providers stream tool calls one after another)
+      - once the choice has a finish reason, or upon `finish()` (the end of
+        the stream)
+    """
+
+    def __init__(self, *, parse_json: bool = False) -> None:
+        self.parse_json = parse_json
+        self._tool_calls: dict[tuple[int, int], AssembledToolCall] = {}
+
+    def feed(self, chunk: Any) -> list[AssembledToolCall]:
+        completed: list[AssembledToolCall] = []
+        for position, choice in enumerate(_get(chunk, "choices") or ()):
+            choice_index = _get(choice, "index")
+            if not isinstance(choice_index, int):
+                choice_index = position
+
+            delta = _get(choice, "delta")
+            if delta is not None:
+                tool_calls = _get(delta, "tool_calls")
+                if not tool_calls:
+                    function_call = _get(delta, "function_call")
+                    # The legacy `function_call` - a single call per choice
+                    tool_calls = [{"function": function_call}] if function_call is not None else ()
+                indices = {
+                    self._feed_tool_call(choice_index, tc_position, tc, completed)
+                    for tc_position, tc in enumerate(tool_calls)
+                }
+                if indices:
+                    # The calls this chunk has moved on from
+                    self._complete_choice(choice_index, completed, below=max(indices), skip=indices)
+
+            if _get(choice, "finish_reason"):
+                self._complete_choice(choice_index, completed)
+        return completed
+
+    def finish(self) -> list[AssembledToolCall]:
+        """
+        Complete the tool calls that are still open (the stream ended).
+        """
+        completed: list[AssembledToolCall] = []
+        for choice_index in sorted({choice_index for choice_index, _ in self._tool_calls}):
+            self._complete_choice(choice_index, completed)
+        return completed
+
+    def tool_calls(self, choice_index: Optional[int] = None) -> list[AssembledToolCall]:
+        """
+        All the tool calls so far (complete or not), ordered by choice and index.
+        """
+        return [
+            tool_call
+            for key, tool_call in sorted(self._tool_calls.items())
+            if choice_index is None or key[0] == choice_index
+        ]
+
+    def _feed_tool_call(self, choice_index: int, position: int, tc: Any, completed: list[AssembledToolCall]) -> int:
+        """
+        Returns the index of the tool call.
+        """
+        index = _get(tc, "index")
+        if not isinstance(index, int):
+            index = position
+
+        tool_call = self._tool_calls.get((choice_index, index))
+        if tool_call is None:
+            tool_call = AssembledToolCall(choice_index, index, parse_json=self.parse_json)
+            self._tool_calls[(choice_index, index)] = tool_call
+
+        tc_id = _get(tc, "id")
+        if isinstance(tc_id, str) and tc_id:
+            tool_call.id = tc_id
+        tc_type = _get(tc, "type")
+        if isinstance(tc_type, str) and tc_type:
+            tool_call.type = tc_type
+
+        fn = _get(tc, "function")
+        if fn is None:
+            return index
+        name = _get(fn, "name")
+        if isinstance(name, str) and name and tool_call.name is None:
+            tool_call.name = name
+        arguments = _get(fn, "arguments")
+        if arguments is not None and not isinstance(arguments, str):
+            # Some providers send the arguments of a call as a whole, parsed
+            arguments = json.dumps(arguments)
+        # pylint: disable=protected-access
+        if arguments and tool_call._append(arguments) and not tool_call.complete:
+            tool_call._complete()
+            completed.append(tool_call)
+        return index
+
+    def _complete_choice(
+        self,
+        choice_index: int,
+        completed: list[AssembledToolCall],
+        *,
+        below: Optional[int] = None,
+        skip: Collection[int] = (),
+    ) -> None:
+        for (index_of_choice, index), tool_call in sorted(self._tool_calls.items()):
+            if index_of_choice != choice_index or tool_call.complete or index in skip:
+                continue
+            if below is not None and index >= below:
+                break
+            tool_call._complete()  # pylint: disable=protected-access
+            completed.append(tool_call)
+
+
+class _JsonScanner:
+    """
+    Tells when a JSON value that arrives in fragments is complete, without
+    parsing it (only the nesting depth and the string state are tracked).
+    """
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ("depth", "in_string", "escaped", "started", "done")
+
+    def __init__(self) -> None:
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.done = False
+
+    def feed(self, fragment: str) -> bool:
+        """
+        Returns True when the fragment completes the value (only once).
+        """
+        # pylint: disable=too-many-branches
+        if self.done:
+            return False
+        if self.in_string and not self.escaped and '"' not in fragment and "\\" not in fragment:
+            # Most fragments are nothing but the inside of a string
+            return False
+        for char in fragment:
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.depth == 0:
+                        # A top-level string
+                        self.done = True
+                        return True
+            elif char == '"':
+                self.in_string = True
+                self.started = True
+            elif char in "{[":
+                self.depth += 1
+                self.started = True
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth <= 0:
+                    self.done = True
+                    return True
+            elif not char.isspace() and not self.started:
+                # A top-level number or literal - only complete with the call
+                self.started = True
+        return False
+
+
+def _get(obj: Any, key: str) -> Any:
+    if isinstance(obj, dict):
+        return obj.get(key)
+    return getattr(obj, key, None)
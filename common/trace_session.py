@@ -0,0 +1,176 @@
+import json
+from typing import Any, Optional, TextIO
+
+from litellm import ModelResponse
+
+from common.config import TRACE_FORMAT, TRACE_STREAM_BUFFER_SIZE, TRACES_DIR
+from common.trace_storage import open_trace_file
+from common.trace_writer import BackgroundTraceWriter, snapshot, trace_writer
+from common.tracing_in_markdown import format_streaming_chunk_trace
+
+
+class StreamTraceSession:
+    """
+    Traces a whole streamed response. Meant to be created once per stream
+    (in `streaming` / `astreaming`) and used as a context manager:
+
+    ```python
+    with StreamTraceSession(timestamp=timestamp, calling_method="astreaming") as trace_session:
+        async for chunk in resp_stream:
+            ...
+            trace_session.add_chunk(chunk_idx=chunk_idx, complapi_chunk=chunk, generic_chunk=generic_chunk)
+    ```
+
+    Chunks are snapshotted as they are added (see
+    `common.trace_writer.snapshot` - LiteLLM modifies them after they were
+    yielded), buffered in memory and handed over to the background trace
+    writer `buffer_size` chunks at a time. The trace files are opened once (on
+    the writer thread) and stay open until the session is closed. The session
+    is flushed and closed when the stream finishes or fails.
+
+    Supported formats:
+      - "markdown": `<timestamp>_RESPONSE_STREAM.md` (same layout as
+        `write_streaming_chunk_trace` produces)
+      - "jsonl": `<timestamp>_RESPONSE_STREAM.jsonl` (one compact JSON object
+        per chunk)
+
+    In both cases the streamed text is also collected in
+    `<timestamp>_RESPONSE_TEXT.md`. The files are compressed and capped
+    according to `TRACE_COMPRESSION` and `TRACE_MAX_BYTES` (see
+    `common/trace_storage.py`).
+    """
+
+    def __init__(
+        self,
+        *,
+        timestamp: str,
+        calling_method: str,
+        trace_format: str = TRACE_FORMAT,
+        buffer_size: int = TRACE_STREAM_BUFFER_SIZE,
+        writer: BackgroundTraceWriter = trace_writer,
+    ) -> None:
+        if trace_format not in ("markdown", "jsonl"):
+            raise ValueError(f"Unknown trace format: {trace_format!r} (expected 'markdown' or 'jsonl')")
+
+        self.timestamp = timestamp
+        self.calling_method = calling_method
+        self.trace_format = trace_format
+        self._buffer_size = max(1, buffer_size)
+        self._writer = writer
+        # (chunk index, upstream chunk, generic chunk) - snapshots as dicts
+        self._buffer: list[tuple[int, Optional[dict], Optional[dict]]] = []
+        self._closed = False
+        self._chunk_count = 0
+
+        # Only ever touched on the writer thread
+        self._stream_file: Optional[TextIO] = None
+        self._text_file: Optional[TextIO] = None
+
+    def __enter__(self) -> "StreamTraceSession":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close(error=exc_value)
+
+    def add_chunk(
+        self,
+        *,
+        chunk_idx: Optional[int] = None,
+        complapi_chunk: Optional[ModelResponse] = None,
+        generic_chunk: Optional[dict] = None,
+    ) -> None:
+        if chunk_idx is None:
+            chunk_idx = self._chunk_count
+        self._chunk_count += 1
+        self._buffer.append((chunk_idx, snapshot(complapi_chunk), snapshot(generic_chunk)))
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer:
+            return
+        chunks, self._buffer = self._buffer, []
+        self._writer.submit(self._write_chunks, chunks=chunks)
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        if self._closed:
+            return
+        self._closed = True
+
+        self.flush()
+        # Closing must not be dropped, otherwise the file handles would leak
+        self._writer.submit_blocking(self._close_files, error=None if error is None else repr(error))
+
+    def _open_files(self) -> None:
+        TRACES_DIR.mkdir(parents=True, exist_ok=True)
+        extension = "md" if self.trace_format == "markdown" else "jsonl"
+
+        self._stream_file = open_trace_file(TRACES_DIR / f"{self.timestamp}_RESPONSE_STREAM.{extension}", "a")
+        self._text_file = open_trace_file(TRACES_DIR / f"{self.timestamp}_RESPONSE_TEXT.md", "a")
+
+        if self.trace_format == "markdown":
+            self._stream_file.write(f"# {self.calling_method.upper()}\n\n")
+
+    def _write_chunks(self, chunks: list[tuple[int, Optional[dict], Optional[dict]]]) -> None:
+        if self._stream_file is None:
+            self._open_files()
+
+        if self.trace_format == "markdown":
+            stream_parts = [
+                format_streaming_chunk_trace(
+                    chunk_idx=chunk_idx,
+                    complapi_chunk=complapi_chunk,
+                    generic_chunk=generic_chunk,
+                )
+                for chunk_idx, complapi_chunk, generic_chunk in chunks
+            ]
+        else:
+            stream_parts = [
+                _format_jsonl_chunk(chunk_idx, complapi_chunk, generic_chunk)
+                for chunk_idx, complapi_chunk, generic_chunk in chunks
+            ]
+
+        self._stream_file.write("".join(stream_parts))
+        self._text_file.write(
+            "".join(_chunk_text(complapi_chunk, generic_chunk) for _, complapi_chunk, generic_chunk in chunks)
+        )
+
+    def _close_files(self, error: Optional[str]) -> None:
+        if self._stream_file is None:
+            if error is None:
+                # Nothing was streamed - no need to create empty files
+                return
+            self._open_files()
+
+        try:
+            if error is not None:
+                if self.trace_format == "markdown":
+                    self._stream_file.write(f"## Error\n\n```\n{error}\n```\n")
+                else:
+                    self._stream_file.write(json.dumps({"error": error}) + "\n")
+        finally:
+            self._stream_file.close()
+            self._text_file.close()
+            self._stream_file = None
+            self._text_file = None
+
+
+def _chunk_text(complapi_chunk: Optional[dict], generic_chunk: Optional[dict]) -> str:
+    if generic_chunk is not None:
+        return generic_chunk["text"]
+    # Passthrough streams don't have generic chunks
+    choices = (complapi_chunk or {}).get("choices")
+    if choices:
+        content = (choices[0].get("delta") or {}).get("content")
+        if isinstance(content, str):
+            return content
+    return ""
+
+
+def _format_jsonl_chunk(chunk_idx: int, complapi_chunk: Optional[dict], generic_chunk: Optional[dict]) -> str:
+    record: dict[str, Any] = {"chunk_idx": chunk_idx}
+    if complapi_chunk is not None:
+        record["complapi_chunk"] = complapi_chunk
+    if generic_chunk is not None:
+        record["generic_chunk"] = generic_chunk
+    return json.dumps(record, separators=(",", ":"), default=str) + "\n"
@@ -0,0 +1,231 @@
+import fnmatch
+import gzip
+import os
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Sequence, TextIO
+
+from common.config import (
+    TRACE_ALWAYS_ON_ERROR,
+    TRACE_COMPRESSION,
+    TRACE_MAX_BYTES,
+    TRACE_RETENTION_INTERVAL_SECONDS,
+    TRACE_RETENTION_MAX_AGE_HOURS,
+    TRACE_RETENTION_MAX_SIZE_MB,
+    TRACE_SAMPLE_RATE,
+    TRACE_SAMPLE_RULES,
+    TRACES_DIR,
+)
+
+
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+class TracePolicy:
+    """
+    Which requests get traced (see `WRITE_TRACES_TO_FILES`):
+      - `sample_rate` - the share of the requests that are traced
+      - `rules` - (model pattern, sample rate) pairs that override
+        `sample_rate` for the matching target models (the first matching
+        pattern wins, `fnmatch` syntax)
+      - `always_on_error` - requests that failed are traced even if they were
+        not sampled (the request and the error - the chunks of a stream that
+        was not sampled are not kept)
+    """
+
+    def __init__(
+        self,
+        *,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        rules: Sequence[tuple[str, float]] = (),
+        always_on_error: bool = TRACE_ALWAYS_ON_ERROR,
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.rules = tuple(rules)
+        self.always_on_error = always_on_error
+
+    @classmethod
+    def from_env(cls) -> "TracePolicy":
+        return cls(rules=parse_sample_rules(TRACE_SAMPLE_RULES))
+
+    def sample(self, target_model: str) -> bool:
+        rate = self.sample_rate
+        for pattern, rule_rate in self.rules:
+            if fnmatch.fnmatchcase(target_model, pattern):
+                rate = rule_rate
+                break
+        if rate >= 1:
+            return True
+        return rate > 0 and random.random() < rate
+
+
+def parse_sample_rules(rules: str) -> list[tuple[str, float]]:
+    """
+    `openai/gpt-4o-mini=0.01,anthropic/*=0.5` -> [("openai/gpt-4o-mini", 0.01), ("anthropic/*", 0.5)]
+    """
+    parsed = []
+    for rule in rules.split(","):
+        rule = rule.strip()
+        if not rule:
+            continue
+        pattern, separator, rate = rule.rpartition("=")
+        if not separator or not pattern:
+            raise ValueError(f"Invalid trace sample rule: {rule!r} (expected '<model pattern>=<rate>')")
+        parsed.append((pattern.strip(), float(rate)))
+    return parsed
+
+
+class _CappedTraceFile:
+    """
+    A text file that stops growing after `max_bytes` (with a marker saying so
+    at the end).
+    """
+
+    def __init__(self, file: TextIO, max_bytes: int) -> None:
+        self._file = file
+        self._remaining = max_bytes
+        self.truncated = False
+
+    def write(self, text: str) -> int:
+        if self.truncated:
+            return 0
+        data = text.encode("utf-8")
+        if len(data) <= self._remaining:
+            self._remaining -= len(data)
+            return self._file.write(text)
+
+        # Cut at the cap, without splitting a multibyte character
+        self._file.write(data[: self._remaining].decode("utf-8", errors="ignore"))
+        self._file.write(f"\n\n[... TRUNCATED - the trace exceeded TRACE_MAX_BYTES={TRACE_MAX_BYTES} ...]\n")
+        self.truncated = True
+        return len(text)
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "_CappedTraceFile":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def open_trace_file(
+    path: Path, mode: str = "w", *, compression: str = TRACE_COMPRESSION, max_bytes: int = TRACE_MAX_BYTES
+) -> TextIO:
+    """
+    Open a trace file for writing (`mode` is "w", "x" or "a"), compressed
+    according to `TRACE_COMPRESSION` (the suffix of the compression is
+    appended to `path`) and capped at `TRACE_MAX_BYTES` (0 - no cap) of
+    uncompressed text.
+    """
+    path = trace_file_path(path, compression)
+    if compression == "gzip":
+        # Light compression - traces are written on a single background thread
+        file = gzip.open(path, f"{mode}t", encoding="utf-8", compresslevel=3)
+    elif compression == "zstd":
+        import zstandard  # pylint: disable=import-outside-toplevel
+
+        file = zstandard.open(path, f"{mode}t", encoding="utf-8")
+    else:
+        file = path.open(mode, encoding="utf-8")  # pylint: disable=consider-using-with
+
+    if max_bytes > 0:
+        return _CappedTraceFile(file, max_bytes)
+    return file
+
+
+def trace_file_path(path: Path, compression: str = TRACE_COMPRESSION) -> Path:
+    return path.with_name(path.name + COMPRESSION_SUFFIXES[compression])
+
+
+class TraceRetention:
+    """
+    Deletes trace files (everything in `TRACES_DIR`, recordings included)
+    older than `max_age_hours`, then the oldest ones until the folder is
+    under `max_size_mb` - every `interval` seconds, on a daemon thread.
+    """
+
+    def __init__(
+        self,
+        *,
+        directory: Path = TRACES_DIR,
+        max_age_hours: float = TRACE_RETENTION_MAX_AGE_HOURS,
+        max_size_mb: float = TRACE_RETENTION_MAX_SIZE_MB,
+        interval: float = TRACE_RETENTION_INTERVAL_SECONDS,
+    ) -> None:
+        self.directory = directory
+        self.max_age_hours = max_age_hours
+        self.max_size_mb = max_size_mb
+        self.interval = max(1.0, interval)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+        self.deleted_files = 0
+        self.deleted_bytes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age_hours > 0 or self.max_size_mb > 0
+
+    def start(self) -> None:
+        """
+        Start the sweeps (does nothing if there are no limits or the sweeps
+        are already running).
+        """
+        if not self.enabled:
+            return
+        with self._thread_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="trace-retention", daemon=True)
+            self._thread.start()
+
+    def sweep(self) -> None:
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file(follow_symlinks=False)]
+        except FileNotFoundError:
+            return
+
+        files = []
+        for entry in entries:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+
+        total_size = sum(size for _, size, _ in files)
+        max_size = self.max_size_mb * 1024 * 1024
+        oldest_allowed = time.time() - self.max_age_hours * 3600
+        for mtime, size, path in files:
+            too_old = self.max_age_hours > 0 and mtime < oldest_allowed
+            too_big = self.max_size_mb > 0 and total_size > max_size
+            if not too_old and not too_big:
+                # The files are sorted by age, the rest are newer
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            self.deleted_files += 1
+            self.deleted_bytes += size
+
+    def stats(self) -> dict[str, int]:
+        return {"deleted_files": self.deleted_files, "deleted_bytes": self.deleted_bytes}
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # TODO Replace with a logger ?
+                print(f"\033[1;31mFailed to apply the trace retention policy: {e!r}\033[0m")
+            time.sleep(self.interval)
+
+
+trace_retention = TraceRetention()
@@ -0,0 +1,163 @@
+import atexit
+import queue
+import threading
+from typing import Any, Callable, Optional
+
+from pydantic import BaseModel
+
+from common.config import TRACE_QUEUE_MAX_SIZE, TRACE_QUEUE_OVERFLOW_POLICY, TRACE_WRITE_BATCH_SIZE
+
+
+_STOP = object()
+
+
+class BackgroundTraceWriter:
+    """
+    Runs trace writing functions on a dedicated daemon thread, so that the
+    request path (the event loop thread in case of the async handlers) only
+    pays for an enqueue.
+
+    The writer thread drains the queue in batches of up to `batch_size` tasks
+    per wake-up. When the queue is full, the task is either dropped or the
+    caller blocks until there is room for it, depending on `overflow_policy`.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_queue_size: int = TRACE_QUEUE_MAX_SIZE,
+        overflow_policy: str = TRACE_QUEUE_OVERFLOW_POLICY,
+        batch_size: int = TRACE_WRITE_BATCH_SIZE,
+    ) -> None:
+        if overflow_policy not in ("drop", "block"):
+            raise ValueError(f"Unknown trace queue overflow policy: {overflow_policy!r} (expected 'drop' or 'block')")
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._block_on_overflow = overflow_policy == "block"
+        self._batch_size = max(1, batch_size)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+    def submit(self, fn: Callable[..., Any], /, **kwargs: Any) -> bool:
+        """
+        Schedule `fn(**kwargs)` to run on the writer thread. Returns False if
+        the task was dropped because the queue was full.
+        """
+        if self._thread is None:
+            self._start()
+
+        try:
+            self._queue.put((fn, kwargs), block=self._block_on_overflow)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        self.enqueued += 1
+        return True
+
+    def submit_blocking(self, fn: Callable[..., Any], /, **kwargs: Any) -> None:
+        """
+        Same as `submit()`, but waits for room in the queue regardless of the
+        overflow policy. Meant for tasks that must not be lost (e.g. the ones
+        that close files).
+        """
+        if self._thread is None:
+            self._start()
+
+        self._queue.put((fn, kwargs))
+        self.enqueued += 1
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every task submitted so far has been executed. Returns
+        False if the timeout expired first.
+        """
+        if self._thread is None:
+            return True
+
+        done = threading.Event()
+        # Flush markers bypass the overflow policy - the caller explicitly
+        # asked to wait
+        self._queue.put((None, done))
+        return done.wait(timeout)
+
+    def close(self, timeout: Optional[float] = 5.0) -> None:
+        with self._thread_lock:
+            thread = self._thread
+            if thread is None:
+                return
+            self._queue.put(_STOP)
+            thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "written": self.written,
+            "failed": self.failed,
+            "queued": self._queue.qsize(),
+        }
+
+    def _start(self) -> None:
+        with self._thread_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            for task in batch:
+                if task is _STOP:
+                    return
+
+                fn, kwargs = task
+                if fn is None:
+                    # A flush marker (see `flush()`)
+                    kwargs.set()
+                    continue
+
+                try:
+                    fn(**kwargs)
+                    self.written += 1
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    # The request that produced the trace is long gone, there
+                    # is nobody to propagate the error to
+                    self.failed += 1
+                    # TODO Replace with a logger ?
+                    print(f"\033[1;31mFailed to write a trace ({getattr(fn, '__name__', fn)}): {e!r}\033[0m")
+
+
+def snapshot(value: Any) -> Any:
+    """
+    A copy of a value to be traced that the later mutations of the original
+    don't reach (LiteLLM and the hooks keep modifying the chunks, responses,
+    messages and params after they were handed over to the trace writer).
+    Pydantic models become plain JSON dicts, dicts and lists are copied
+    recursively, the rest (strings, numbers) is immutable anyway. Taken on the
+    request path - the formatting and the I/O are left to the writer thread.
+    """
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [snapshot(item) for item in value]
+    return value
+
+
+trace_writer = BackgroundTraceWriter()
@@ -1,9 +1,11 @@
 import json
-from typing import Optional
+from typing import Any, Optional, Union
 
 from litellm import ModelResponse, ResponsesAPIResponse
+from pydantic import BaseModel
 
 from common.config import TRACES_DIR
+from common.trace_storage import open_trace_file, trace_file_path
 
 
 def write_request_trace(  # pylint: disable=unused-argument
@@ -19,11 +21,11 @@ def write_request_trace(  # pylint: disable=unused-argument
 ) -> None:
     TRACES_DIR.mkdir(parents=True, exist_ok=True)
     file = TRACES_DIR / f"{timestamp}_REQUEST.md"
-    if file.exists():
+    if trace_file_path(file).exists():
         # TODO Replace with a warning instead ?
-        raise FileExistsError(f"File {file} already exists")
+        raise FileExistsError(f"File {trace_file_path(file)} already exists")
 
-    with file.open("w", encoding="utf-8") as f:
+    with open_trace_file(file) as f:
         f.write(f"# {calling_method.upper()}\n\n")
 
         f.write("## Request Messages\n\n")
@@ -63,27 +65,61 @@ def write_response_trace(
     *,
     timestamp: str,
     calling_method: str,
-    response_respapi: Optional[ResponsesAPIResponse] = None,
-    response_complapi: Optional[ModelResponse] = None,
+    response_respapi: Optional[Union[ResponsesAPIResponse, dict]] = None,
+    response_complapi: Optional[Union[ModelResponse, dict]] = None,
 ) -> None:
     TRACES_DIR.mkdir(parents=True, exist_ok=True)
     file = TRACES_DIR / f"{timestamp}_RESPONSE.md"
-    if file.exists():
+    if trace_file_path(file).exists():
         # TODO Replace with a warning instead ?
-        raise FileExistsError(f"File {file} already exists")
+        raise FileExistsError(f"File {trace_file_path(file)} already exists")
 
-    with file.open("w", encoding="utf-8") as f:
+    with open_trace_file(file) as f:
         f.write(f"# {calling_method.upper()}\n\n")
 
         f.write("## Response\n\n")
 
         if response_respapi is not None:
             f.write("### Responses API:\n")
-            f.write(f"```json\n{response_respapi.model_dump_json(indent=2)}\n```\n\n")
+            f.write(f"```json\n{_to_json(response_respapi)}\n```\n\n")
 
         if response_complapi is not None:
             f.write("### ChatCompletions API:\n")
-            f.write(f"```json\n{response_complapi.model_dump_json(indent=2)}\n```\n")
+            f.write(f"```json\n{_to_json(response_complapi)}\n```\n")
+
+
+def write_error_trace(*, timestamp: str, calling_method: str, error: str) -> None:
+    TRACES_DIR.mkdir(parents=True, exist_ok=True)
+    with open_trace_file(TRACES_DIR / f"{timestamp}_ERROR.md") as f:
+        f.write(f"# {calling_method.upper()}\n\n")
+        f.write(f"## Error\n\n```\n{error}\n```\n")
+
+
+def format_streaming_chunk_trace(
+    *,
+    chunk_idx: int,
+    respapi_chunk: Optional[Union[ResponsesAPIResponse, dict]] = None,
+    complapi_chunk: Optional[Union[ModelResponse, dict]] = None,
+    generic_chunk: Optional[dict] = None,
+) -> str:
+    """
+    The chunks can also be snapshots of them (see
+    `common.trace_writer.snapshot`).
+    """
+    parts = [f"## Response Chunk #{chunk_idx}\n\n"]
+
+    if respapi_chunk is not None:
+        parts.append(f"### Responses API:\n```json\n{_to_json(respapi_chunk)}\n```\n\n")
+
+    if complapi_chunk is not None:
+        parts.append(f"### ChatCompletions API:\n```json\n{_to_json(complapi_chunk)}\n```\n\n")
+
+    if generic_chunk is not None:
+        # TODO Do `gen_chunk.model_dump_json(indent=2)` once it's not
+        #  just a dict
+        parts.append(f"### GenericStreamingChunk:\n```json\n{json.dumps(generic_chunk, indent=2)}\n```\n\n")
+
+    return "".join(parts)
 
 
 def write_streaming_chunk_trace(
@@ -95,6 +131,11 @@ def write_streaming_chunk_trace(
     complapi_chunk: Optional[ModelResponse] = None,
     generic_chunk: Optional[dict] = None,
 ) -> None:
+    """
+    Append a single chunk to the stream trace files. Opens (and closes) the
+    files every time - use `common.trace_session.StreamTraceSession` when
+    tracing a whole stream.
+    """
     TRACES_DIR.mkdir(parents=True, exist_ok=True)
     file = TRACES_DIR / f"{timestamp}_RESPONSE_STREAM.md"
     text_file = TRACES_DIR / f"{timestamp}_RESPONSE_TEXT.md"
@@ -106,19 +147,22 @@ def write_streaming_chunk_trace(
 
     # Append the chunk to the file
     with file.open("a", encoding="utf-8") as f:
-        f.write(f"## Response Chunk #{chunk_idx}\n\n")
-
-        if respapi_chunk is not None:
-            f.write(f"### Responses API:\n```json\n{respapi_chunk.model_dump_json(indent=2)}\n```\n\n")
-
-        if complapi_chunk is not None:
-            f.write(f"### ChatCompletions API:\n```json\n{complapi_chunk.model_dump_json(indent=2)}\n```\n\n")
-
-        if generic_chunk is not None:
-            # TODO Do `gen_chunk.model_dump_json(indent=2)` once it's not
-            #  just a dict
-            f.write(f"### GenericStreamingChunk:\n```json\n{json.dumps(generic_chunk, indent=2)}\n```\n\n")
-
-            # Append text only to the text file
-            with text_file.open("a", encoding="utf-8") as text_f:
-                text_f.write(generic_chunk["text"])
+        f.write(
+            format_streaming_chunk_trace(
+                chunk_idx=chunk_idx,
+                respapi_chunk=respapi_chunk,
+                complapi_chunk=complapi_chunk,
+                generic_chunk=generic_chunk,
+            )
+        )
+
+    if generic_chunk is not None:
+        # Append text only to the text file
+        with text_file.open("a", encoding="utf-8") as text_f:
+            text_f.write(generic_chunk["text"])
+
+
+def _to_json(value: Any) -> str:
+    if isinstance(value, BaseModel):
+        return value.model_dump_json(indent=2)
+    return json.dumps(value, indent=2, ensure_ascii=False, default=str)
@@ -3,11 +3,14 @@
 """
 NOTE: The utilities in this module were mostly vibe-coded without review.
 """
+
+import asyncio
 import os
 from datetime import UTC, datetime
 from typing import Any, Optional, Union
 
 from litellm import GenericStreamingChunk
+from pydantic import BaseModel
 
 
 class ProxyError(RuntimeError):
@@ -44,6 +47,34 @@ def env_var_to_bool(value: Optional[str], default: str = "false") -> bool:
     return (value or default).lower() in ("true", "1", "on", "yes", "y")
 
 
+def env_var_to_int(value: Optional[str], default: int) -> int:
+    """
+    Convert environment variable string to integer.
+
+    Args:
+        value: The environment variable value (or None if not set)
+        default: Default value to use if value is None or empty
+
+    Returns:
+        The integer value of the environment variable (or the default)
+    """
+    return int(value) if value else default
+
+
+def env_var_to_float(value: Optional[str], default: float) -> float:
+    """
+    Convert environment variable string to float.
+
+    Args:
+        value: The environment variable value (or None if not set)
+        default: Default value to use if value is None or empty
+
+    Returns:
+        The float value of the environment variable (or the default)
+    """
+    return float(value) if value else default
+
+
 def generate_timestamp_utc() -> str:
     """
     Generate timestamp in format YYYYmmdd_HHMMSS_fff_fff in UTC.
@@ -60,6 +91,18 @@ def generate_timestamp_utc() -> str:
     return f"{str_repr[:-3]}_{str_repr[-3:]}"
 
 
+def in_event_loop() -> bool:
+    """
+    Whether the current thread is running an event loop (e.g. the handler
+    was called from an async entry point rather than from a sync one).
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
 def to_generic_streaming_chunk(chunk: Any) -> GenericStreamingChunk:
     """
     Best-effort convert a LiteLLM ModelResponseStream chunk into
@@ -69,8 +112,8 @@ def to_generic_streaming_chunk(chunk: Any) -> GenericStreamingChunk:
       - text: str (required)
       - is_finished: bool (required)
       - finish_reason: str (required)
-      - usage: Optional[ChatCompletionUsageBlock] (we pass None for incremental
-        chunks)
+      - usage: Optional[ChatCompletionUsageBlock] (the usage the upstream
+        reported, usually only in the final chunk - see `usage_block`)
       - index: int (default 0)
       - tool_use: Optional[ChatCompletionToolCallChunk] (default None)
       - provider_specific_fields: Optional[dict]
@@ -82,11 +125,13 @@ def to_generic_streaming_chunk(chunk: Any) -> GenericStreamingChunk:
     index: int = 0
     provider_specific_fields: Optional[dict[str, Any]] = None
     tool_use: Optional[dict[str, Any]] = None
+    usage: Any = None
 
     try:
         # chunk may be a pydantic object with attributes
         choices = getattr(chunk, "choices", None)
         provider_specific_fields = getattr(chunk, "provider_specific_fields", None)
+        usage = usage_block(getattr(chunk, "usage", None))
 
         if isinstance(choices, list) and choices:
             choice = choices[0]
@@ -132,15 +177,7 @@ def to_generic_streaming_chunk(chunk: Any) -> GenericStreamingChunk:
                                 f"Failed to convert OpenAI tool_use to GenericStreamingChunk: {e}"
                             ) from e
 
-                    tool_use = {
-                        "index": tc_index if isinstance(tc_index, int) else 0,
-                        "id": tc_id if isinstance(tc_id, str) else None,
-                        "type": tc_type if isinstance(tc_type, str) else "function",
-                        "function": {
-                            "name": fn_name if isinstance(fn_name, str) else None,
-                            "arguments": fn_args if isinstance(fn_args, str) else None,
-                        },
-                    }
+                    tool_use = tool_call_chunk(tc_index, tc_id, tc_type, fn_name, fn_args)
 
                 # Anthropic-style tool_use block on delta
                 if tool_use is None:
@@ -237,12 +274,66 @@ def to_generic_streaming_chunk(chunk: Any) -> GenericStreamingChunk:
     except Exception as e:
         raise ProxyError(f"Failed to convert to GenericStreamingChunk: {e}") from e
 
+    return generic_streaming_chunk(text, is_finished, finish_reason, usage, index, tool_use, provider_specific_fields)
+
+
+def generic_streaming_chunk(
+    text: str,
+    is_finished: bool,
+    finish_reason: str,
+    usage: Any,
+    index: int,
+    tool_use: Optional[dict[str, Any]],
+    provider_specific_fields: Optional[dict[str, Any]],
+) -> GenericStreamingChunk:
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
     return {
         "text": text,
         "is_finished": is_finished,
         "finish_reason": finish_reason,
-        "usage": None,  # TODO Do we have to put anything in here ?
+        "usage": usage,
         "index": index,
         "tool_use": tool_use,
         "provider_specific_fields": provider_specific_fields,
     }
+
+
+def final_chunk_usage(chunk: Any) -> Any:
+    """
+    Usage of a streamed response, if `chunk` is the one that carries it. Cheap
+    enough to be called on every chunk.
+
+    Not necessarily the chunk with the finish reason - LiteLLM puts the usage
+    OpenAI sends after it (`stream_options.include_usage`) into a chunk of its
+    own, with an empty choice. Where the usage comes in several chunks, the
+    last one has the totals.
+    """
+    return getattr(chunk, "usage", None)
+
+
+def usage_block(usage: Any) -> Optional[dict[str, Any]]:
+    """
+    The usage of an upstream chunk as a dict (LiteLLM builds its `Usage` out of
+    it, token details included).
+    """
+    if usage is None or isinstance(usage, dict):
+        return usage
+    if isinstance(usage, BaseModel):
+        return usage.model_dump()
+    return None
+
+
+def tool_call_chunk(tc_index: Any, tc_id: Any, tc_type: Any, fn_name: Any, fn_args: Any) -> dict[str, Any]:
+    """
+    A ChatCompletionToolCallChunk-like dict (the fields of unexpected types
+    are replaced with the defaults).
+    """
+    return {
+        "index": tc_index if isinstance(tc_index, int) else 0,
+        "id": tc_id if isinstance(tc_id, str) else None,
+        "type": tc_type if isinstance(tc_type, str) else "function",
+        "function": {
+            "name": fn_name if isinstance(fn_name, str) else None,
+            "arguments": fn_args if isinstance(fn_args, str) else None,
+        },
+    }
@@ -0,0 +1,5 @@
+import os
+
+# Use the model cost map bundled with LiteLLM instead of downloading it upon
+# import (the tests don't need the network)
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
@@ -0,0 +1,133 @@
+import asyncio
+
+import litellm
+import pytest
+
+import common.tracing_in_markdown
+from common.admission import AdmissionController, AdmissionRejectedError
+from common.metrics import ProxyMetrics
+from common.proxy_llm import ProxyLLM
+from common.trace_storage import TracePolicy
+from common.trace_writer import trace_writer
+
+
+_TARGET = "openai/gpt-4o"
+
+
+def test_queued_requests_are_admitted_by_priority():
+    controller = AdmissionController(max_concurrency=1, max_queue=10)
+
+    async def main():
+        holder = await controller.aacquire(_TARGET, "default")
+        admitted = []
+
+        async def request(priority):
+            ticket = await controller.aacquire(_TARGET, priority)
+            admitted.append(priority)
+            ticket.release()
+
+        waiting = [asyncio.ensure_future(request(priority)) for priority in ("batch", "default", "interactive")]
+        await asyncio.sleep(0.01)
+        assert controller.queue_depths() == {_TARGET: 3}
+        holder.release()
+        await asyncio.gather(*waiting)
+        return admitted
+
+    assert asyncio.run(main()) == ["interactive", "default", "batch"]
+    assert controller.in_flight() == {_TARGET: 0}
+
+
+def test_a_full_queue_sheds_the_lowest_priority():
+    controller = AdmissionController(max_concurrency=1, max_queue=1, queue_timeout=5.0)
+
+    async def main():
+        holder = await controller.aacquire(_TARGET, "default")
+        batch = asyncio.ensure_future(controller.aacquire(_TARGET, "batch"))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.ensure_future(controller.aacquire(_TARGET, "interactive"))
+        await asyncio.sleep(0.01)
+
+        with pytest.raises(AdmissionRejectedError) as rejected:
+            await batch
+        # Not even a request of the same priority fits in anymore
+        with pytest.raises(AdmissionRejectedError):
+            await controller.aacquire(_TARGET, "interactive")
+
+        holder.release()
+        (await interactive).release()
+        return rejected.value
+
+    error = asyncio.run(main())
+    assert error.reason == "queue_full"
+    assert error.status_code == 429
+    assert error.headers == {"retry-after": "5"}
+    assert controller.stats()[_TARGET]["rejected"] == {"queue_full": 2}
+
+
+def test_requests_are_rejected_after_the_queue_timeout():
+    controller = AdmissionController(max_concurrency=1, targets={_TARGET: {"queue_timeout": 0.05}})
+    holder = controller.acquire(_TARGET, "default")
+
+    with pytest.raises(AdmissionRejectedError) as rejected:
+        controller.acquire(_TARGET, "default")
+
+    assert rejected.value.reason == "queue_timeout"
+    holder.release()
+    assert controller.in_flight() == {_TARGET: 0}
+    assert controller.queue_depths() == {_TARGET: 0}
+
+
+def test_priority_of_the_request():
+    controller = AdmissionController()
+
+    assert controller.priority_of({"metadata": {"priority": "batch"}}) == "batch"
+    assert controller.priority_of({"metadata": {"priority": "urgent"}}) == "default"
+    assert controller.priority_of(None) == "default"
+
+
+def test_from_settings():
+    assert AdmissionController.from_settings(None) is None
+    assert AdmissionController.from_settings({"enabled": False, "max_concurrency": 4}) is None
+    assert AdmissionController.from_settings({"max_concurrency": 4}).max_concurrency == 4
+
+
+class _UpstreamlessLLM(ProxyLLM):
+    def upstream_completion(self, call):
+        raise AssertionError("A rejected request was sent upstream")
+
+
+@pytest.mark.parametrize("sample_rate", [0.0, 1.0])
+def test_rejected_requests_are_traced_and_counted(sample_rate, tmp_path, monkeypatch):
+    monkeypatch.setattr(common.tracing_in_markdown, "TRACES_DIR", tmp_path)
+    admission = AdmissionController(max_concurrency=1, max_queue=0)
+    metrics = ProxyMetrics()
+    handler = _UpstreamlessLLM(
+        target_model=_TARGET,
+        admission=admission,
+        metrics=metrics,
+        write_traces=True,
+        trace_policy=TracePolicy(sample_rate=sample_rate, always_on_error=True),
+        write_recordings=False,
+        startup_warm_up=False,
+    )
+    # Takes the only slot
+    admission.acquire(_TARGET, "default")
+
+    with pytest.raises(AdmissionRejectedError):
+        handler.completion(
+            model="yoda-speak",
+            messages=[{"role": "user", "content": "Hello"}],
+            api_base=None,
+            custom_prompt_dict={},
+            model_response=litellm.ModelResponse(),
+            print_verbose=print,
+            encoding=None,
+            api_key=None,
+            logging_obj=None,
+            optional_params={},
+        )
+
+    assert trace_writer.flush(timeout=5)
+    assert sorted(path.name.split("_")[-1] for path in tmp_path.iterdir()) == ["ERROR.md", "REQUEST.md"]
+    assert metrics.requests.snapshot() == {(_TARGET, "completion", "error"): 1}
+    assert metrics.admission_rejections.snapshot() == {(_TARGET, "default", "queue_full"): 1}
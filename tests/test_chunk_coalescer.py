@@ -0,0 +1,50 @@
+import asyncio
+
+from litellm import ModelResponseStream
+
+from common.chunk_coalescer import ChunkCoalescer
+
+
+def _chunk(choice_index: int, text: str) -> ModelResponseStream:
+    return ModelResponseStream(choices=[{"index": choice_index, "delta": {"content": text}}])
+
+
+def _texts(chunks: list) -> list[tuple[int, str]]:
+    return [(chunk.choices[0].index, chunk.choices[0].delta.content) for chunk in chunks]
+
+
+def _stream(*deltas: tuple[int, str]) -> list[ModelResponseStream]:
+    return [_chunk(choice_index, text) for choice_index, text in deltas]
+
+
+async def _acollect(coalescer: ChunkCoalescer, chunks: list) -> list:
+    async def stream():
+        for chunk in chunks:
+            yield chunk
+
+    return [chunk async for chunk in coalescer.acoalesce(stream())]
+
+
+def test_consecutive_text_deltas_are_merged():
+    coalescer = ChunkCoalescer(max_delay=60.0, max_chars=1000)
+    chunks = _stream((0, "A"), (0, "b"), (0, "c"), (0, "d"))
+
+    assert _texts(coalescer.coalesce(chunks)) == [(0, "A"), (0, "bcd")]
+    assert coalescer.stats() == {"chunks_in": 4, "chunks_out": 2, "ratio": 2.0}
+
+
+def test_the_choices_are_never_merged_into_one_another():
+    interleaved = [(0, "A"), (1, "B"), (0, "a2"), (1, "b2"), (0, "a3"), (1, "b3")]
+    coalescer = ChunkCoalescer(max_delay=60.0, max_chars=1000)
+
+    merged = _texts(coalescer.coalesce(_stream(*interleaved)))
+    amerged = _texts(asyncio.run(_acollect(coalescer, _stream(*interleaved))))
+
+    assert merged == amerged == interleaved
+
+
+def test_runs_of_the_same_choice_are_merged():
+    coalescer = ChunkCoalescer(max_delay=60.0, max_chars=1000)
+    chunks = _stream((0, "A"), (0, "a2"), (0, "a3"), (1, "B"), (1, "b2"), (0, "a4"))
+
+    assert _texts(coalescer.coalesce(chunks)) == [(0, "A"), (0, "a2a3"), (1, "Bb2"), (0, "a4")]
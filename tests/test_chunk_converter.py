@@ -0,0 +1,96 @@
+"""
+Equivalence of the fast `StreamingChunkConverter` and the reference
+`to_generic_streaming_chunk` (the conversion LiteLLM gets from the handlers
+without the fast path) over the recorded chunks of the benchmark.
+"""
+
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+from litellm import ModelResponseStream
+
+from benchmarks.chunk_conversion import DEFAULT_RECORDING, load_recorded_streams
+from common.chunk_converter import StreamingChunkConverter
+from common.utils import to_generic_streaming_chunk
+
+
+_FIELDS = ("text", "is_finished", "finish_reason", "usage", "index", "tool_use", "provider_specific_fields")
+
+_STREAMS = load_recorded_streams([DEFAULT_RECORDING])
+
+
+def _convert_both(stream: list[Any]) -> list[tuple[dict, dict]]:
+    convert_chunk = StreamingChunkConverter()
+    return [(to_generic_streaming_chunk(chunk), convert_chunk(chunk)) for chunk in stream]
+
+
+def _assert_same_fields(expected: dict, actual: dict, where: str) -> None:
+    assert set(actual) == set(expected), where
+    for field in _FIELDS:
+        assert actual[field] == expected[field], f"{where}: {field!r} differs"
+
+
+def test_recording_covers_the_interesting_chunks():
+    chunks = [chunk for stream in _STREAMS for chunk in stream]
+    assert len(_STREAMS) >= 2
+    assert any(chunk.choices and chunk.choices[0].delta.tool_calls for chunk in chunks)
+    assert {"stop", "tool_calls"} <= {chunk.choices[0].finish_reason for chunk in chunks if chunk.choices}
+    assert any(getattr(chunk, "usage", None) is not None for chunk in chunks)
+
+
+@pytest.mark.parametrize("stream_idx", range(len(_STREAMS)))
+def test_recorded_streams_convert_identically(stream_idx):
+    for chunk_idx, (expected, actual) in enumerate(_convert_both(_STREAMS[stream_idx])):
+        _assert_same_fields(expected, actual, f"stream {stream_idx}, chunk {chunk_idx}")
+
+
+def test_finish_reason():
+    converted = [pair for stream in _STREAMS for pair in _convert_both(stream)]
+    finished = [actual for _, actual in converted if actual["is_finished"]]
+
+    assert sorted(chunk["finish_reason"] for chunk in finished) == ["stop", "tool_calls"]
+    assert all(not actual["finish_reason"] for _, actual in converted if not actual["is_finished"])
+
+
+def test_tool_call_deltas():
+    stream = next(stream for stream in _STREAMS if any(c.choices and c.choices[0].delta.tool_calls for c in stream))
+    tool_uses = [actual["tool_use"] for _, actual in _convert_both(stream) if actual["tool_use"] is not None]
+
+    assert tool_uses[0]["id"] is not None
+    assert tool_uses[0]["function"]["name"] == "get_weather"
+    assert all(tool_use["id"] is None and tool_use["function"]["name"] is None for tool_use in tool_uses[1:])
+    # The argument fragments add up to the whole JSON
+    assert "".join(tool_use["function"]["arguments"] for tool_use in tool_uses).startswith("{")
+
+
+def test_usage_chunk_without_choices():
+    stream = next(stream for stream in _STREAMS if any(getattr(c, "usage", None) is not None for c in stream))
+    expected, actual = _convert_both(stream)[-1]
+
+    _assert_same_fields(expected, actual, "usage chunk")
+    assert isinstance(actual["usage"], dict)
+    assert actual["usage"]["total_tokens"] == actual["usage"]["prompt_tokens"] + actual["usage"]["completion_tokens"]
+
+
+@pytest.mark.parametrize(
+    "chunk",
+    [
+        # Not a pydantic chunk, with a dict-based delta (the fallback to the reference)
+        SimpleNamespace(
+            choices=[SimpleNamespace(index=0, delta={"content": "Hmm", "tool_use": {"id": "t", "name": "f"}})],
+            provider_specific_fields=None,
+        ),
+        # Legacy function_call
+        ModelResponseStream(
+            choices=[{"index": 0, "delta": {"function_call": {"name": "f", "arguments": "{}"}}}],
+        ),
+        # A later choice index
+        ModelResponseStream(choices=[{"index": 1, "delta": {"content": "two"}, "finish_reason": "length"}]),
+    ],
+)
+def test_other_shapes_convert_identically(chunk):
+    first = ModelResponseStream(choices=[{"index": 0, "delta": {"content": "first"}}])
+    # The converter has already specialized on the first chunk of the stream
+    expected, actual = _convert_both([first, chunk])[1]
+    _assert_same_fields(expected, actual, repr(chunk))
@@ -0,0 +1,80 @@
+import pytest
+
+from common.context_budget import ContextBudget
+from common.metrics import ProxyMetrics
+
+
+_TARGET = "openai/gpt-4o"
+
+
+def _conversation(turns: int) -> list[dict]:
+    messages = [{"role": "system", "content": "Speak like Yoda."}]
+    for number in range(turns):
+        messages.append({"role": "user", "content": f"Question number {number}: " + "blah " * 50})
+        messages.append({"role": "assistant", "content": f"Answer number {number}: " + "hmm " * 50})
+    return messages
+
+
+def test_within_the_budget_nothing_changes():
+    budget = ContextBudget(max_tokens=100000)
+    messages = _conversation(3)
+
+    assert budget(messages, target_model=_TARGET) is messages
+    assert budget.stats()["trimmed_requests"] == 0
+
+
+def test_the_oldest_turns_are_dropped():
+    metrics = ProxyMetrics()
+    budget = ContextBudget(max_tokens=300, metrics=metrics)
+    messages = _conversation(5)
+
+    trimmed = budget(messages, target_model=_TARGET)
+
+    # The system prompt and the most recent whole turns are kept
+    assert trimmed[0] == messages[0]
+    assert trimmed[-2:] == messages[-2:]
+    assert trimmed[1:] == messages[len(messages) - len(trimmed) + 1 :]
+    assert trimmed[1]["role"] == "user"
+    stats = budget.stats()
+    assert stats["trimmed_messages"] == len(messages) - len(trimmed)
+    assert stats["tokens_after"] <= 300 < stats["tokens_before"]
+    assert stats["over_budget_requests"] == 0
+
+
+def test_summarize_quotes_the_dropped_user_messages():
+    budget = ContextBudget(max_tokens=400, strategy="summarize", summary_max_tokens=100, summary_chars_per_turn=20)
+    messages = _conversation(5)
+
+    trimmed = budget(messages, target_model=_TARGET)
+
+    summary = trimmed[1]
+    assert summary["role"] == "system"
+    assert "Question number 0" in summary["content"]
+    assert trimmed[2]["role"] == "user"
+    assert budget.stats()["tokens_after"] <= 400
+
+
+def test_the_last_turn_is_kept_even_over_budget():
+    budget = ContextBudget(max_tokens=50)
+    messages = _conversation(2)
+
+    trimmed = budget(messages, target_model=_TARGET)
+
+    assert trimmed == [messages[0]] + messages[-2:]
+    assert budget.stats()["over_budget_requests"] == 1
+
+
+def test_token_counts_are_cached_across_turns():
+    budget = ContextBudget(max_tokens=100000)
+    budget(_conversation(2), target_model=_TARGET)
+
+    budget(_conversation(3), target_model=_TARGET)
+
+    token_counts = budget.stats()["token_counts"]
+    assert token_counts["misses"] == 7
+    assert token_counts["hits"] == 5
+
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        ContextBudget(strategy="forget")
@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+from common.conversation_store import (
+    ConversationStore,
+    InMemoryConversationStore,
+    SQLiteConversationStore,
+    create_conversation_store,
+    normalize_message,
+)
+
+
+@pytest.fixture(name="make_store", params=["memory", "sqlite"])
+def fixture_make_store(request, tmp_path):
+    def _make_store(**kwargs):
+        if request.param == "memory":
+            return InMemoryConversationStore(**kwargs)
+        return SQLiteConversationStore(path=tmp_path / "conversations.sqlite3", **kwargs)
+
+    return _make_store
+
+
+def _turn(number: int) -> list[dict]:
+    return [{"role": "user", "content": f"turn {number}"}, {"role": "assistant", "content": f"reply {number}"}]
+
+
+def test_history_puts_the_chain_of_turns_back_together(make_store):
+    store = make_store(max_entries=100, ttl_seconds=60.0)
+    store.store("resp_1", None, _turn(1))
+    store.store("resp_2", "resp_1", _turn(2))
+    store.store("resp_3", "resp_2", _turn(3))
+
+    assert store.history("resp_3") == _turn(1) + _turn(2) + _turn(3)
+    # Every turn is stored once, whichever branch continues from it
+    store.store("resp_2b", "resp_1", _turn(4))
+    assert store.history("resp_2b") == _turn(1) + _turn(4)
+    assert store.stats() == {
+        "hits": 2,
+        "misses": 0,
+        "evictions": 0,
+        "expirations": 0,
+        "stored": 4,
+        "restored_messages": 10,
+    }
+
+
+def test_unknown_response(make_store):
+    store = make_store(max_entries=100, ttl_seconds=60.0)
+
+    assert store.history("resp_unknown") is None
+    assert store.stats()["misses"] == 1
+
+
+def test_a_conversation_with_a_missing_turn_is_gone(make_store):
+    store = make_store(max_entries=2, ttl_seconds=60.0)
+    store.store("resp_1", None, _turn(1))
+    store.store("resp_2", "resp_1", _turn(2))
+    store.store("resp_3", "resp_2", _turn(3))
+
+    assert store.stats()["evictions"] == 1
+    assert store.history("resp_3") is None
+
+
+def test_restoring_a_conversation_keeps_its_turns_from_being_evicted(make_store):
+    store = make_store(max_entries=3, ttl_seconds=60.0)
+    store.store("resp_a1", None, _turn(1))
+    store.store("resp_b1", None, _turn(1))
+    store.store("resp_a2", "resp_a1", _turn(2))
+    # Restored later than the other turns were stored (by the clock)
+    time.sleep(0.01)
+    assert store.history("resp_a2") is not None
+
+    store.store("resp_c1", None, _turn(1))
+
+    assert store.history("resp_a2") == _turn(1) + _turn(2)
+    assert store.history("resp_b1") is None
+
+
+def test_turns_expire(make_store):
+    store = make_store(max_entries=100, ttl_seconds=0.05)
+    store.store("resp_1", None, _turn(1))
+    time.sleep(0.1)
+
+    assert store.history("resp_1") is None
+
+
+def test_backends():
+    assert create_conversation_store("") is None
+    assert isinstance(create_conversation_store("memory"), InMemoryConversationStore)
+    with pytest.raises(ValueError):
+        create_conversation_store("redis")
+
+
+def test_the_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        ConversationStore(max_entries=100, ttl_seconds=60.0)  # pylint: disable=abstract-class-instantiated
+
+
+def test_normalize_message_drops_the_unset_fields():
+    assert normalize_message({"role": "assistant", "content": "Hmm.", "tool_calls": None}) == {
+        "role": "assistant",
+        "content": "Hmm.",
+    }
@@ -0,0 +1,44 @@
+import asyncio
+
+from openai import OpenAI
+
+from common.http_pool import UpstreamClientPool
+
+
+_OPENAI = "openai/gpt-4o"
+_ANTHROPIC = "anthropic/claude-3-5-sonnet-20240620"
+
+
+def test_without_an_api_key_litellm_creates_the_openai_clients(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    pool = UpstreamClientPool({"warm_up": False})
+
+    assert pool.get_client(_OPENAI, is_async=False) is None
+    assert not pool.warm_up([_OPENAI], background=False)
+
+    # Created once there is a key
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    assert isinstance(pool.get_client(_OPENAI, is_async=False), OpenAI)
+
+
+def test_requests_with_their_own_credentials_get_no_openai_client(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    pool = UpstreamClientPool({"warm_up": False})
+
+    assert pool.get_client(_OPENAI, is_async=False, api_key="sk-request") is None
+    assert pool.get_client(_OPENAI, is_async=False, api_base="http://localhost:8000/v1") is None
+    # The other providers' clients don't carry credentials
+    assert pool.get_client(_ANTHROPIC, is_async=False, api_key="sk-request") is not None
+
+
+def test_async_handlers_use_the_pooled_client():
+    pool = UpstreamClientPool({"warm_up": False})
+
+    async def main():
+        handler = pool.get_client(_ANTHROPIC, is_async=True)
+        http_client = pool._clients[(_ANTHROPIC, True)].http_client  # pylint: disable=protected-access
+        assert handler.client is http_client
+        await pool.aclose()
+        return http_client
+
+    assert asyncio.run(main()).is_closed
@@ -0,0 +1,117 @@
+"""
+The pre-upstream hooks (the prompt transforms of the handlers) run once the
+target of the upstream call was chosen, for every attempt.
+"""
+
+import asyncio
+
+import litellm
+import pytest
+
+from common.hedging import HedgingPolicy
+from common.prompt_transforms import AddCacheControl, InjectSystemPrompt, PromptTransformPipeline
+from common.proxy_llm import ProxyCall, ProxyLLM
+from common.routing import TargetRouter
+
+
+_ANTHROPIC = "anthropic/claude-3-5-sonnet-20240620"
+_OPENAI = "openai/gpt-4o"
+
+
+class _RecordingLLM(ProxyLLM):
+    """
+    Sends nothing upstream - records the target and the messages of every
+    upstream call instead. The calls to `slow_target` take a while.
+    """
+
+    def __init__(self, *, slow_target=None, **kwargs):
+        self.prompt_transform = PromptTransformPipeline(
+            [InjectSystemPrompt("Be brief."), AddCacheControl(mode="auto")]
+        )
+        self.slow_target = slow_target
+        self.upstream_calls = []
+        super().__init__(
+            pre_upstream_hooks=[self._transform_prompt],
+            write_traces=False,
+            write_recordings=False,
+            stage_timing=False,
+            startup_warm_up=False,
+            **kwargs,
+        )
+
+    def _transform_prompt(self, call: ProxyCall) -> None:
+        call.messages = self.prompt_transform(call.messages, target_model=call.target_model)
+
+    def upstream_completion(self, call):
+        self.upstream_calls.append((call.target_model, call.messages))
+        return _response(call.target_model)
+
+    async def aupstream_completion(self, call):
+        self.upstream_calls.append((call.target_model, call.messages))
+        if call.target_model == self.slow_target:
+            await asyncio.sleep(1)
+        return _response(call.target_model)
+
+
+def _response(target_model: str) -> litellm.ModelResponse:
+    return litellm.ModelResponse(model=target_model, choices=[{"message": {"role": "assistant", "content": "Hmm."}}])
+
+
+def _router(targets: list[str], preferred: list[str]) -> TargetRouter:
+    router = TargetRouter(targets, explore_ratio=0.0)
+    # The first preferred target that isn't excluded, rather than the fastest
+    router.choose = lambda messages, exclude=(): next(target for target in preferred if target not in exclude)
+    return router
+
+
+def _completion_kwargs() -> dict:
+    return {
+        "model": "yoda-speak",
+        "messages": [{"role": "user", "content": "Hello"}],
+        "api_base": None,
+        "custom_prompt_dict": {},
+        "model_response": litellm.ModelResponse(),
+        "print_verbose": print,
+        "encoding": None,
+        "api_key": None,
+        "logging_obj": None,
+        "optional_params": {},
+    }
+
+
+def _has_cache_control(messages: list) -> bool:
+    content = messages[0]["content"]
+    return isinstance(content, list) and "cache_control" in content[-1]
+
+
+@pytest.mark.parametrize("target_model", [_ANTHROPIC, _OPENAI])
+def test_prompt_transforms_see_the_routed_target(target_model):
+    other = _OPENAI if target_model == _ANTHROPIC else _ANTHROPIC
+    # The handler's own `target_model` (the first target) is the other one
+    handler = _RecordingLLM(router=_router([other, target_model], [target_model]))
+
+    handler.completion(**_completion_kwargs())
+
+    assert len(handler.upstream_calls) == 1
+    sent_to, messages = handler.upstream_calls[0]
+    assert sent_to == target_model
+    assert messages[0]["role"] == "system"
+    assert _has_cache_control(messages) == (target_model == _ANTHROPIC)
+
+
+def test_hedged_attempts_are_transformed_for_their_own_target():
+    handler = _RecordingLLM(
+        router=_router([_ANTHROPIC, _OPENAI], [_ANTHROPIC, _OPENAI]),
+        hedging=HedgingPolicy(delay=0.05, max_hedge_ratio=1.0),
+        slow_target=_ANTHROPIC,
+    )
+
+    response = asyncio.run(handler.acompletion(**_completion_kwargs()))
+
+    assert response.model == _OPENAI
+    sent = dict(handler.upstream_calls)
+    assert set(sent) == {_ANTHROPIC, _OPENAI}
+    assert _has_cache_control(sent[_ANTHROPIC])
+    assert not _has_cache_control(sent[_OPENAI])
+    # Transformed from the original request, not from the other attempt
+    assert [message["role"] for message in sent[_OPENAI]] == ["system", "user"]
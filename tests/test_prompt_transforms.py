@@ -0,0 +1,87 @@
+import litellm
+import pytest
+
+from common.prompt_transforms import (
+    AddCacheControl,
+    InjectSystemPrompt,
+    PromptCacheStats,
+    PromptTransformPipeline,
+    prompt_cache_usage,
+)
+
+
+_CONVERSATION = [
+    {"role": "system", "content": "Be brief."},
+    {"role": "user", "content": "Hello"},
+]
+
+
+@pytest.mark.parametrize(
+    "position, expected",
+    [
+        ("prepend", [{"role": "system", "content": "Speak like Yoda."}, *_CONVERSATION]),
+        ("merge", [{"role": "system", "content": "Be brief.\n\nSpeak like Yoda."}, _CONVERSATION[1]]),
+        ("append", [*_CONVERSATION, {"role": "system", "content": "Speak like Yoda."}]),
+    ],
+)
+def test_inject_system_prompt(position, expected):
+    transform = InjectSystemPrompt("Speak like Yoda.", position=position)
+
+    assert transform(_CONVERSATION, target_model="openai/gpt-4o") == expected
+
+
+def test_cache_control_marks_the_end_of_the_system_messages():
+    transform = AddCacheControl(mode="auto")
+
+    anthropic = transform(_CONVERSATION, target_model="anthropic/claude-3-5-sonnet-20240620")
+
+    assert anthropic[0]["content"] == [{"type": "text", "text": "Be brief.", "cache_control": {"type": "ephemeral"}}]
+    assert anthropic[1:] == _CONVERSATION[1:]
+    # The request itself stays as it was
+    assert _CONVERSATION[0]["content"] == "Be brief."
+    assert transform(_CONVERSATION, target_model="openai/gpt-4o") is _CONVERSATION
+
+
+def test_pipeline_from_settings():
+    pipeline = PromptTransformPipeline.from_settings(
+        [{"type": "inject_system_prompt", "position": "merge"}, {"type": "cache_control", "mode": "never"}],
+        system_prompt="Speak like Yoda.",
+    )
+
+    assert [type(transform) for transform in pipeline.transforms] == [InjectSystemPrompt, AddCacheControl]
+    with pytest.raises(ValueError):
+        PromptTransformPipeline.from_settings([{"type": "unknown"}])
+
+
+@pytest.mark.parametrize(
+    "usage, expected",
+    [
+        # OpenAI
+        (
+            litellm.Usage(prompt_tokens=100, completion_tokens=5, prompt_tokens_details={"cached_tokens": 64}),
+            (100, 64, 0),
+        ),
+        # Anthropic (as LiteLLM passes it on in a dict)
+        ({"prompt_tokens": 100, "cache_read_input_tokens": 32, "cache_creation_input_tokens": 50}, (100, 32, 50)),
+        # No prompt caching at all
+        ({"prompt_tokens": 10, "completion_tokens": 5}, (10, 0, 0)),
+    ],
+)
+def test_prompt_cache_usage(usage, expected):
+    assert prompt_cache_usage(usage) == expected
+
+
+def test_prompt_cache_stats():
+    stats = PromptCacheStats()
+    stats.record_usage({"prompt_tokens": 100, "cache_read_input_tokens": 75})
+    stats.record_usage(None)
+    stats.record_missing_usage()
+
+    assert stats.stats() == {
+        "responses": 1,
+        "usage_fallbacks": 1,
+        "prompt_tokens": 100,
+        "cached_tokens": 75,
+        "cache_creation_tokens": 0,
+        "cached_ratio": 0.75,
+    }
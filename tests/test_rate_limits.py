@@ -0,0 +1,70 @@
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from common.admission import AdmissionRejectedError
+from common.rate_limits import RateLimitPacer
+from common.shared_state import SharedState
+
+
+_TARGET = "openai/gpt-4o"
+_MESSAGES = [{"role": "user", "content": "Hello"}]
+
+
+def test_reservations_wait_once_the_quota_is_spent():
+    pacer = RateLimitPacer(window=60.0, requests_per_minute=2, max_wait=60.0)
+
+    delays = [pacer.reserve(_TARGET, _MESSAGES, {}).delay for _ in range(3)]
+
+    assert delays[:2] == [0.0, 0.0]
+    assert delays[2] == pytest.approx(30.0, abs=0.1)
+
+
+def test_reservations_that_would_wait_too_long_are_rejected():
+    pacer = RateLimitPacer(window=60.0, requests_per_minute=1, max_wait=1.0)
+    pacer.reserve(_TARGET, _MESSAGES, {})
+
+    with pytest.raises(AdmissionRejectedError):
+        pacer.reserve(_TARGET, _MESSAGES, {})
+    assert pacer.stats()[_TARGET]["rejected"] == 1
+
+
+def test_workers_share_the_quota(tmp_path):
+    workers = [
+        RateLimitPacer(window=60.0, requests_per_minute=2, max_wait=60.0, shared_state=SharedState(tmp_path / "s.db"))
+        for _ in range(2)
+    ]
+
+    delays = [workers[idx % 2].reserve(_TARGET, _MESSAGES, {}).delay for idx in range(3)]
+
+    assert delays[2] > 0
+
+
+def test_shared_reservations_dont_block_the_event_loop(tmp_path):
+    path = tmp_path / "s.db"
+    pacer = RateLimitPacer(window=60.0, requests_per_minute=60, shared_state=SharedState(path))
+    # Another worker holding the write lock for a while
+    other_worker = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    other_worker.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.3, other_worker.execute, ("COMMIT",)).start()
+
+    async def main():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.ensure_future(tick())
+        reservation = await pacer.areserve(_TARGET, _MESSAGES, {})
+        ticker.cancel()
+        return reservation, ticks
+
+    reservation, ticks = asyncio.run(main())
+
+    assert reservation.delay == 0.0
+    assert ticks >= 10
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from common.response_cache import InMemoryResponseCache, ResponseCache, SQLiteResponseCache, make_cache_key
+
+
+@pytest.fixture(name="make_cache", params=["memory", "sqlite"])
+def fixture_make_cache(request, tmp_path):
+    def _make_cache(**kwargs):
+        if request.param == "memory":
+            return InMemoryResponseCache(**kwargs)
+        return SQLiteResponseCache(path=tmp_path / "response_cache.sqlite3", **kwargs)
+
+    return _make_cache
+
+
+def test_least_recently_used_entries_are_evicted(make_cache):
+    cache = make_cache(max_entries=2, ttl_seconds=60.0)
+    cache.set("a", {"response": "a"})
+    cache.set("b", {"response": "b"})
+    time.sleep(0.01)
+    assert cache.get("a") == {"response": "a"}
+
+    cache.set("c", {"response": "c"})
+
+    assert cache.get("b") is None
+    assert cache.get("a") == {"response": "a"}
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 1, "expirations": 0}
+
+
+def test_entries_expire(make_cache):
+    cache = make_cache(max_entries=10, ttl_seconds=0.05)
+    cache.set("a", {"response": "a"})
+    time.sleep(0.1)
+
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_cache_key_ignores_the_order_of_dict_keys_and_the_stream_options():
+    key = make_cache_key(
+        target_model="openai/gpt-4o",
+        messages=[{"role": "user", "content": "Hello"}],
+        optional_params={"temperature": 0, "max_tokens": 10},
+        stream=True,
+    )
+
+    assert key == make_cache_key(
+        target_model="openai/gpt-4o",
+        messages=[{"content": "Hello", "role": "user"}],
+        optional_params={"max_tokens": 10, "temperature": 0, "stream_options": {"include_usage": True}},
+        stream=True,
+    )
+    assert key != make_cache_key(
+        target_model="openai/gpt-4o",
+        messages=[{"role": "user", "content": "Hello"}],
+        optional_params={"temperature": 0, "max_tokens": 10},
+        stream=False,
+    )
+
+
+def test_the_base_class_is_abstract():
+    with pytest.raises(TypeError):
+        ResponseCache(max_entries=100, ttl_seconds=60.0)  # pylint: disable=abstract-class-instantiated
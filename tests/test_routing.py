@@ -0,0 +1,55 @@
+from common.routing import TargetRouter
+
+
+_TARGETS = ["openai/gpt-4o", "azure/gpt-4o"]
+_CONVERSATION = [{"role": "system", "content": "Speak like Yoda."}, {"role": "user", "content": "Hello"}]
+
+
+def _served(router: TargetRouter, target: str, *, ttft: float, error: bool = False) -> None:
+    router.start(target)
+    router.first_token(target, ttft)
+    router.finish(target, error=error)
+
+
+def test_a_conversation_sticks_to_its_target():
+    router = TargetRouter(_TARGETS, explore_ratio=0.0)
+    first = router.choose(_CONVERSATION)
+    # The other target got faster, but not by `sticky_tolerance`
+    _served(router, first, ttft=1.0)
+    other = next(target for target in _TARGETS if target != first)
+    _served(router, other, ttft=0.8)
+
+    assert router.choose(_CONVERSATION + [{"role": "assistant", "content": "Hmm."}]) == first
+    assert router.stats()["sticky_hits"] == 1
+
+
+def test_hedged_attempts_dont_move_the_conversation():
+    router = TargetRouter(_TARGETS, explore_ratio=0.0)
+    first = router.choose(_CONVERSATION)
+
+    hedge_target = router.choose(_CONVERSATION, exclude=(first,))
+
+    assert hedge_target != first
+    assert router.choose(_CONVERSATION) == first
+    assert router.stats()["sticky_reroutes"] == 0
+
+
+def test_a_conversation_moves_away_from_an_unhealthy_target():
+    router = TargetRouter(_TARGETS, explore_ratio=0.0)
+    first = router.choose(_CONVERSATION)
+    for _ in range(10):
+        _served(router, first, ttft=1.0, error=True)
+
+    second = router.choose(_CONVERSATION)
+
+    assert second != first
+    assert router.choose(_CONVERSATION) == second
+    assert router.stats()["sticky_reroutes"] == 1
+
+
+def test_from_settings():
+    assert TargetRouter.from_settings(None) is None
+    assert TargetRouter.from_settings({"enabled": False, "targets": _TARGETS}) is None
+    router = TargetRouter.from_settings({"enabled": True, "targets": _TARGETS, "sticky": False})
+    assert router.targets == tuple(_TARGETS)
+    assert not router.sticky
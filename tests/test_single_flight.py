@@ -0,0 +1,85 @@
+import asyncio
+
+from common.single_flight import SingleFlight, SlowSubscriberError
+
+
+def test_concurrent_identical_calls_share_one_upstream_call():
+    single_flight = SingleFlight()
+    upstream_calls = []
+
+    async def fn():
+        upstream_calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"answer": 42}
+
+    async def main():
+        return await asyncio.gather(*(single_flight.call("key", fn) for _ in range(3)))
+
+    results = asyncio.run(main())
+
+    assert len(upstream_calls) == 1
+    assert results == [{"answer": 42}] * 3
+    # Every caller gets its own copy
+    assert len({id(result) for result in results}) == 3
+    assert single_flight.stats() == {"leaders": 1, "followers": 2, "slow_subscribers": 0, "in_flight": 0}
+
+
+def test_streams_are_fanned_out():
+    single_flight = SingleFlight()
+
+    async def source():
+        for idx in range(5):
+            await asyncio.sleep(0.001)
+            yield idx
+
+    async def consume():
+        return [chunk async for chunk in single_flight.stream("key", source)]
+
+    async def main():
+        return await asyncio.gather(consume(), consume())
+
+    assert asyncio.run(main()) == [[0, 1, 2, 3, 4]] * 2
+    assert single_flight.stats()["leaders"] == 1
+
+
+def test_a_slow_subscriber_is_cut_off():
+    single_flight = SingleFlight(max_lag=2)
+
+    async def source():
+        for idx in range(10):
+            await asyncio.sleep(0.001)
+            yield idx
+
+    async def fast():
+        return [chunk async for chunk in single_flight.stream("key", source)]
+
+    async def slow():
+        chunks = []
+        async for chunk in single_flight.stream("key", source):
+            chunks.append(chunk)
+            await asyncio.sleep(0.05)
+        return chunks
+
+    async def main():
+        return await asyncio.gather(fast(), slow(), return_exceptions=True)
+
+    fast_chunks, slow_result = asyncio.run(main())
+
+    assert fast_chunks == list(range(10))
+    assert isinstance(slow_result, SlowSubscriberError)
+    assert single_flight.stats()["slow_subscribers"] == 1
+
+
+def test_errors_reach_every_caller():
+    single_flight = SingleFlight()
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def main():
+        return await asyncio.gather(*(single_flight.call("key", fn) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert [type(result) for result in results] == [ValueError, ValueError]
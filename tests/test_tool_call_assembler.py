@@ -0,0 +1,76 @@
+import json
+
+from common.tool_call_assembler import ToolCallAssembler
+
+
+def _chunk(*tool_calls, choice_index=0) -> dict:
+    return {"choices": [{"index": choice_index, "delta": {"tool_calls": list(tool_calls)}, "finish_reason": None}]}
+
+
+def _delta(index: int, arguments: str, *, tc_id=None, name=None) -> dict:
+    tool_call = {"index": index, "function": {"arguments": arguments}}
+    if tc_id is not None:
+        tool_call["id"] = tc_id
+        tool_call["type"] = "function"
+        tool_call["function"]["name"] = name
+    return tool_call
+
+
+def test_parallel_tool_calls_are_put_together():
+    assembler = ToolCallAssembler()
+
+    assert not assembler.feed(_chunk(_delta(0, "", tc_id="call_a", name="get_weather")))
+    assert not assembler.feed(_chunk(_delta(0, '{"city": ')))
+    assert not assembler.feed(_chunk(_delta(0, '"Paris"}')))
+    # Moving on to the next call completes the previous one
+    completed = assembler.feed(_chunk(_delta(1, '{"city": "Rome"}', tc_id="call_b", name="get_weather")))
+    assert [tool_call.id for tool_call in completed] == ["call_a"]
+    completed = assembler.feed({"choices": [{"index": 0, "delta": {}, "finish_reason": "tool_calls"}]})
+    assert [tool_call.id for tool_call in completed] == ["call_b"]
+
+    assert [tool_call.to_dict() for tool_call in assembler.tool_calls()] == [
+        {"id": "call_a", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Paris"}'}},
+        {"id": "call_b", "type": "function", "function": {"name": "get_weather", "arguments": '{"city": "Rome"}'}},
+    ]
+    assert not assembler.finish()
+
+
+def test_calls_complete_as_soon_as_their_json_does():
+    assembler = ToolCallAssembler(parse_json=True)
+    arguments = json.dumps({"query": 'a "quoted" {brace}', "tags": ["x", "y"]})
+    fragments = [arguments[start : start + 3] for start in range(0, len(arguments), 3)]
+
+    completed = [tool_call for fragment in fragments for tool_call in assembler.feed(_chunk(_delta(0, fragment)))]
+
+    assert len(completed) == 1
+    assert completed[0].parsed_arguments == {"query": 'a "quoted" {brace}', "tags": ["x", "y"]}
+    assert completed[0].parse_error is None
+
+
+def test_unfinished_calls_complete_with_the_stream():
+    assembler = ToolCallAssembler(parse_json=True)
+    assembler.feed(_chunk(_delta(0, '{"city": "Par', tc_id="call_a", name="get_weather")))
+
+    completed = assembler.finish()
+
+    assert len(completed) == 1
+    assert completed[0].complete
+    assert completed[0].parse_error is not None
+
+
+def test_choices_are_kept_apart():
+    assembler = ToolCallAssembler()
+    assembler.feed(_chunk(_delta(0, '{"n": 1}', tc_id="call_0", name="f")))
+    assembler.feed(_chunk(_delta(0, '{"n": 2}', tc_id="call_1", name="f"), choice_index=1))
+
+    completed = assembler.feed({"choices": [{"index": 1, "delta": {}, "finish_reason": "tool_calls"}]})
+
+    assert [tool_call.id for tool_call in completed] == ["call_1"]
+    assert [tool_call.arguments for tool_call in assembler.tool_calls(0)] == ['{"n": 1}']
+
+
+def test_legacy_function_call():
+    assembler = ToolCallAssembler()
+    assembler.feed({"choices": [{"index": 0, "delta": {"function_call": {"name": "f", "arguments": "{}"}}}]})
+
+    assert [(tool_call.name, tool_call.arguments) for tool_call in assembler.finish()] == [("f", "{}")]
@@ -0,0 +1,44 @@
+import json
+
+from litellm import ModelResponseStream
+
+import common.trace_session
+from common.trace_session import StreamTraceSession
+from common.trace_writer import BackgroundTraceWriter, snapshot
+
+
+def _chunk(content: str, finish_reason=None) -> ModelResponseStream:
+    return ModelResponseStream(
+        id="chatcmpl-upstream", choices=[{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}]
+    )
+
+
+def test_snapshot_is_not_reached_by_later_mutations():
+    messages = [{"role": "user", "content": [{"type": "text", "text": "hi"}]}]
+    copied = snapshot(messages)
+    messages[0]["content"][0]["text"] = "changed"
+    messages.append({"role": "assistant", "content": "later"})
+
+    assert copied == [{"role": "user", "content": [{"type": "text", "text": "hi"}]}]
+
+
+def test_stream_trace_records_the_chunks_as_they_were_added(tmp_path, monkeypatch):
+    monkeypatch.setattr(common.trace_session, "TRACES_DIR", tmp_path)
+    writer = BackgroundTraceWriter(max_queue_size=100, overflow_policy="block", batch_size=10)
+
+    chunks = [_chunk("Hmm"), _chunk(", strong you are.", finish_reason="stop")]
+    with StreamTraceSession(
+        timestamp="ts", calling_method="astreaming", trace_format="jsonl", writer=writer
+    ) as session:
+        for chunk in chunks:
+            session.add_chunk(complapi_chunk=chunk)
+            # What LiteLLM and the hooks do with the chunks once they are yielded
+            chunk.choices[0].finish_reason = None
+            chunk.id = "resp_handler"
+    assert writer.flush(timeout=5)
+    writer.close()
+
+    records = [json.loads(line) for line in (tmp_path / "ts_RESPONSE_STREAM.jsonl").read_text().splitlines()]
+    assert [record["complapi_chunk"]["id"] for record in records] == ["chatcmpl-upstream"] * 2
+    assert records[-1]["complapi_chunk"]["choices"][0]["finish_reason"] == "stop"
+    assert (tmp_path / "ts_RESPONSE_TEXT.md").read_text() == "Hmm, strong you are."
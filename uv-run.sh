@@ -5,9 +5,12 @@
 set -e
 LITELLM_CONFIG="${LITELLM_CONFIG:-config.yaml}"
 LITELLM_PORT="${LITELLM_PORT:-4000}"
+# Picked up by `litellm` itself (`--num_workers`)
+export NUM_WORKERS="${NUM_WORKERS:-1}"
 echo ""
 echo "🚀 Running My LiteLLM Server (via uv)..."
 echo "📦 Config: ${LITELLM_CONFIG}"
+echo "👷 Workers: ${NUM_WORKERS}"
 echo ""
 echo "Starting..."
 uv run litellm --config "${LITELLM_CONFIG}" --port "${LITELLM_PORT}" --host "0.0.0.0"
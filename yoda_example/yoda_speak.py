@@ -1,20 +1,19 @@
-from typing import Any, AsyncGenerator, Callable, Generator, Optional, Union
-
-import httpx
-import litellm
-from litellm import (
-    CustomLLM,
-    CustomStreamWrapper,
-    GenericStreamingChunk,
-    HTTPHandler,
-    ModelResponse,
-    ModelResponseStream,
-    AsyncHTTPHandler,
-)
-
-from common.config import WRITE_TRACES_TO_FILES
-from common.tracing_in_markdown import write_request_trace, write_response_trace, write_streaming_chunk_trace
-from common.utils import ProxyError, generate_timestamp_utc, to_generic_streaming_chunk
+from typing import Any, Optional
+
+from common.admission import AdmissionController
+from common.chunk_coalescer import create_chunk_coalescer
+from common.config import REQUEST_COALESCING, load_handler_settings
+from common.conversation_store import create_conversation_store
+from common.hedging import HedgingPolicy
+from common.http_pool import UpstreamClientPool
+from common.metrics import create_proxy_metrics
+from common.prompt_transforms import InjectSystemPrompt, PromptTransformPipeline
+from common.proxy_llm import ProxyCall, ProxyLLM
+from common.rate_limits import RateLimitPacer
+from common.response_cache import create_response_cache
+from common.routing import TargetRouter
+from common.shared_state import shared_state
+from common.single_flight import SingleFlight
 
 
 _YODA_SYSTEM_PROMPT = {
@@ -26,259 +25,51 @@ _YODA_SYSTEM_PROMPT = {
 }
 
 
-class YodaSpeakLLM(CustomLLM):
-    # pylint: disable=too-many-positional-arguments,too-many-locals,duplicate-code
+class YodaSpeakLLM(ProxyLLM):
     """
     Proxy wrapper that forces Yoda-speak responses from the underlying LLM.
-    """
-
-    def __init__(self, *, target_model: str = "openai/gpt-4o", **kwargs: Any) -> None:
-        super().__init__(**kwargs)
-        self.target_model = target_model
-
-    def completion(
-        self,
-        model: str,
-        messages: list,
-        api_base: str,
-        custom_prompt_dict: dict,
-        model_response: ModelResponse,
-        print_verbose: Callable,
-        encoding,
-        api_key,
-        logging_obj,
-        optional_params: dict,
-        acompletion=None,
-        litellm_params=None,
-        logger_fn=None,
-        headers=None,
-        timeout: Optional[Union[float, httpx.Timeout]] = None,
-        client: Optional[HTTPHandler] = None,
-    ) -> ModelResponse:
-        try:
-            timestamp = generate_timestamp_utc()
-            calling_method = "completion"
-
-            messages_modified = messages + [_YODA_SYSTEM_PROMPT]
-
-            if WRITE_TRACES_TO_FILES:
-                write_request_trace(
-                    timestamp=timestamp,
-                    calling_method=calling_method,
-                    messages_original=messages,
-                    messages_complapi=messages_modified,
-                    params_complapi=optional_params,
-                )
-
-            response: ModelResponse = litellm.completion(
-                model=self.target_model,
-                messages=messages_modified,
-                logger_fn=logger_fn,
-                headers=headers or {},
-                timeout=timeout,
-                client=client,
-                # Drop any params that are not supported by the provider
-                drop_params=True,
-                **optional_params,
-            )
-
-            if WRITE_TRACES_TO_FILES:
-                write_response_trace(
-                    timestamp=timestamp,
-                    calling_method=calling_method,
-                    response_complapi=response,
-                )
-
-            return response
-
-        except Exception as e:
-            raise ProxyError(e) from e
-
-    async def acompletion(
-        self,
-        model: str,
-        messages: list,
-        api_base: str,
-        custom_prompt_dict: dict,
-        model_response: ModelResponse,
-        print_verbose: Callable,
-        encoding,
-        api_key,
-        logging_obj,
-        optional_params: dict,
-        acompletion=None,
-        litellm_params=None,
-        logger_fn=None,
-        headers=None,
-        timeout: Optional[Union[float, httpx.Timeout]] = None,
-        client: Optional[AsyncHTTPHandler] = None,
-    ) -> ModelResponse:
-        try:
-            timestamp = generate_timestamp_utc()
-            calling_method = "acompletion"
-
-            messages_modified = messages + [_YODA_SYSTEM_PROMPT]
-
-            if WRITE_TRACES_TO_FILES:
-                write_request_trace(
-                    timestamp=timestamp,
-                    calling_method=calling_method,
-                    messages_original=messages,
-                    messages_complapi=messages_modified,
-                    params_complapi=optional_params,
-                )
-
-            response: ModelResponse = await litellm.acompletion(
-                model=self.target_model,
-                messages=messages_modified,
-                logger_fn=logger_fn,
-                headers=headers or {},
-                timeout=timeout,
-                client=client,
-                # Drop any params that are not supported by the provider
-                drop_params=True,
-                **optional_params,
-            )
-
-            if WRITE_TRACES_TO_FILES:
-                write_response_trace(
-                    timestamp=timestamp,
-                    calling_method=calling_method,
-                    response_complapi=response,
-                )
-
-            return response
-
-        except Exception as e:
-            raise ProxyError(e) from e
 
-    def streaming(
-        self,
-        model: str,
-        messages: list,
-        api_base: str,
-        custom_prompt_dict: dict,
-        model_response: ModelResponse,
-        print_verbose: Callable,
-        encoding,
-        api_key,
-        logging_obj,
-        optional_params: dict,
-        acompletion=None,
-        litellm_params=None,
-        logger_fn=None,
-        headers=None,
-        timeout: Optional[Union[float, httpx.Timeout]] = None,
-        client: Optional[HTTPHandler] = None,
-    ) -> Generator[GenericStreamingChunk, None, None]:
-        try:
-            timestamp = generate_timestamp_utc()
-            calling_method = "streaming"
-
-            messages_modified = messages + [_YODA_SYSTEM_PROMPT]
-
-            if WRITE_TRACES_TO_FILES:
-                write_request_trace(
-                    timestamp=timestamp,
-                    calling_method=calling_method,
-                    messages_original=messages,
-                    messages_complapi=messages_modified,
-                    params_complapi=optional_params,
-                )
-
-            resp_stream: CustomStreamWrapper = litellm.completion(
-                model=self.target_model,
-                messages=messages_modified,
-                logger_fn=logger_fn,
-                headers=headers or {},
-                timeout=timeout,
-                client=client,
-                # Drop any params that are not supported by the provider
-                drop_params=True,
-                **optional_params,
-            )
-
-            for chunk_idx, chunk in enumerate[ModelResponseStream](resp_stream):
-                generic_chunk = to_generic_streaming_chunk(chunk)
-
-                if WRITE_TRACES_TO_FILES:
-                    write_streaming_chunk_trace(
-                        timestamp=timestamp,
-                        calling_method=calling_method,
-                        chunk_idx=chunk_idx,
-                        complapi_chunk=chunk,
-                        generic_chunk=generic_chunk,
-                    )
-
-                yield generic_chunk
-
-        except Exception as e:
-            raise ProxyError(e) from e
+    This handler only rewrites the request (a single pre-upstream hook, so
+    that the prompt transforms see the target the request is actually sent
+    to), so with `passthrough_stream=True` the upstream `ModelResponseStream` chunks
+    are yielded to LiteLLM as they are, without being converted to
+    `GenericStreamingChunk` dicts and back.
+    """
 
-    async def astreaming(
+    def __init__(
         self,
-        model: str,
-        messages: list,
-        api_base: str,
-        custom_prompt_dict: dict,
-        model_response: ModelResponse,
-        print_verbose: Callable,
-        encoding,
-        api_key,
-        logging_obj,
-        optional_params: dict,
-        acompletion=None,
-        litellm_params=None,
-        logger_fn=None,
-        headers=None,
-        timeout: Optional[Union[float, httpx.Timeout]] = None,
-        client: Optional[AsyncHTTPHandler] = None,
-    ) -> AsyncGenerator[GenericStreamingChunk, None]:
-        try:
-            timestamp = generate_timestamp_utc()
-            calling_method = "astreaming"
-
-            messages_modified = messages + [_YODA_SYSTEM_PROMPT]
-
-            if WRITE_TRACES_TO_FILES:
-                write_request_trace(
-                    timestamp=timestamp,
-                    calling_method=calling_method,
-                    messages_original=messages,
-                    messages_complapi=messages_modified,
-                    params_complapi=optional_params,
-                )
-
-            resp_stream: CustomStreamWrapper = await litellm.acompletion(
-                model=self.target_model,
-                messages=messages_modified,
-                logger_fn=logger_fn,
-                headers=headers or {},
-                timeout=timeout,
-                client=client,
-                # Drop any params that are not supported by the provider
-                drop_params=True,
-                **optional_params,
-            )
-
-            chunk_idx = 0
-            async for chunk in resp_stream:
-                generic_chunk = to_generic_streaming_chunk(chunk)
-
-                if WRITE_TRACES_TO_FILES:
-                    write_streaming_chunk_trace(
-                        timestamp=timestamp,
-                        calling_method=calling_method,
-                        chunk_idx=chunk_idx,
-                        complapi_chunk=chunk,
-                        generic_chunk=generic_chunk,
-                    )
-
-                yield generic_chunk
-                chunk_idx += 1
-
-        except Exception as e:
-            raise ProxyError(e) from e
-
-
-yoda_speak_llm = YodaSpeakLLM()
+        *,
+        target_model: Optional[str] = None,
+        prompt_transform: Optional[PromptTransformPipeline] = None,
+        **kwargs: Any,
+    ) -> None:
+        if target_model is None and kwargs.get("router") is None:
+            target_model = "openai/gpt-4o"
+        self.prompt_transform = prompt_transform or PromptTransformPipeline(
+            [InjectSystemPrompt(_YODA_SYSTEM_PROMPT["content"], position="prepend")]
+        )
+        super().__init__(target_model=target_model, pre_upstream_hooks=[self._transform_prompt], **kwargs)
+
+    def _transform_prompt(self, call: ProxyCall) -> None:
+        call.messages = self.prompt_transform(call.messages, target_model=call.target_model)
+
+
+_SETTINGS = load_handler_settings("yoda_speak")
+_METRICS = create_proxy_metrics(shared_state=shared_state)
+
+yoda_speak_llm = YodaSpeakLLM(
+    target_model=_SETTINGS.get("target_model"),
+    prompt_transform=PromptTransformPipeline.from_settings(
+        _SETTINGS.get("prompt_transforms"), system_prompt=_YODA_SYSTEM_PROMPT["content"], metrics=_METRICS
+    ),
+    chunk_coalescer=create_chunk_coalescer(),
+    response_cache=create_response_cache(),
+    single_flight=SingleFlight() if REQUEST_COALESCING else None,
+    conversation_store=create_conversation_store(),
+    client_pool=UpstreamClientPool.from_settings(_SETTINGS.get("http_pool")),
+    router=TargetRouter.from_settings(_SETTINGS.get("routing")),
+    hedging=HedgingPolicy.from_settings(_SETTINGS.get("hedging")),
+    admission=AdmissionController.from_settings(_SETTINGS.get("admission")),
+    pacer=RateLimitPacer.from_settings(_SETTINGS.get("rate_limits"), shared_state=shared_state),
+    metrics=_METRICS,
+)